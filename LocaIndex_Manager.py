@@ -1,18 +1,24 @@
+import time
+STARTUP_T0 = time.perf_counter()  # 起動時間の内訳（インポート）の計測開始
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog, simpledialog
-import csv, os, math, json, unicodedata
-from PIL import Image, ImageTk, ImageDraw, ImageFont
-from io import BytesIO
-
-# 定数（緯度は -90～90、経度は -180～180）
-LAT_MIN, LAT_MAX = -90, 90
-LON_MIN, LON_MAX = -180, 180
-
+from tkinter import ttk, messagebox, filedialog, simpledialog, font as tkfont
+import os, math, json, unicodedata, threading, queue
+from PIL import Image, ImageTk, ImageFont, ImageChops
+import numpy as np
+from locaindex_render import (
+    LAT_MIN, LAT_MAX, LON_MIN, LON_MAX, PINS_FILE, PIN_CACHE_FILE, PIN_JOURNAL_FILE, PINS_DB_FILE, SETTINGS_FILE,
+    BG_SOURCE_FILE, DEFAULT_FONT_PATH, DEFAULT_PIN_COLOR, PIN_COLORS, EXPORT_FONT_SIZE, PIN_MARKER_PIXELS,
+    PinStore, PinJournal, SqlitePinBackend, TilePyramid, RouteCache, LabelLayout, MapExport, TileExport,
+    load_pins_file, write_pins_folder, replace_atomically, read_map_window, read_map_settings, pil_text_size)
+IMPORT_SECONDS = time.perf_counter() - STARTUP_T0
+
+# 定数（地図・ピンファイル・画像出力に関するものは locaindex_render にある）
 STATE_FILE = "app_state.json"
-DEFAULT_FONT_PATH = "meiryo.ttc"  # デフォルトフォントパス
-DEFAULT_PIN_COLOR = "blue"         # デフォルトピンの色
-PIN_COLORS = ["black", "red", "blue", "green", "yellow", "purple", "orange"]
-RESOLUTION_OPTIONS = {"1x": 1, "2x": 2, "3x": 3}
+STORAGE_OPTIONS = ["CSV", "SQLite"]  # ピンの保存形式
+RESOLUTION_OPTIONS = {"1x": 1, "2x": 2, "3x": 3, "5x": 5, "10x": 10, "20x": 20}  # 出力は帯ごとに書くので大きな倍率でもメモリは増えない
+QUERY_MODES = ["近い順 (件)", "半径 (km)"]  # 近傍検索の種類
+SEARCH_MARK_LIMIT = 1000  # 検索結果を地図上で囲む最大件数
+SEARCH_LIST_LIMIT = 5000  # 検索結果を一覧に出す最大件数（名前順で先頭から。これを超える分は並べ替えない）
 
 # --- 表示文字列の幅調整用ヘルパー関数 ---
 def get_display_width(s):
@@ -41,6 +47,1070 @@ def format_pin_entry(name, distance):
     distance_padded = distance_str.rjust(target_distance_width)
     return margin + padded_name + distance_padded
 
+# --- 表示範囲（ビューポート） ---
+# 経緯度とキャンバス座標の変換。倍率 zoom のとき地図全体は (幅*zoom) x (高さ*zoom) の大きさになり、
+# offset_x / offset_y はその左上の位置（マージンからのずれ）。経度方向は一周するので offset_x は周期の剰余で持ち、
+# 緯度方向は地図が表示領域からはみ出さない範囲に制限する。
+class Viewport:
+    ZOOM_MIN = 1.0
+    ZOOM_MAX = 64.0
+    ZOOM_STEP = 1.25  # ホイール1段あたりの倍率
+
+    def __init__(self, left, top, width, height):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.zoom = 1.0
+        self.offset_x = 0.0
+        self.offset_y = 0.0
+
+    @property
+    def period(self):
+        # 経度一周分の幅（px）
+        return self.width * self.zoom
+
+    @property
+    def full_height(self):
+        return self.height * self.zoom
+
+    def lon_to_x(self, lon):
+        return self.left + (lon - LON_MIN) / (LON_MAX - LON_MIN) * self.period + self.offset_x
+
+    def lat_to_y(self, lat):
+        return self.top + (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * self.full_height + self.offset_y
+
+    def to_world(self, x, y):
+        # キャンバス座標 -> 倍率1・オフセット0 の座標（マージン除く）。クリック判定用
+        return (x - self.left - self.offset_x) / self.zoom, (y - self.top - self.offset_y) / self.zoom
+
+    def clamp(self):
+        self.offset_x %= self.period
+        self.offset_y = min(0.0, max(self.height - self.full_height, self.offset_y))
+
+    def restore(self, zoom, offset_x, offset_y):
+        self.zoom = min(max(float(zoom), self.ZOOM_MIN), self.ZOOM_MAX)
+        self.offset_x = float(offset_x)
+        self.offset_y = float(offset_y)
+        self.clamp()
+
+    def center_on(self, x, y, zoom):
+        # 倍率1の座標 (x, y) を表示領域の中央に置く
+        self.zoom = min(max(zoom, self.ZOOM_MIN), self.ZOOM_MAX)
+        self.offset_x = self.width / 2 - x * self.zoom
+        self.offset_y = self.height / 2 - y * self.zoom
+        self.clamp()
+
+    def pan(self, dx, dy):
+        self.offset_x += dx
+        self.offset_y += dy
+        self.clamp()
+
+    def zoom_at(self, x, y, factor):
+        # (x, y) の下にある地点が動かないように拡大・縮小する。倍率が変わらなければ False
+        zoom = min(max(self.zoom * factor, self.ZOOM_MIN), self.ZOOM_MAX)
+        if zoom == self.zoom:
+            return False
+        scale = zoom / self.zoom
+        self.offset_x = x - self.left - (x - self.left - self.offset_x) * scale
+        self.offset_y = y - self.top - (y - self.top - self.offset_y) * scale
+        self.zoom = zoom
+        self.clamp()
+        return True
+
+# --- キャンバス描画シーン（保持モード） ---
+# キャンバス上のアイテムは一度だけ作成し、種類ごとのタグ（bg, grid, pin:<id>, route）で管理する。
+# アイテムは表示範囲の上下左右に半画面ずつ余裕を持たせた範囲（配置範囲）に入るものだけを作る。
+# 余裕の中でのパンは "pan"（縦横）/ "pan_x"（横のみ）/ "pan_y"（縦のみ）タグのアイテムを canvas.move で動かすだけで、
+# 余裕を越えたときや倍率が変わったときだけ作り直す。描画の手間は見えている範囲のピン数で決まる。
+# ピンのラベルは LabelLayout で重ならない位置に置き、置けないものは描かない。
+# クラスタ表示が有効で配置範囲のピンが CLUSTER_MIN_PINS 以上のときは、倍率に合う段の PinClusterIndex のセルのうち
+# ピンが2つ以上あるものを件数付きの印1つで描く（ピンの少ないマップや拡大した範囲では従来どおり個々に描く）。
+# 個々に描くピンが RASTER_MIN_PINS 以上のときは、マーカーをピンごとのアイテムにせず配置範囲の大きさの1枚の画像に描く
+# （ラベルはテキストアイテムのまま）。画像はピンが変わったときと作り直すときだけ描き直し、クリック判定はグリッドで行う。
+class MapScene:
+    # 下から順の重なり順
+    LAYERS = ("bg", "grid", "pin", "highlight", "search", "preview_pin", "route")
+    GRID_STEPS = (30, 15, 10, 5, 2, 1, 0.5, 0.25, 0.1)  # 経緯線の間隔（度）の候補（粗い順）
+    GRID_SPACING = 50  # 経緯線どうしの最小間隔（px）
+    ITEM_MARGIN = 100  # 配置範囲の外側でも、ラベルが掛かりうるこの幅（px）まではアイテムを作る
+    RASTER_MIN_PINS = 2000  # 個々に描くピンがこの数以上ならマーカーを画像にまとめる
+    CLUSTER_MIN_PINS = 500  # 配置範囲のピンがこの数以上のときだけクラスタにまとめる
+
+    def __init__(self, app):
+        self.app = app
+        self.canvas = app.canvas
+        self.pin_tags = {}     # ピンID -> タグ名
+        self.label_font = tkfont.nametofont("TkDefaultFont")  # キャンバスの文字の既定フォント
+        self.label_height = self.label_font.metrics("linespace")
+        self.bg_photo = None   # 拡大時の背景（PhotoImage）
+        self.bg_source = None  # (キー, 透明度適用前の背景画像)
+        self.clusters = PinClusterIndex(app.pins, app.eff_width, app.eff_height)
+        self.expanded = set()  # クリックで個々のピンに分けたクラスタ (段, セル)
+        self.level = None      # 描いているクラスタの段（クラスタ表示でなければ None）
+        self.cells = {}        # セル -> 描いた内容（クラスタの印なら None、個々のピンならピンIDのリスト）
+        self.raster = False    # マーカーを画像にまとめて描いているか
+        self.pin_photo = None  # マーカーの画像（PhotoImage）
+        self.reset()
+        self.draw_grid()
+
+    def reset(self):
+        # 現在のビューポートを基準に配置範囲を決め直す
+        vp = self.app.viewport
+        self.zoom = vp.zoom
+        self.period = vp.period
+        self.full_height = vp.full_height
+        self.base_x, self.base_y = vp.offset_x, vp.offset_y  # 配置範囲を決めたときのオフセット
+        self.shift_x = self.shift_y = 0.0                    # その後アイテムを移動した量
+        self.pad_x = self.app.eff_width / 2
+        self.pad_y = self.app.eff_height / 2
+        # ラベルの配置は倍率ごとに決まる（配置範囲のピンについて rebuild_pins() で置き直す）
+        self.labels = LabelLayout(self.measure_label, 4, self.period, self.app.pins, lambda: self.app.current_pin_id)
+
+    def measure_label(self, text):
+        return self.label_font.measure(text), self.label_height
+
+    @property
+    def offset_x(self):
+        # アイテムが現在配置されているオフセット（経度方向は周期の整数倍だけビューポートとずれうる）
+        return self.base_x + self.shift_x
+
+    @property
+    def offset_y(self):
+        return self.base_y + self.shift_y
+
+    def coverage(self):
+        # アイテムを置く範囲（キャンバス座標の x0, x1, y0, y1）
+        app = self.app
+        m = self.ITEM_MARGIN
+        return (self.shift_x - self.pad_x - m, self.shift_x + app.canvas_width + self.pad_x + m,
+                self.shift_y - self.pad_y - m, self.shift_y + app.canvas_height + self.pad_y + m)
+
+    def invalidate(self):
+        # 表示の方式が変わったとき。次の sync() で作り直す
+        self.zoom = None
+
+    def sync(self):
+        # ビューポートの変化をアイテムの移動で反映する。移動で足りず作り直した場合は True
+        vp = self.app.viewport
+        if vp.zoom != self.zoom:
+            return self.rebuild()
+        # 経度方向は一周ずらしても同じ見た目なので、移動量の最も小さい代表値を使う
+        shift_x = (vp.offset_x - self.base_x + self.period / 2) % self.period - self.period / 2
+        shift_y = vp.offset_y - self.base_y
+        if abs(shift_x) > self.pad_x or abs(shift_y) > self.pad_y:
+            return self.rebuild()
+        dx, dy = shift_x - self.shift_x, shift_y - self.shift_y
+        if dx or dy:
+            self.canvas.move("pan", dx, dy)
+            self.canvas.move("pan_x", dx, 0)
+            self.canvas.move("pan_y", 0, dy)
+            self.shift_x, self.shift_y = shift_x, shift_y
+        return False
+
+    def rebuild(self):
+        self.reset()
+        self.draw_grid()
+        self.rebuild_pins()
+        return True
+
+    def lon_to_x(self, lon):
+        # アイテム作成用：ビューポートの現在値ではなく、アイテムが現在配置されているオフセットを使う
+        app = self.app
+        return app.margin_left + (lon - LON_MIN) / (LON_MAX - LON_MIN) * self.period + self.offset_x
+
+    def lat_to_y(self, lat):
+        app = self.app
+        return app.margin_top + (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * self.full_height + self.offset_y
+
+    def copy_shifts(self, x0, x1):
+        # 横方向の範囲 [x0, x1] を周期の整数倍ずらしたコピーのうち、配置範囲に掛かるもののずらし量
+        x_lo, x_hi, _, _ = self.coverage()
+        first = math.ceil((x_lo - x1) / self.period)
+        last = math.floor((x_hi - x0) / self.period)
+        return [k * self.period for k in range(first, last + 1)]
+
+    def copies(self, x, y):
+        # 点 (x, y) の左右のコピーのうち、配置範囲に入るものの x 座標
+        _, _, y_lo, y_hi = self.coverage()
+        if not y_lo <= y <= y_hi:
+            return []
+        return [x + dx for dx in self.copy_shifts(x, x)]
+
+    def place_layer(self, layer, tag=None):
+        # layer に属するアイテム（tag 指定時はそのタグのもの）を、上位レイヤーの最下位アイテムの直下へ移動
+        for upper in self.LAYERS[self.LAYERS.index(layer) + 1:]:
+            if self.canvas.find_withtag(upper):
+                self.canvas.tag_lower(tag or layer, upper)
+                return
+
+    def world_range(self):
+        # 配置範囲を倍率1・オフセット 0 の座標で表したもの (x0, y0, x1, y1)
+        app = self.app
+        x_lo, x_hi, y_lo, y_hi = self.coverage()
+        return ((x_lo - app.margin_left - self.offset_x) / self.zoom, (y_lo - app.margin_top - self.offset_y) / self.zoom,
+                (x_hi - app.margin_left - self.offset_x) / self.zoom, (y_hi - app.margin_top - self.offset_y) / self.zoom)
+
+    def world_to_canvas(self, x, y):
+        app = self.app
+        return app.margin_left + x * self.zoom + self.offset_x, app.margin_top + y * self.zoom + self.offset_y
+
+    def pin_ids_in_range(self):
+        # 配置範囲に入るピンID。範囲が地図全体を覆う倍率では全ピン、それ以外はクリック判定用グリッドで絞る
+        app = self.app
+        x0, y0, x1, y1 = self.world_range()
+        if x1 - x0 >= app.eff_width and y0 <= 0 and y1 >= app.eff_height:
+            return app.pins.ids.tolist()
+        return sorted(app.hit_grid.query_box(x0, y0, x1, y1))
+
+    def cluster_level(self, visible):
+        # visible は配置範囲のピンの数
+        if not self.app.cluster_mode or visible < self.CLUSTER_MIN_PINS:
+            return None
+        return self.clusters.level_for(self.zoom)
+
+    def is_single(self, key):
+        # セルのピンを個々に描くか（1つだけ、またはクリックで分けたもの）
+        return len(self.clusters.levels[self.level][key][0]) == 1 or (self.level, key) in self.expanded
+
+    def layout_point(self, pin_id):
+        # ラベル配置用の座標（この倍率での地図上の px）と文字列
+        lat, lon = self.app.pins.lat_lon(pin_id)
+        return ((lon - LON_MIN) / (LON_MAX - LON_MIN) * self.period,
+                (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * self.full_height, self.app.pins.get(pin_id).name)
+
+    def rebuild_pins(self):
+        app = self.app
+        self.canvas.delete("pin")
+        self.pin_tags.clear()
+        self.cells = {}
+        pin_ids = self.pin_ids_in_range()
+        self.level = self.cluster_level(len(pin_ids))
+        if self.level is not None:
+            pin_ids = []
+            for key in self.clusters.cells_in(self.level, *self.world_range()):
+                if self.is_single(key):
+                    self.cells[key] = sorted(self.clusters.levels[self.level][key][0])
+                    pin_ids.extend(self.cells[key])
+                else:
+                    self.cells[key] = None
+        rows = app.pins.rows_of(pin_ids)
+        xs = (app.pins.lon[rows] - LON_MIN) / (LON_MAX - LON_MIN) * self.period
+        ys = (LAT_MAX - app.pins.lat[rows]) / (LAT_MAX - LAT_MIN) * self.full_height
+        self.labels.set_pins(pin_ids, xs.tolist(), ys.tolist(), [app.pins.get(pin_id).name for pin_id in pin_ids])
+        self.raster = len(pin_ids) >= self.RASTER_MIN_PINS
+        for pin_id in pin_ids:
+            # 重なり順の調整は最後にまとめて行う
+            self.draw_pin(pin_id, restack=False)
+        for key, content in self.cells.items():
+            if content is None:
+                self.draw_cluster(key, restack=False)
+        self.place_layer("pin")
+        self.draw_pin_raster()
+
+    def draw_pin_raster(self):
+        # 個々に描くピンのマーカーを1枚の画像に描いて置く（ピンレイヤーの最下位）
+        self.canvas.delete("pin_raster")
+        if not self.raster:
+            return
+        app = self.app
+        x_lo, x_hi, y_lo, y_hi = self.coverage()
+        x0, y0 = math.floor(x_lo), math.floor(y_lo)
+        width, height = math.ceil(x_hi) - x0, math.ceil(y_hi) - y0
+        points = self.labels.points.values()
+        xs = np.fromiter((p[0] for p in points), dtype=np.float64, count=len(points))
+        ys = np.fromiter((p[1] for p in points), dtype=np.float64, count=len(points))
+        xs += app.margin_left + self.offset_x - x0
+        ys = np.round(ys + app.margin_top + self.offset_y - y0).astype(np.int64)
+        alpha = np.zeros((height, width), dtype=np.uint8)
+        for shift in (self.copy_shifts(xs.min() + x0, xs.max() + x0) if len(xs) else ()):
+            cols = np.round(xs + shift).astype(np.int64)
+            for dx, dy in PIN_MARKER_PIXELS:
+                px, py = cols + dx, ys + dy
+                inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+                alpha[py[inside], px[inside]] = 255
+        img = Image.new("RGBA", (width, height), "black")
+        img.putalpha(Image.fromarray(alpha))
+        self.pin_photo = ImageTk.PhotoImage(img)
+        self.canvas.create_image(x0, y0, anchor="nw", image=self.pin_photo, tags=("pin", "pin_raster", "pan"))
+        self.place_layer("pin", "pin_raster")
+        self.canvas.tag_lower("pin_raster", "pin")
+
+    def clear_pins(self):
+        # ピンを丸ごと入れ替えるとき、古いアイテムとラベル配置・クラスタ索引を先に捨てる
+        self.canvas.delete("pin")
+        self.pin_tags.clear()
+        self.labels.set_pins([], [], [], [])
+        self.clusters.invalidate()
+        self.expanded.clear()
+        self.cells = {}
+
+    def cluster_tag(self, key):
+        return f"cluster:{key[0]},{key[1]}"
+
+    def draw_cluster(self, key, restack=True):
+        # 件数付きの丸をセル内のピンの重心に描く
+        count = len(self.clusters.levels[self.level][key][0])
+        x, y = self.world_to_canvas(*self.clusters.centroid(self.level, key))
+        r = 7 + 3 * len(str(count))
+        tag = self.cluster_tag(key)
+        for cx in self.copies(x, y):
+            self.canvas.create_oval(cx - r, y - r, cx + r, y + r, fill="steelblue", outline="white",
+                                    tags=("pin", "cluster", tag, "pan"))
+            self.canvas.create_text(cx, y, text=str(count), fill="white", tags=("pin", "cluster", tag, "pan"))
+        if restack:
+            self.place_layer("pin", tag)
+
+    def redraw_cells(self, positions):
+        # ピンが出入りしたセル（倍率1の座標 positions を含むもの）を描き直す
+        changed = set()
+        keys = {self.clusters.key(self.level, *position) for position in positions if position is not None}
+        for key in keys:
+            previous = self.cells.pop(key, None)
+            self.canvas.delete(self.cluster_tag(key))
+            for pin_id in previous or ():
+                tag = self.pin_tags.pop(pin_id, None)
+                if tag:
+                    self.canvas.delete(tag)
+                changed |= self.labels.discard(pin_id)
+            if key not in self.clusters.levels[self.level]:
+                continue
+            if self.is_single(key):
+                self.cells[key] = sorted(self.clusters.levels[self.level][key][0])
+                for pin_id in self.cells[key]:
+                    changed |= self.labels.put(pin_id, *self.layout_point(pin_id))
+            else:
+                self.cells[key] = None
+                self.draw_cluster(key)
+        self.redraw_pins(changed)
+
+    def cluster_at(self, x, y):
+        # キャンバス座標 (x, y) にあるクラスタの印のセル（なければ None）
+        if self.level is None:
+            return None
+        app = self.app
+        wx = (x - app.margin_left - self.offset_x) / self.zoom % app.eff_width
+        wy = (y - app.margin_top - self.offset_y) / self.zoom
+        col, row = self.clusters.key(self.level, wx, wy)
+        for key in ((col + dc, row + dr) for dc in (-1, 0, 1) for dr in (-1, 0, 1)):
+            if key not in self.cells or self.cells[key] is not None:
+                continue
+            cx, cy = self.clusters.centroid(self.level, key)
+            dx = abs(cx - wx) % app.eff_width
+            dx = min(dx, app.eff_width - dx) * self.zoom
+            r = 7 + 3 * len(str(len(self.clusters.levels[self.level][key][0])))
+            if dx * dx + ((cy - wy) * self.zoom) ** 2 <= r * r:
+                return key
+        return None
+
+    def expand_cluster(self, key):
+        # クリックしたクラスタを、ピンの広がりが画面の半分ほどになる倍率まで拡大して分ける。
+        # これ以上拡大できない（同じ地点に重なっている）ときは、その場で個々のピンを出す
+        app = self.app
+        vp = app.viewport
+        members = self.clusters.levels[self.level][key][0]
+        xs = [self.clusters.positions[pin_id][0] for pin_id in members]
+        ys = [self.clusters.positions[pin_id][1] for pin_id in members]
+        spread = max((max(xs) - min(xs)) / app.eff_width, (max(ys) - min(ys)) / app.eff_height, 1e-9)
+        zoom = min(vp.ZOOM_MAX, max(vp.zoom * 2, 0.5 / spread))
+        if vp.zoom >= vp.ZOOM_MAX or self.clusters.level_for(zoom) == self.level:
+            self.expanded.add((self.level, key))
+            self.redraw_cells([self.clusters.centroid(self.level, key)])
+            return False
+        vp.center_on((max(xs) + min(xs)) / 2, (max(ys) + min(ys)) / 2, zoom)
+        return True
+
+    def draw_background(self):
+        app = self.app
+        self.canvas.delete("bg")
+        # 背景画像が未設定の場合のみ、グレーの背景を描画
+        if not app.bg_image_original:
+            self.canvas.create_rectangle(app.margin_left, app.margin_top,
+                                         app.margin_left + app.eff_width, app.margin_top + app.eff_height,
+                                         fill="#e0e0e0", outline="", tags="bg")
+        elif self.zoom == 1:
+            # 背景画像が設定されている場合は、その画像を描画（透明度も反映）
+            app.update_bg_image_with_alpha()
+            x = app.margin_left + self.offset_x
+            for dx in self.copy_shifts(x, x + app.eff_width):
+                self.canvas.create_image(x + dx, app.margin_top,
+                                         anchor="nw", image=app.bg_image, tags=("bg", "pan"))
+        else:
+            # 拡大時は配置範囲に入る部分だけを、その倍率に合う段のタイルから切り出す
+            x_lo, x_hi, y_lo, y_hi = self.coverage()
+            top = app.margin_top + self.offset_y
+            x0 = math.floor(x_lo)
+            y0 = math.floor(max(y_lo, top))
+            y1 = math.ceil(min(y_hi, top + self.full_height))
+            key = (app.bg_image_original, self.zoom, x0 - app.margin_left - self.offset_x, y0 - top,
+                   math.ceil(x_hi) - x0, y1 - y0)
+            if self.bg_source is None or self.bg_source[0] != key:
+                self.bg_source = (key, app.read_bg_window(*key[1:]))
+            img = self.bg_source[1].convert("RGBA")
+            img.putalpha(app.bg_alpha_level())
+            self.bg_photo = ImageTk.PhotoImage(img)
+            self.canvas.create_image(x0, y0, anchor="nw", image=self.bg_photo, tags=("bg", "pan"))
+        self.canvas.tag_lower("bg")
+
+    def grid_step(self, pixels_per_degree):
+        # 間隔が GRID_SPACING 以上になる最も細かい刻み（倍率が低いほど粗くなる）
+        step = self.GRID_STEPS[0]
+        for candidate in self.GRID_STEPS[1:]:
+            if candidate * pixels_per_degree < self.GRID_SPACING:
+                break
+            step = candidate
+        return step
+
+    def draw_grid(self):
+        app = self.app
+        self.canvas.delete("grid")
+        x_lo, x_hi, y_lo, y_hi = self.coverage()
+        # 経線は横方向だけ、緯線は縦方向だけパンに合わせて動かす
+        px_per_lon = self.period / (LON_MAX - LON_MIN)
+        step = self.grid_step(px_per_lon)
+        lon0 = LON_MIN + (x_lo - app.margin_left - self.offset_x) / px_per_lon
+        lon1 = LON_MIN + (x_hi - app.margin_left - self.offset_x) / px_per_lon
+        for i in range(math.ceil(lon0 / step), math.floor(lon1 / step) + 1):
+            lon = i * step
+            x = self.lon_to_x(lon)
+            label = LON_MAX - (LON_MAX - lon) % (LON_MAX - LON_MIN)  # 一周ずれたコピーも -180～180 の表記に
+            self.canvas.create_line(x, app.margin_top, x, app.margin_top + app.eff_height,
+                                    fill="gray", tags=("grid", "pan_x"))
+            self.canvas.create_text(x, app.margin_top - 15, text=f"{label:g}°", fill="gray",
+                                    tags=("grid", "pan_x"))
+
+        px_per_lat = self.full_height / (LAT_MAX - LAT_MIN)
+        step = self.grid_step(px_per_lat)
+        lat0 = max(LAT_MIN, LAT_MAX - (y_hi - app.margin_top - self.offset_y) / px_per_lat)
+        lat1 = min(LAT_MAX, LAT_MAX - (y_lo - app.margin_top - self.offset_y) / px_per_lat)
+        for i in range(math.ceil(lat0 / step), math.floor(lat1 / step) + 1):
+            lat = i * step
+            y = self.lat_to_y(lat)
+            line_color = "rosybrown" if i == 0 else "gray"
+            self.canvas.create_line(app.margin_left, y, app.margin_left + app.eff_width, y,
+                                    fill=line_color, tags=("grid", "pan_y"))
+            self.canvas.create_text(app.margin_left - 20, y, text=f"{lat:g}°", fill="gray",
+                                    tags=("grid", "pan_y"))
+        self.place_layer("grid")
+
+    def draw_pin(self, pin_id, restack=True):
+        app = self.app
+        tag = f"pin:{pin_id}"
+        self.pin_tags[pin_id] = tag
+        pin = app.pins.get(pin_id)
+        lat, lon = app.pins.lat_lon(pin_id)
+        y = self.lat_to_y(lat)
+        label = self.labels.label(pin_id)
+        # 配置範囲に入る左右のコピーにだけ描画（画像にまとめているときはラベルだけ）
+        for x in self.copies(self.lon_to_x(lon), y):
+            if not self.raster:
+                pts = [x - 3, y - 4, x + 3, y - 4, x, y]
+                self.canvas.create_polygon(pts, fill="black", outline="black", tags=("pin", tag, "pan"))
+            if label:
+                anchor, dx, dy = label
+                self.canvas.create_text(x + dx, y + dy, text=pin.name, fill=pin.color,
+                                        tags=("pin", tag, "pan"), anchor=anchor)
+        if restack:
+            self.place_layer("pin", tag)
+
+    def redraw_pins(self, pin_ids):
+        # ラベルの置き方が変わったピンのアイテムだけを作り直す（個々に描いているピンのみ）
+        for pin_id in pin_ids:
+            if pin_id not in self.labels.points:
+                continue
+            tag = self.pin_tags.get(pin_id)
+            if tag:
+                self.canvas.delete(tag)
+            self.draw_pin(pin_id)
+
+    def add_pin(self, pin_id):
+        position = self.clusters.add(pin_id)
+        if self.level is None:
+            self.redraw_pins(self.labels.put(pin_id, *self.layout_point(pin_id)))
+        else:
+            self.redraw_cells([position])
+        self.markers_changed()
+
+    def remove_pin(self, pin_id):
+        position = self.clusters.remove(pin_id)
+        tag = self.pin_tags.pop(pin_id, None)
+        if tag:
+            self.canvas.delete(tag)
+        if self.level is None:
+            self.redraw_pins(self.labels.discard(pin_id))
+        else:
+            self.redraw_cells([position])
+        self.markers_changed()
+
+    def markers_changed(self):
+        # マーカーを画像にまとめているときは、次の描画でまとめて描き直す
+        if self.raster:
+            self.app.request_redraw("pin_raster")
+
+    def update_pin(self, pin_id):
+        # 移動・名前の変更とも、周囲のラベル（クラスタ表示では出入りのあったセル）だけを描き直す
+        old = self.clusters.remove(pin_id)
+        new = self.clusters.add(pin_id)
+        if self.level is None:
+            self.redraw_pins(self.labels.put(pin_id, *self.layout_point(pin_id)))
+        else:
+            self.redraw_cells([old, new])
+        self.markers_changed()
+
+    def refresh_labels(self, pin_ids):
+        # 選択の切り替えなどでラベルの優先度が変わったとき
+        self.redraw_pins(self.labels.refresh(pin_ids))
+
+    def set_preview(self, lat, lon):
+        self.canvas.delete("preview_pin")
+        # キャンバス表示時の変換関数をそのまま使用
+        y = self.lat_to_y(lat)
+        for x in self.copies(self.lon_to_x(lon), y):
+            pts = [x - 3, y - 4, x + 3, y - 4, x, y]
+            self.canvas.create_polygon(pts, fill="red", outline="red", tags=("preview_pin", "pan"))
+        self.place_layer("preview_pin")
+
+    def clear_preview(self):
+        self.canvas.delete("preview_pin")
+
+    def set_highlights(self, pin_ids):
+        # 近傍検索の結果などを丸で囲んで強調表示
+        app = self.app
+        self.canvas.delete("highlight")
+        for pin_id in pin_ids:
+            lat, lon = app.pins.lat_lon(pin_id)
+            y = self.lat_to_y(lat) - 2
+            for x in self.copies(self.lon_to_x(lon), y):
+                self.canvas.create_oval(x - 7, y - 7, x + 7, y + 7, outline="orange", width=2,
+                                        tags=("highlight", "pan"))
+        self.place_layer("highlight")
+
+    def set_search_marks(self, pin_ids):
+        # 検索語に一致したピンを四角で囲む
+        app = self.app
+        self.canvas.delete("search")
+        for pin_id in pin_ids:
+            lat, lon = app.pins.lat_lon(pin_id)
+            y = self.lat_to_y(lat) - 2
+            for x in self.copies(self.lon_to_x(lon), y):
+                self.canvas.create_rectangle(x - 6, y - 6, x + 6, y + 6, outline="magenta", width=2,
+                                             tags=("search", "pan"))
+        self.place_layer("search")
+
+    def set_routes(self, xs, ys):
+        # xs, ys: 現在のオフセットで求めた中央コピーの座標（航路数 × 補間点数の配列）
+        self.canvas.delete("route")
+        if not len(xs):
+            return
+        # 外接矩形が配置範囲に掛からない航路は作らない
+        x_lo, x_hi, y_lo, y_hi = self.coverage()
+        row_x0, row_x1 = xs.min(axis=1), xs.max(axis=1)
+        rows = (ys.max(axis=1) >= y_lo) & (ys.min(axis=1) <= y_hi)
+        for dx in self.copy_shifts(row_x0.min(), row_x1.max()):
+            keep = rows & (row_x1 + dx >= x_lo) & (row_x0 + dx <= x_hi)
+            if not keep.any():
+                continue
+            for line in np.stack([xs[keep] + dx, ys[keep]], axis=-1).reshape(int(keep.sum()), -1).tolist():
+                self.canvas.create_line(line, fill="blue", dash=(4, 4), tags=("route", "pan"))
+
+# --- ピンのクリック判定用グリッド ---
+# 倍率1・オフセット 0 のときの画面座標（マージン除く）でピンを一定サイズのセルに振り分けておき、
+# クリック位置の周囲のセルだけを調べる。パン・拡大はクリック位置側をビューポートで逆変換して吸収する。
+# 拡大表示で配置範囲に入るピンを集めるときにも使う。
+class PinHitGrid:
+    CELL = 16  # セルの大きさ（px）。判定半径より大きくしておく
+
+    def __init__(self, store, width, height):
+        self.store = store
+        self.width = width
+        self.height = height
+        self.cols = max(1, math.ceil(width / self.CELL))
+        self.cells = {}    # (列, 行) -> ピンIDの集合
+        self.entries = {}  # ピンID -> (セル, x, y)
+
+    def project(self, lat, lon):
+        x = (lon - LON_MIN) / (LON_MAX - LON_MIN) * self.width % self.width
+        y = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * self.height
+        return x, y
+
+    def cell_of(self, x, y):
+        return (int(x // self.CELL) % self.cols, int(y // self.CELL))
+
+    def insert(self, pin_id, x, y):
+        cell = self.cell_of(x, y)
+        self.cells.setdefault(cell, set()).add(pin_id)
+        self.entries[pin_id] = (cell, x, y)
+
+    def add(self, pin_id):
+        self.insert(pin_id, *self.project(*self.store.lat_lon(pin_id)))
+
+    def remove(self, pin_id):
+        entry = self.entries.pop(pin_id, None)
+        if entry:
+            bucket = self.cells[entry[0]]
+            bucket.discard(pin_id)
+            if not bucket:
+                del self.cells[entry[0]]
+
+    def update(self, pin_id):
+        self.remove(pin_id)
+        self.add(pin_id)
+
+    def rebuild(self):
+        self.cells.clear()
+        self.entries.clear()
+        xs, ys = self.project(self.store.lat, self.store.lon)
+        for pin_id, x, y in zip(self.store.ids.tolist(), xs.tolist(), ys.tolist()):
+            self.insert(pin_id, x, y)
+
+    def query(self, x, y, radius=10):
+        # (x, y) から radius 未満のピンIDを、距離・名前・登録順の優先順で返す
+        x %= self.width
+        col, row = self.cell_of(x, y)
+        reach = math.ceil(radius / self.CELL)
+        hits = {}
+        for c in range(col - reach, col + reach + 1):
+            for r in range(row - reach, row + reach + 1):
+                # 列数が少ない場合に同じセルを複数回調べることがあるため dict で重複を除く
+                for pin_id in self.cells.get((c % self.cols, r), ()):
+                    _, px, py = self.entries[pin_id]
+                    dx = abs(x - px)
+                    dx = min(dx, self.width - dx)  # 左右のタイルを跨いだ距離
+                    d2 = dx * dx + (y - py) ** 2
+                    if d2 < radius * radius:
+                        hits[pin_id] = (d2, self.store.get(pin_id).name, pin_id)
+        return [hit[2] for hit in sorted(hits.values())]
+
+    def query_box(self, x0, y0, x1, y1):
+        # 矩形（横方向は周期的に扱う）に掛かるセルのピンIDの集合。セル単位なので矩形の少し外も含む
+        c0, c1 = math.floor(x0 / self.CELL), math.floor(x1 / self.CELL)
+        r0, r1 = max(0, math.floor(y0 / self.CELL)), math.floor(y1 / self.CELL)
+        if c1 - c0 + 1 >= self.cols:
+            c0, c1 = 0, self.cols - 1
+        found = set()
+        if (c1 - c0 + 1) * (r1 - r0 + 1) > len(self.cells):
+            # 矩形のセル数より空でないセルの方が少なければ、そちらを走査する
+            cols = {c % self.cols for c in range(c0, c1 + 1)}
+            for (c, r), bucket in self.cells.items():
+                if c in cols and r0 <= r <= r1:
+                    found.update(bucket)
+        else:
+            for c in range(c0, c1 + 1):
+                for r in range(r0, r1 + 1):
+                    found.update(self.cells.get((c % self.cols, r), ()))
+        return found
+
+# --- ピンのクラスタ索引 ---
+# 倍率1・オフセット 0 の座標で、段ごとに大きさが半分になる格子（段 k のセルは CELL / 2**k px）にピンを振り分け、
+# セルごとにピンIDの集合と座標の和を持つ。表示倍率に合う段のセルを、ピンが2つ以上あれば件数付きの1つの印として描く。
+# 段は初めて使うときに作り、作った段はピンの追加・移動・削除のたびに該当セルだけを直す。
+class PinClusterIndex:
+    CELL = 64   # 段 0 のセルの大きさ（px）。画面上ではどの倍率でも 64～128px になる
+    LEVELS = 7  # 最大倍率 64 で段 6（セル 1px）
+
+    def __init__(self, store, width, height):
+        self.store = store
+        self.width = width
+        self.height = height
+        self.positions = None               # ピンID -> (x, y)。最初に段を作るときに作る
+        self.levels = [None] * self.LEVELS  # 段 -> {セル: [ピンIDの集合, x の和, y の和]}
+
+    def invalidate(self):
+        # ピンを丸ごと入れ替えたとき。次に使うときに作り直す
+        self.positions = None
+        self.levels = [None] * self.LEVELS
+
+    def project(self, lat, lon):
+        x = (lon - LON_MIN) / (LON_MAX - LON_MIN) * self.width % self.width
+        y = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * self.height
+        return x, y
+
+    def level_for(self, zoom):
+        return min(self.LEVELS - 1, max(0, math.floor(math.log2(zoom))))
+
+    def cell_size(self, level):
+        return self.CELL / 2 ** level
+
+    def key(self, level, x, y):
+        size = self.cell_size(level)
+        return (int(x // size), int(y // size))
+
+    def ensure(self, level):
+        if self.positions is None:
+            xs, ys = self.project(self.store.lat, self.store.lon)
+            self.positions = dict(zip(self.store.ids.tolist(), zip(xs.tolist(), ys.tolist())))
+        if self.levels[level] is None:
+            cells = {}
+            size = self.cell_size(level)
+            for pin_id, (x, y) in self.positions.items():
+                entry = cells.get((int(x // size), int(y // size)))
+                if entry is None:
+                    cells[(int(x // size), int(y // size))] = [{pin_id}, x, y]
+                else:
+                    entry[0].add(pin_id)
+                    entry[1] += x
+                    entry[2] += y
+            self.levels[level] = cells
+        return self.levels[level]
+
+    def add(self, pin_id):
+        # 追加した位置を返す（索引を作っていなければ None）
+        if self.positions is None:
+            return None
+        x, y = self.project(*self.store.lat_lon(pin_id))
+        self.positions[pin_id] = (x, y)
+        for level, cells in enumerate(self.levels):
+            if cells is not None:
+                entry = cells.setdefault(self.key(level, x, y), [set(), 0.0, 0.0])
+                entry[0].add(pin_id)
+                entry[1] += x
+                entry[2] += y
+        return x, y
+
+    def remove(self, pin_id):
+        # 取り除いたピンのあった位置を返す
+        if self.positions is None:
+            return None
+        position = self.positions.pop(pin_id, None)
+        if position is None:
+            return None
+        x, y = position
+        for level, cells in enumerate(self.levels):
+            if cells is not None:
+                key = self.key(level, x, y)
+                entry = cells[key]
+                entry[0].discard(pin_id)
+                if entry[0]:
+                    entry[1] -= x
+                    entry[2] -= y
+                else:
+                    del cells[key]
+        return position
+
+    def centroid(self, level, key):
+        members, sx, sy = self.levels[level][key]
+        return sx / len(members), sy / len(members)
+
+    def cells_in(self, level, x0, y0, x1, y1):
+        # 矩形（横方向は周期的に扱う）に掛かる空でないセル
+        cells = self.ensure(level)
+        size = self.cell_size(level)
+        cols = math.ceil(self.width / size)
+        c0, c1 = math.floor(x0 / size), math.floor(x1 / size)
+        r0, r1 = max(0, math.floor(y0 / size)), math.floor(y1 / size)
+        if c1 - c0 + 1 >= cols:
+            c0, c1 = 0, cols - 1
+        if (c1 - c0 + 1) * (r1 - r0 + 1) > len(cells):
+            wanted = {c % cols for c in range(c0, c1 + 1)}
+            return [key for key in cells if key[0] in wanted and r0 <= key[1] <= r1]
+        keys = {(c % cols, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)}
+        return [key for key in keys if key in cells]
+
+# --- 球面上の近傍検索 ---
+# ピンを単位球上の3次元ベクトルにして KD 木（scipy の cKDTree）に登録し、
+# 「近い順 k 件」「半径 R km 以内」を全ピンの距離計算なしで求める。
+# 球面上の距離と3次元の直線距離（弦の長さ）は単調に対応するので、木の探索結果をそのまま使える。
+class PinSphereIndex:
+    def __init__(self, store):
+        self.store = store
+        self.ids = np.empty(0, dtype=np.int64)
+        self.tree = None
+        self.geo_version = None  # 木を作ったときの store.geo_version
+
+    def ensure(self):
+        # ピンの追加・移動・削除後、最初の検索時にだけ作り直す
+        if self.geo_version == self.store.geo_version:
+            return
+        from scipy.spatial import cKDTree
+        self.ids = self.store.ids.copy()
+        if len(self.ids):
+            self.tree = cKDTree(lat_lon_to_xyz(np.radians(self.store.lat), np.radians(self.store.lon)))
+        else:
+            self.tree = None
+        self.geo_version = self.store.geo_version
+
+    def nearest(self, lat, lon, k, radius, exclude=None):
+        # (lat, lon) に近い順に最大 k 件の (ピンID, 距離km) を返す
+        self.ensure()
+        if self.tree is None or k <= 0:
+            return []
+        count = min(k + (1 if exclude is not None else 0), len(self.ids))
+        chord, idx = self.tree.query(lat_lon_to_xyz(math.radians(lat), math.radians(lon)), k=count)
+        results = [(int(self.ids[i]), chord_to_km(d, radius))
+                   for d, i in zip(np.atleast_1d(chord), np.atleast_1d(idx))
+                   if self.ids[i] != exclude]
+        return results[:k]
+
+    def within(self, lat, lon, distance_km, radius, exclude=None):
+        # (lat, lon) から distance_km 以内の (ピンID, 距離km) を近い順に返す
+        self.ensure()
+        if self.tree is None or distance_km < 0:
+            return []
+        center = lat_lon_to_xyz(math.radians(lat), math.radians(lon))
+        angle = min(distance_km / radius, math.pi)
+        idx = self.tree.query_ball_point(center, 2 * math.sin(angle / 2) + 1e-12)
+        if not idx:
+            return []
+        chord = np.linalg.norm(self.tree.data[idx] - center, axis=1)
+        order = np.argsort(chord, kind="stable")
+        return [(int(self.ids[idx[j]]), chord_to_km(chord[j], radius))
+                for j in order if self.ids[idx[j]] != exclude]
+
+def lat_lon_to_xyz(lat, lon):
+    # 緯度経度（ラジアン）を単位球上の3次元ベクトルに変換
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+def chord_to_km(chord, radius):
+    # 弦の長さを球面上の距離（km）に変換
+    return float(2 * math.asin(min(chord / 2, 1.0)) * radius)
+
+def haversine_km(lat1, lon1, lats2, lons2, radius):
+    # (lat1, lon1) から各点までの球面距離（km）を一括計算（haversine 公式）
+    lat1, lon1 = math.radians(lat1), math.radians(lon1)
+    lats2, lons2 = np.radians(lats2), np.radians(lons2)
+    a = np.sin((lats2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lats2) * np.sin((lons2 - lon1) / 2) ** 2
+    return radius * 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+# --- 名前・備考の検索索引 ---
+# 名前と備考を正規化（NFKC・大文字小文字を区別しない）した文字列の 1 文字／2 文字 n-gram から
+# ピンIDの集合を引く転置索引。検索語の n-gram の集合を小さい順に積集合し、残った候補だけを部分一致で確かめる。
+# 入力を打ち足した場合は直前の結果とも積集合を取る。読み込み時にワーカースレッドで（ピンの行番号をキーにして）作り、
+# 以後はピンの追加・変更・削除で更新する。キーは「ピンID - base」で、読み込んだピンの ID は base + 行番号になる。
+class PinSearchIndex:
+    def __init__(self, store):
+        self.store = store
+        self.base = 0
+        self.texts = {}     # キー -> 正規化した「名前\n備考」
+        self.postings = {}  # n-gram -> キーの集合
+        self.version = 0    # 索引が変わるたびに増える
+        self.last = None    # 直前の (検索語, version, 一致したキーの集合)
+
+    @staticmethod
+    def normalize(text):
+        return unicodedata.normalize("NFKC", text).casefold()
+
+    @staticmethod
+    def grams(text):
+        return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+    @classmethod
+    def build_entries(cls, names, remarks):
+        # 名前・備考の列から (行番号 -> 正規化した文字列, n-gram -> 行番号の集合) を作る（読み込みのワーカースレッドで呼ぶ）
+        texts = {}
+        postings = {}
+        for row, (name, remark) in enumerate(zip(names, remarks)):
+            text = texts[row] = cls.normalize(name + "\n" + remark)
+            for gram in cls.grams(text):
+                postings.setdefault(gram, set()).add(row)
+        return texts, postings
+
+    def adopt(self, entries, base):
+        # ピンを丸ごと入れ替えたとき。build_entries() の結果を、行番号 0 のピンの ID を base として使う
+        self.texts, self.postings = entries
+        self.base = base
+        self.version += 1
+        self.last = None
+
+    def add(self, pin_id):
+        pin = self.store.get(pin_id)
+        text = self.normalize(pin.name + "\n" + pin.remark)
+        key = pin_id - self.base
+        self.texts[key] = text
+        for gram in self.grams(text):
+            self.postings.setdefault(gram, set()).add(key)
+        self.version += 1
+
+    def remove(self, pin_id):
+        key = pin_id - self.base
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for gram in self.grams(text):
+            bucket = self.postings[gram]
+            bucket.discard(key)
+            if not bucket:
+                del self.postings[gram]
+        self.version += 1
+
+    def update(self, pin_id):
+        self.remove(pin_id)
+        self.add(pin_id)
+
+    def search(self, query):
+        # query を名前か備考に含むピンIDの配列（query が空なら None）
+        query = self.normalize(query).strip()
+        if not query:
+            return None
+        if len(query) == 1:
+            keys = [query]
+        else:
+            keys = {query[i:i + 2] for i in range(len(query) - 1)}
+        sets = [self.postings.get(key, set()) for key in keys]
+        last = self.last
+        if last is not None and last[1] == self.version and last[0] in query:
+            sets.append(last[2])
+        sets.sort(key=len)
+        hits = sets[0].intersection(*sets[1:])
+        if len(query) > 2:
+            hits = {key for key in hits if query in self.texts[key]}
+        self.last = (query, self.version, hits)
+        return np.fromiter(hits, dtype=np.int64, count=len(hits)) + self.base
+
+# --- 再描画スケジューラ ---
+# 各処理は「どの領域を描き直す必要があるか」を request() で印を付けるだけにし、
+# 実際の描画は after_idle（前回から MIN_INTERVAL_MS 未満なら after）で1回にまとめて行う。
+# スライダーと変数トレースが同時に発火しても、描画は1フレームにつき1回になる。
+class RedrawScheduler:
+    # 描画する順番
+    REGIONS = ("background", "pins", "pin_raster", "routes", "highlight", "search", "list", "preview")
+    MIN_INTERVAL_MS = 16  # 約60fps
+
+    def __init__(self, root, handlers, before_flush=None, after_flush=None):
+        self.root = root
+        self.handlers = handlers          # 領域名 -> 描画関数
+        self.before_flush = before_flush  # 毎回の描画前に呼ぶ関数（表示範囲の同期など）。追加で描き直す領域を返せる
+        self.after_flush = after_flush
+        self.dirty = set()
+        self.pending = None
+        self.last_flush = 0.0
+        self.requested = 0   # 受け付けた再描画要求の数
+        self.flushes = 0     # 実際に行った描画の回数
+        self.coalesced = 0   # 既に予約済みの描画にまとめられた要求の数
+
+    def request(self, *regions):
+        self.requested += 1
+        self.dirty.update(regions)
+        if self.pending is not None:
+            self.coalesced += 1
+            return
+        wait = self.MIN_INTERVAL_MS - (time.perf_counter() - self.last_flush) * 1000
+        if wait > 0:
+            self.pending = self.root.after(int(wait) + 1, self.flush)
+        else:
+            self.pending = self.root.after_idle(self.flush)
+
+    def flush(self):
+        if self.pending is not None:
+            self.root.after_cancel(self.pending)
+            self.pending = None
+        dirty, self.dirty = self.dirty, set()
+        self.last_flush = time.perf_counter()
+        self.flushes += 1
+        if self.before_flush:
+            dirty.update(self.before_flush() or ())
+        for region in self.REGIONS:
+            if region in dirty:
+                self.handlers[region]()
+        if self.after_flush:
+            self.after_flush()
+
+# --- 仮想化ピン一覧 ---
+# Listbox には見えている行だけを入れ、スクロール位置に合わせて入れ替える。
+# 行の文字列は表示する行の分だけ format_row(ピンID) で作るので、ピンが何件あっても
+# 一覧の更新・スクロール・クリックにかかる時間は表示行数で決まる。選択はピンIDで保持する。
+class VirtualPinList:
+    def __init__(self, master, rows, font, on_select):
+        self.rows = rows
+        self.on_select = on_select
+        self.ids = []            # 一覧に並べるピンID（表示順）
+        self.format_row = None   # ピンID -> 行の文字列
+        self.positions = None    # ピンID -> 行番号（必要になったときに作る）
+        self.top = 0             # 先頭に表示している行番号
+        self.selected_id = None
+        self.frame = ttk.Frame(master)
+        self.listbox = tk.Listbox(self.frame, height=rows, font=font, exportselection=False)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.listbox.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.bind("<<ListboxSelect>>", self.on_click)
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll_by(-3 if e.delta > 0 else 3))
+        self.listbox.bind("<Button-4>", lambda e: self.scroll_by(-3))
+        self.listbox.bind("<Button-5>", lambda e: self.scroll_by(3))
+        self.listbox.bind("<Up>", lambda e: self.step(-1))
+        self.listbox.bind("<Down>", lambda e: self.step(1))
+        self.listbox.bind("<Prior>", lambda e: self.scroll_by(-self.rows))
+        self.listbox.bind("<Next>", lambda e: self.scroll_by(self.rows))
+
+    def pack(self, **kw):
+        self.frame.pack(**kw)
+
+    def set_rows(self, ids, format_row, selected_id=None):
+        self.ids = ids
+        self.format_row = format_row
+        self.positions = None
+        self.top = self.clamp(self.top)
+        if selected_id is not None and selected_id != self.selected_id:
+            # 一覧以外（キャンバスなど）で選択されたときは、その行までスクロール
+            self.see(selected_id)
+        self.selected_id = selected_id
+        self.render()
+
+    def position_of(self, pin_id):
+        if self.positions is None:
+            self.positions = {pid: i for i, pid in enumerate(self.ids)}
+        return self.positions.get(pin_id)
+
+    def clamp(self, top):
+        return max(0, min(top, len(self.ids) - self.rows))
+
+    def see(self, pin_id):
+        # 指定したピンの行が見える位置までスクロール
+        index = self.position_of(pin_id)
+        if index is not None and not self.top <= index < self.top + self.rows:
+            self.top = self.clamp(index - self.rows // 2)
+
+    def render(self):
+        visible = self.ids[self.top:self.top + self.rows]
+        self.listbox.delete(0, tk.END)
+        if visible:
+            self.listbox.insert(tk.END, *[self.format_row(pin_id) for pin_id in visible])
+        if self.selected_id in visible:
+            self.listbox.selection_set(visible.index(self.selected_id))
+        total = len(self.ids)
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll_to(self, top):
+        top = self.clamp(top)
+        if top != self.top:
+            self.top = top
+            self.render()
+        return "break"
+
+    def scroll_by(self, delta):
+        return self.scroll_to(self.top + delta)
+
+    def on_scroll(self, action, amount, unit=None):
+        # スクロールバーからの "moveto" / "scroll" 指令
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * len(self.ids)))
+        elif unit == "pages":
+            self.scroll_by(int(amount) * self.rows)
+        else:
+            self.scroll_by(int(amount))
+
+    def on_click(self, event):
+        if not self.listbox.curselection():
+            return
+        index = self.top + self.listbox.curselection()[0]
+        if index < len(self.ids):
+            self.selected_id = self.ids[index]
+            self.on_select(self.selected_id)
+
+    def step(self, delta):
+        # キー操作で前後の行へ選択を移す（表示範囲外へもスクロールして追従）
+        if not self.ids:
+            return "break"
+        index = self.position_of(self.selected_id)
+        index = 0 if index is None else max(0, min(index + delta, len(self.ids) - 1))
+        self.selected_id = self.ids[index]
+        self.see(self.selected_id)
+        self.render()
+        self.on_select(self.selected_id)
+        return "break"
+
 # --- メインアプリ ---
 class MapMakerApp:
     def __init__(self, root):
@@ -58,25 +1128,56 @@ class MapMakerApp:
         self.eff_width = self.canvas_width - self.margin_left - self.margin_right
         self.eff_height = self.canvas_height - self.margin_top - self.margin_bottom
 
-        self.offset_x = 0
-        self.pins = []  # 各ピン: {"lat", "lon", "name", "remark", "color", marker_id, text_id}
+        self.viewport = Viewport(self.margin_left, self.margin_top, self.eff_width, self.eff_height)
+        self.pins = PinStore()  # 全ピン（ID で参照する）
+        self.journal = PinJournal()  # 保存済みのマップフォルダとの差分
+        self.settings_dirty = False
+        self.route_cache = RouteCache()  # 大圏航路の計算結果キャッシュ
         self.current_file = ""
-        self.editing_pin = None
+        self.editing_pin_id = None
         self.editing_mode = False
         self.resolution_multiplier = 1
 
         # 背景画像関連
         self.bg_image_original = None  # PIL Image（透明度未適用）
         self.bg_image = None           # ImageTk.PhotoImage（透明度適用済み）
+        self.bg_image_key = None       # bg_image の生成元 (元画像, 8bit透明度)
+        self.bg_pyramid = None         # 背景画像のタイルピラミッド（TilePyramid）
+
+        # 起動時間の内訳 [(項目, 秒)]。ピンと背景は表示後にワーカースレッドで読み込む
+        self.startup_times = [("インポート", IMPORT_SECONDS)]
+        self.startup_mark = time.perf_counter()
+        self.first_paint_pending = True
 
         # フォント設定
         self.font = self.load_font()
+        self.mark_startup("フォント")
         self.create_widgets()
-        self.load_state()  # STATE_FILEから状態読み込み（任意）
-        self.load_bg_image_from_folder()
+        self.mark_startup("画面")
+        folder = self.load_state()  # STATE_FILEから状態読み込み（任意）
+        self.mark_startup("状態")
+        if folder:
+            # 読み込み終わるまではグリッドだけのキャンバスに「読み込み中」を表示
+            self.canvas.create_text(self.canvas_width / 2, self.canvas_height / 2, text="マップを読み込み中…",
+                                    fill="gray", font=("Meiryo", 16), tags="placeholder")
+            pins_started = time.perf_counter()
+            self.start_pin_load(folder, with_background=False,
+                                on_loaded=lambda: self.mark_startup("ピン", time.perf_counter() - pins_started))
+        self.load_bg_image_async(on_loaded=lambda seconds: self.mark_startup("背景", seconds))
         self.draw_map()
         self.drag_start = None
 
+    def mark_startup(self, label, seconds=None):
+        # 直前の計測点からの経過時間（seconds を渡した場合はその値）を内訳に加える
+        now = time.perf_counter()
+        if seconds is None:
+            seconds = now - self.startup_mark
+            self.startup_mark = now
+        self.startup_times.append((label, seconds))
+        if hasattr(self, "startup_label"):
+            self.startup_label.config(
+                text="起動: " + " / ".join(f"{name} {sec * 1000:.0f}ms" for name, sec in self.startup_times))
+
     def load_font(self):
         try:
             return ImageFont.truetype(DEFAULT_FONT_PATH, 16)
@@ -98,6 +1199,11 @@ class MapMakerApp:
         self.map_name_entry = ttk.Entry(top_frame, width=15)
         self.map_name_entry.pack(side=tk.LEFT)
         self.map_name_entry.insert(0, "my_map")
+        # ピンの保存形式（SQLite は大きなカタログ向け）
+        ttk.Label(top_frame, text="保存形式:").pack(side=tk.LEFT, padx=5)
+        self.storage_var = tk.StringVar(value=STORAGE_OPTIONS[0])
+        ttk.Combobox(top_frame, textvariable=self.storage_var, values=STORAGE_OPTIONS,
+                     width=7, state="readonly").pack(side=tk.LEFT)
 
         # 解像度選択コンボボックス
         ttk.Label(top_frame, text="出力解像度:").pack(side=tk.LEFT, padx=5)
@@ -106,13 +1212,32 @@ class MapMakerApp:
         self.resolution_combo.pack(side=tk.LEFT, padx=5)
         self.resolution_combo.bind("<<ComboboxSelected>>", self.on_resolution_change)
 
-        ttk.Button(top_frame, text="画像生成", command=self.export_image).pack(side=tk.LEFT, padx=5)
+        self.export_button = ttk.Button(top_frame, text="画像生成", command=self.export_image)
+        self.export_button.pack(side=tk.LEFT, padx=5)
+        self.tiles_button = ttk.Button(top_frame, text="タイル生成", command=self.export_tiles)
+        self.tiles_button.pack(side=tk.LEFT, padx=5)
+        # 書き出し中だけ表示する進み具合と中止ボタン
+        self.export_cancel = None  # 書き出し中の中止フラグ（threading.Event）
+        self.export_queue = None
+        self.close_after_export = False  # 書き出しの中止を待ってから閉じる
+        self.export_status_label = ttk.Label(top_frame, text="", foreground="gray")
+        self.export_cancel_button = ttk.Button(top_frame, text="中止", command=self.cancel_export)
 
         # 大圏航路表示トグルボタン
         self.gc_route_mode = 0  # 0: 表示なし, 1: 全ピンへの大圏航路表示
         self.gc_route_button = ttk.Button(top_frame, text="大圏航路表示: 無効", command=self.toggle_gc_route)
         self.gc_route_button.pack(side=tk.LEFT, padx=5)
 
+        # クラスタ表示トグルボタン（近くのピンを件数付きの印にまとめる）
+        self.cluster_mode = True
+        self.cluster_button = ttk.Button(top_frame, text="クラスタ表示: 有効", command=self.toggle_cluster_mode)
+        self.cluster_button.pack(side=tk.LEFT, padx=5)
+
+        # 表示倍率（マウスホイールで拡大・縮小、ドラッグで上下左右に移動）
+        ttk.Button(top_frame, text="全体表示", command=self.reset_view).pack(side=tk.LEFT, padx=5)
+        self.zoom_label = ttk.Label(top_frame, text="倍率: x1.00")
+        self.zoom_label.pack(side=tk.LEFT, padx=5)
+
         # 中央領域：キャンバス＋右側パネル
         center_frame = ttk.Frame(self.root)
         center_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
@@ -122,6 +1247,24 @@ class MapMakerApp:
         self.canvas.bind("<B1-Motion>", self.on_canvas_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_canvas_release)
         self.canvas.bind("<Button-3>", self.on_pin_click)
+        self.canvas.bind("<MouseWheel>", lambda e: self.zoom_canvas(e, 1 if e.delta > 0 else -1))
+        self.canvas.bind("<Button-4>", lambda e: self.zoom_canvas(e, 1))
+        self.canvas.bind("<Button-5>", lambda e: self.zoom_canvas(e, -1))
+        self.scene = MapScene(self)
+        self.hit_grid = PinHitGrid(self.pins, self.eff_width, self.eff_height)
+        self.sphere_index = PinSphereIndex(self.pins)
+        self.query_center = None  # 近傍検索の中心ピンID
+        self.query_results = []   # 近傍検索の結果 [(ピンID, 距離km)]
+        self.redraw = RedrawScheduler(self.root, {
+            "background": self.scene.draw_background,
+            "pins": self.rebuild_pin_layer,
+            "pin_raster": self.scene.draw_pin_raster,
+            "routes": self.draw_routes,
+            "highlight": lambda: self.scene.set_highlights([pin_id for pin_id, _ in self.query_results]),
+            "search": self.draw_search_marks,
+            "list": self.update_pin_list,
+            "preview": self.update_pin_preview,
+        }, before_flush=self.sync_viewport, after_flush=self.update_redraw_stats)
 
         self.detail_panel = ttk.Frame(center_frame, relief=tk.SUNKEN, padding=5)
         self.detail_panel.pack(side=tk.RIGHT, fill=tk.Y)
@@ -143,17 +1286,33 @@ class MapMakerApp:
         self.bg_alpha_entry.pack(side=tk.LEFT, padx=5)
         # 入力欄の右にスライダーを追加（0～100の範囲）
         self.bg_alpha_slider = ttk.Scale(trans_frame, from_=0, to=100, orient=tk.HORIZONTAL,
-                                         variable=self.bg_alpha, command=lambda v: self.draw_map())
+                                         variable=self.bg_alpha, command=lambda v: self.request_redraw("background"))
         self.bg_alpha_slider.pack(side=tk.LEFT, padx=5)
         # 変数が変化したら背景再描画
-        self.bg_alpha.trace("w", lambda *args: self.draw_map())
+        self.bg_alpha.trace("w", lambda *args: self.request_redraw("background"))
+        # 星の直径が変わったら一覧の距離を更新
+        self.star_diameter.trace("w", lambda *args: self.request_redraw("list"))
+        # settings.json は変更があったときだけ書き直す
+        for var in (self.star_diameter, self.bg_alpha):
+            var.trace("w", lambda *args: setattr(self, "settings_dirty", True))
 
         ttk.Label(self.detail_panel, text="ピン一覧").pack(anchor="nw")
-        self.pin_listbox = tk.Listbox(self.detail_panel, height=25, font=("ＭＳ ゴシック", 10))
-        self.pin_listbox.pack(fill=tk.X, pady=2)
-        self.pin_listbox.bind("<<ListboxSelect>>", self.on_pin_list_select)
+        # ★ 名前・備考で一覧を絞り込む（入力のたびに更新）
+        search_frame = ttk.Frame(self.detail_panel)
+        search_frame.pack(anchor="nw", fill=tk.X)
+        ttk.Label(search_frame, text="検索:").pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        ttk.Entry(search_frame, textvariable=self.search_var, width=20).pack(side=tk.LEFT, padx=2)
+        ttk.Button(search_frame, text="クリア", width=5, command=lambda: self.search_var.set("")).pack(side=tk.LEFT, padx=2)
+        self.search_status_label = ttk.Label(search_frame, text="")
+        self.search_status_label.pack(side=tk.LEFT, padx=2)
+        self.search_var.trace("w", lambda *args: self.request_redraw("search", "list"))
+        self.search_index = PinSearchIndex(self.pins)
+        self.search_cache = None  # (検索語, 索引の version, 名前順の一致ピンID（先頭 SEARCH_LIST_LIMIT 件）, 一致した件数)
+        self.pin_list = VirtualPinList(self.detail_panel, 25, ("ＭＳ ゴシック", 10), self.select_pin)
+        self.pin_list.pack(fill=tk.X, pady=2)
         ttk.Label(self.detail_panel, text="ピン詳細").pack(anchor="nw", pady=(10, 0))
-        self.detail_text = tk.Text(self.detail_panel, width=45, height=15, state="disabled")
+        self.detail_text = tk.Text(self.detail_panel, width=45, height=8, state="disabled")
         self.detail_text.pack(pady=5)
         button_frame = ttk.Frame(self.detail_panel)
         button_frame.pack(pady=5)
@@ -169,10 +1328,38 @@ class MapMakerApp:
         self.bg_edit_button = ttk.Button(lower_button_frame, text="背景画像編集", command=self.open_bg_paint_tool)
         self.bg_edit_button.pack(side=tk.LEFT, padx=5)
 
+        # ★ 近傍検索（選択中のピンを中心に、近い順 k 件／半径 R km 以内）
+        query_frame = ttk.Frame(self.detail_panel)
+        query_frame.pack(anchor="nw", pady=(5, 0))
+        ttk.Label(query_frame, text="近傍検索:").pack(side=tk.LEFT)
+        self.query_mode_var = tk.StringVar(value=QUERY_MODES[0])
+        ttk.Combobox(query_frame, textvariable=self.query_mode_var, values=QUERY_MODES,
+                     width=10, state="readonly").pack(side=tk.LEFT, padx=2)
+        self.query_value_var = tk.StringVar(value="5")
+        ttk.Entry(query_frame, textvariable=self.query_value_var, width=8).pack(side=tk.LEFT, padx=2)
+        ttk.Button(query_frame, text="検索", width=5, command=self.run_pin_query).pack(side=tk.LEFT, padx=2)
+        ttk.Button(query_frame, text="解除", width=5, command=self.clear_pin_query).pack(side=tk.LEFT, padx=2)
+        self.query_listbox = tk.Listbox(self.detail_panel, height=5, font=("ＭＳ ゴシック", 10))
+        self.query_listbox.pack(fill=tk.X, pady=2)
+        self.query_listbox.bind("<<ListboxSelect>>", self.on_query_result_select)
+        self.query_status_label = ttk.Label(self.detail_panel, text="")
+        self.query_status_label.pack(anchor="nw")
+        # 再描画の回数と、まとめられた再描画要求の数
+        self.redraw_stats_label = ttk.Label(self.detail_panel, text="", foreground="gray")
+        self.redraw_stats_label.pack(anchor="nw", pady=(5, 0))
+        # ピンファイルの読み込み状況
+        self.load_status_label = ttk.Label(self.detail_panel, text="", foreground="gray")
+        self.load_status_label.pack(anchor="nw")
+        self.load_queue = None  # 読み込み中はワーカースレッドからの通知を受け取るキュー
+        self.startup_label = ttk.Label(self.detail_panel, text="", foreground="gray")
+        self.startup_label.pack(anchor="nw")
+        self.bg_load_token = 0  # 背景画像の非同期読み込みの世代（古い結果を捨てるため）
 
         self.edit_button.pack_forget()
         self.delete_button.pack_forget()
-        self.current_pin = None
+        self.current_pin_id = None
+        self.list_key = None  # 一覧を書いたときの (選択ピンID, 半径, store.version)
+        self.distance_cache = None  # (選択ピンID, 半径, store.geo_version, 行順の距離列)
 
         # 下部：ピン作成／編集入力領域
         self.pin_frame = ttk.Frame(self.root, relief=tk.RIDGE, padding=5)
@@ -205,11 +1392,11 @@ class MapMakerApp:
         ttk.Label(self.pin_frame, text="スライダー:").grid(row=0, column=3, sticky="w", padx=5, pady=2)
         self.lat_scale = ttk.Scale(self.pin_frame, from_=LAT_MIN, to=LAT_MAX,
                                    orient=tk.HORIZONTAL, length=600,
-                                   variable=self.lat_var, command=lambda v: self.update_pin_preview())
+                                   variable=self.lat_var, command=lambda v: self.request_redraw("preview"))
         self.lat_scale.grid(row=1, column=3, padx=5, pady=5)
         self.lon_scale = ttk.Scale(self.pin_frame, from_=LON_MIN, to=LON_MAX,
                                    orient=tk.HORIZONTAL, length=600,
-                                   variable=self.lon_var, command=lambda v: self.update_pin_preview())
+                                   variable=self.lon_var, command=lambda v: self.request_redraw("preview"))
         self.lon_scale.grid(row=2, column=3, padx=5, pady=5)
         button_frame_bottom = ttk.Frame(self.pin_frame)
         button_frame_bottom.grid(row=4, column=0, columnspan=4, pady=5)
@@ -219,7 +1406,7 @@ class MapMakerApp:
         self.cancel_button.pack(side=tk.LEFT, padx=10)
         self.set_pin_input_state("disabled")
         for var in (self.lat_var, self.lon_var, self.name_var):
-            var.trace("w", lambda *args: self.update_pin_preview())
+            var.trace("w", lambda *args: self.request_redraw("preview"))
 
     def set_pin_input_state(self, state):
         self.lat_entry.config(state=state)
@@ -239,215 +1426,290 @@ class MapMakerApp:
         selected_resolution = self.resolution_var.get()
         self.resolution_multiplier = RESOLUTION_OPTIONS[selected_resolution]
 
-    def lon_to_x(self, lon):
-        relative = (lon - LON_MIN) / (LON_MAX - LON_MIN)
-        x = self.margin_left + relative * self.eff_width + self.offset_x
-        return x
-
-    def lat_to_y(self, lat):
-        relative = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN)
-        y = self.margin_top + relative * self.eff_height
-        return y
+    def bg_alpha_level(self):
+        try:
+            alpha = self.bg_alpha.get() / 100.0
+        except Exception:
+            alpha = 1.0
+        return min(max(int(alpha * 255), 0), 255)
 
     def update_bg_image_with_alpha(self):
         if self.bg_image_original:
-            try:
-                alpha = self.bg_alpha.get() / 100.0
-            except Exception:
-                alpha = 1.0
+            alpha_level = self.bg_alpha_level()
+            # 元画像と透明度が前回と同じなら作成済みの PhotoImage をそのまま使う
+            key = self.bg_image_key
+            if (self.bg_image is not None and key is not None
+                    and key[0] is self.bg_image_original and key[1] == alpha_level):
+                return
             # PIL Image にアルファチャンネルを付与
-            img = self.bg_image_original.copy().convert("RGBA")
-            alpha_mask = Image.new("L", img.size, int(alpha * 255))
-            img.putalpha(alpha_mask)
+            img = self.bg_image_original.convert("RGBA")
+            img.putalpha(alpha_level)
             self.bg_image = ImageTk.PhotoImage(img)
+            self.bg_image_key = (self.bg_image_original, alpha_level)
 
 
 
-    def draw_map(self):
-        self.canvas.delete("all")
-        # 背景画像が未設定の場合のみ、グレーの背景を描画
-        if not self.bg_image_original:
-            self.canvas.create_rectangle(self.margin_left, self.margin_top,
-                                        self.margin_left + self.eff_width, self.margin_top + self.eff_height,
-                                        fill="#e0e0e0", outline="")
-        else:
-            # 背景画像が設定されている場合は、その画像を描画（透明度も反映）
-            self.update_bg_image_with_alpha()
-            offset = self.offset_x % self.eff_width
-            for dx in (-self.eff_width, 0, self.eff_width):
-                self.canvas.create_image(self.margin_left + offset + dx,
-                                        self.margin_top,
-                                        anchor="nw", image=self.bg_image)
-        for lon in range(-180, 181, 30):
-            x = self.lon_to_x(lon)
-            for dx in (-self.eff_width, 0, self.eff_width):
-                if lon == 180 and dx != 0:
-                    continue
-                x_pos = x + dx
-                self.canvas.create_line(x_pos, self.margin_top, x_pos, self.margin_top + self.eff_height, fill="gray")
-                self.canvas.create_text(x_pos, self.margin_top - 15, text=f"{lon}°", fill="gray")
-
-        for lat in range(LAT_MIN, LAT_MAX + 1, 15):
-            y = self.lat_to_y(lat)
-            line_color = "rosybrown" if lat == 0 else "gray"
-            self.canvas.create_line(self.margin_left, y, self.margin_left + self.eff_width, y, fill=line_color)
-            self.canvas.create_text(self.margin_left - 20, y, text=f"{lat}°", fill="gray")
-
-        for pin in self.pins:
-            self.draw_pin(pin)
-        if self.editing_mode:
-            self.update_pin_preview()
-        self.update_pin_list()
+    def read_bg_window(self, zoom, x, y, width, height):
+        # 倍率 zoom の地図上の範囲（左上 (x, y)、横方向は一周ごとに繰り返す）を width x height の画像で返す
+        source = self.bg_pyramid if self.bg_pyramid is not None else self.bg_image_original
+        return read_map_window(source, self.eff_width, self.eff_height, zoom, x, y, width, height)
 
+    def draw_map(self):
+        # 全領域の再描画を予約（マップの読み込み時など）。部分的な変更は request_redraw() で領域を指定する
+        self.request_redraw(*RedrawScheduler.REGIONS)
+
+    def rebuild_pin_layer(self):
+        # ピン一覧が入れ替わったとき（読み込み等）にキャンバスとクリック判定をまとめて作り直す
+        self.hit_grid.rebuild()
+        self.scene.clusters.invalidate()
+        self.clear_pin_query()
+        self.scene.rebuild_pins()
+
+    def request_redraw(self, *regions):
+        self.redraw.request(*regions)
+
+    def sync_viewport(self):
+        # 表示範囲の変化をキャンバスへ反映。アイテムを作り直した場合は位置に依存する領域も描き直す
+        if self.scene.sync():
+            return ("background", "routes", "highlight", "search", "preview")
+        return ()
+
+    def zoom_canvas(self, event, steps):
+        # マウス位置を中心に拡大・縮小（作り直しは次のフレームでまとめて行う）
+        if self.viewport.zoom_at(event.x, event.y, Viewport.ZOOM_STEP ** steps):
+            self.update_zoom_label()
+            self.request_redraw()
+
+    def reset_view(self):
+        self.viewport.restore(1.0, 0, 0)
+        self.update_zoom_label()
+        self.request_redraw()
+
+    def update_zoom_label(self):
+        self.zoom_label.config(text=f"倍率: x{self.viewport.zoom:.2f}")
+
+    def update_redraw_stats(self):
+        if self.first_paint_pending:
+            self.first_paint_pending = False
+            self.mark_startup("初回描画")
+        self.redraw_stats_label.config(
+            text=f"再描画: {self.redraw.flushes}回（統合された要求: {self.redraw.coalesced}件）")
+
+    def draw_routes(self):
         # 大圏航路の描画（gc_route_mode が 0 以外の場合）
-
-        if self.gc_route_mode != 0 and self.current_pin:
+        xs = ys = np.empty((0, 0))
+        if self.gc_route_mode != 0 and self.current_pin_id is not None:
             # 現在選択中のピンから他のすべてのピンへ大圏航路を描画
-            for pin in self.pins:
-                if pin != self.current_pin:
-                    pts = self.get_gc_points_raw(self.current_pin["lat"], self.current_pin["lon"],
-                                                pin["lat"], pin["lon"])
-                    self.canvas.create_line(pts, fill="blue", dash=(4, 4))
-                    self.canvas.create_line([(x + self.eff_width, y) for (x, y) in pts],
-                                            fill="blue", dash=(4, 4))
-                    self.canvas.create_line([(x - self.eff_width, y) for (x, y) in pts],
-                                            fill="blue", dash=(4, 4))
-
-    def draw_pin(self, pin):
-        base_x = self.lon_to_x(pin["lon"])  # ここではモジュロ演算を使わない
-        y = self.lat_to_y(pin["lat"])
-        # タイルとして左・中央・右側にそれぞれ描画
-        for dx in (-self.eff_width, 0, self.eff_width):
-            x = base_x + dx
-            pts = [x - 3, y - 4, x + 3, y - 4, x, y]
-            self.canvas.create_polygon(pts, fill="black", outline="black", tags="pin")
-            pin_color = pin.get("color", DEFAULT_PIN_COLOR)
-            self.canvas.create_text(x, y - 4, text=pin["name"], fill=pin_color, tags="pin", anchor="s")
+            # キャッシュ済みの正規化座標を現在の倍率・オフセットで変換するだけ（パン時は三角関数の計算なし）
+            dest_ids, u, v = self.route_cache.get_routes(self.pins, self.current_pin_id)
+            if dest_ids:
+                xs = self.margin_left + u * self.scene.period + self.scene.offset_x
+                ys = self.margin_top + v * self.scene.full_height + self.scene.offset_y
+        self.scene.set_routes(xs, ys)
 
     def update_pin_preview(self):
-        self.canvas.delete("preview_pin")
         if not self.editing_mode:
+            self.scene.clear_preview()
             return
         try:
             lat = float(self.lat_var.get())
             lon = float(self.lon_var.get())
         except Exception:
             return
-        # キャンバス表示時の変換関数をそのまま使用
-        base_x = self.lon_to_x(lon)
-        y = self.lat_to_y(lat)
-        # 左・中央・右側のタイルに対して描画
-        for dx in (-self.eff_width, 0, self.eff_width):
-            x = base_x + dx
-            pts = [x - 3, y - 4, x + 3, y - 4, x, y]
-            self.canvas.create_polygon(pts, fill="red", outline="red", tags="preview_pin")
+        self.scene.set_preview(lat, lon)
 
     def on_canvas_press(self, event):
-        self.drag_start = event.x
+        self.drag_start = (event.x, event.y)
 
     def on_canvas_drag(self, event):
         if self.drag_start is not None:
-            dx = event.x - self.drag_start
-            self.offset_x += dx
-            self.offset_x %= self.eff_width
-            self.drag_start = event.x
-            self.draw_map()
+            self.viewport.pan(event.x - self.drag_start[0], event.y - self.drag_start[1])
+            self.drag_start = (event.x, event.y)
+            # 再描画せず、次のフレームで既存のアイテムを移動するだけ
+            self.request_redraw()
 
     def on_canvas_release(self, event):
         self.drag_start = None
 
     def on_pin_click(self, event):
-        clicked = None
-        for pin in self.pins:
-            base_x = self.lon_to_x(pin["lon"])  # 基準となるx座標（タイル分の補正は後で）
-            y = self.lat_to_y(pin["lat"])
-            # 左・中央・右側のタイルそれぞれでクリック判定
-            for dx in (-self.eff_width, 0, self.eff_width):
-                x = base_x + dx
-                if (event.x - x) ** 2 + (event.y - y) ** 2 < 100:
-                    clicked = pin
-                    break
-            if clicked:
-                break
-        if clicked:
-            # 直前ピン関連の処理は削除
-            self.current_pin = clicked
-            self.show_pin_detail(clicked)
-            self.update_pin_list()
-            for i, p in enumerate(self.pins):
-                if p == clicked:
-                    self.pin_listbox.selection_clear(0, tk.END)
-                    self.pin_listbox.selection_set(i)
-                    break
-            self.draw_map()
+        # クラスタの印なら拡大して分ける
+        key = self.scene.cluster_at(event.x, event.y)
+        if key is not None:
+            if self.scene.expand_cluster(key):
+                self.update_zoom_label()
+                self.request_redraw()
+            return
+        # クリック位置を倍率1・オフセット 0 の座標に戻してグリッドで判定（重なっている場合は最も近いピン）
+        # クラスタにまとめられて見えていないピンは選ばない
+        x, y = self.viewport.to_world(event.x, event.y)
+        hits = [pin_id for pin_id in self.hit_grid.query(x, y, 10 / self.viewport.zoom)
+                if pin_id in self.scene.labels.points]
+        if hits:
+            self.select_pin(hits[0])
+
+    def select_pin(self, pin_id):
+        previous, self.current_pin_id = self.current_pin_id, pin_id
+        self.scene.refresh_labels([previous, pin_id])  # 選択中のピンのラベルを最優先で置く
+        self.show_pin_detail(pin_id)
+        self.request_redraw("routes", "list")
+
+    def clear_selection(self):
+        previous, self.current_pin_id = self.current_pin_id, None
+        self.scene.refresh_labels([previous])
+        self.detail_text.config(state="normal")
+        self.detail_text.delete("1.0", tk.END)
+        self.detail_text.config(state="disabled")
+        self.edit_button.pack_forget()
+        self.delete_button.pack_forget()
 
 
 
-    def show_pin_detail(self, pin):
+    def show_pin_detail(self, pin_id):
+        pin = self.pins.get(pin_id)
+        lat, lon = self.pins.lat_lon(pin_id)
         self.detail_text.config(state="normal")
         self.detail_text.delete("1.0", tk.END)
-        info = f"緯度: {pin['lat']}\n経度: {pin['lon']}\n地名: {pin['name']}\n備考: {pin['remark']}\n色: {pin.get('color', DEFAULT_PIN_COLOR)}"
+        info = f"緯度: {lat}\n経度: {lon}\n地名: {pin.name}\n備考: {pin.remark}\n色: {pin.color}"
         self.detail_text.insert(tk.END, info)
         self.detail_text.config(state="disabled")
         self.edit_button.pack(side=tk.LEFT, padx=5)
         self.delete_button.pack(side=tk.LEFT, padx=5)
 
-    def on_pin_list_select(self, event):
-        if not self.pin_listbox.curselection():
-            return
-        index = self.pin_listbox.curselection()[0]
-        pin = self.pins[index]
-        self.current_pin = pin
-        self.show_pin_detail(pin)
-        self.update_pin_list()
-        self.draw_map()
-
     def update_pin_list(self):
-        self.pin_listbox.delete(0, tk.END)
-        self.pins.sort(key=lambda pin: pin['name'])
-        selected_pin = self.current_pin
-        for pin in self.pins:
-            if selected_pin and pin != selected_pin:
-                try:
-                    distance = self.compute_distance(selected_pin["lat"], selected_pin["lon"], pin["lat"], pin["lon"])
-                    display_text = format_pin_entry(pin["name"], distance)
-                except Exception:
-                    display_text = "  " + pin["name"]
-            else:
-                display_text = "  " + pin["name"]
-            self.pin_listbox.insert(tk.END, display_text)
-
-    def compute_distance(self, lat1, lon1, lat2, lon2):
-        # ユーザー設定の星の直径から半径（直径÷2）を取得して計算
-        R = self.star_diameter.get() / 2.0  
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        return R * c
+        # 選択・星の直径・ピンの内容のいずれかが変わったときだけ書き直す（パンやプレビューでは何もしない）
+        selected_id = self.current_pin_id
+        try:
+            radius = self.star_diameter.get() / 2.0
+        except tk.TclError:
+            radius = None  # 直径の入力途中は距離を表示しない
+        matches = self.search_matches()
+        key = (selected_id, radius, self.pins.version, self.search_cache[:2])
+        if key == self.list_key:
+            return
+        self.list_key = key
+        # 名前順の索引は PinStore 側で維持されている。行の文字列は表示される行の分だけ作る
+        if selected_id is not None and radius is not None:
+            distances = self.distance_column(selected_id, radius)
+
+            def format_row(pin_id):
+                name = self.pins.get(pin_id).name
+                if pin_id == selected_id:
+                    return "  " + name
+                return format_pin_entry(name, float(distances[self.pins.rows[pin_id]]))
+        else:
+            def format_row(pin_id):
+                return "  " + self.pins.get(pin_id).name
+        self.pin_list.set_rows(self.pins.sorted_ids() if matches is None else matches, format_row, selected_id)
+
+    def search_matches(self):
+        # 検索語に一致するピンIDを名前順で先頭から SEARCH_LIST_LIMIT 件まで返す（検索語が空なら None）
+        query = self.search_var.get()
+        key = (query, self.search_index.version)
+        if self.search_cache is not None and self.search_cache[:2] == key:
+            return self.search_cache[2]
+        hits = self.search_index.search(query)
+        if hits is None:
+            matches, total = None, 0
+        else:
+            matches, total = self.pins.sort_by_name(hits, SEARCH_LIST_LIMIT), len(hits)
+        self.search_cache = key + (matches, total)
+        return matches
+
+    def draw_search_marks(self):
+        matches = self.search_matches()
+        if matches is None:
+            self.scene.set_search_marks([])
+            self.search_status_label.config(text="")
+            return
+        total = self.search_cache[3]
+        self.scene.set_search_marks(matches[:SEARCH_MARK_LIMIT])
+        text = f"{total}件"
+        if total > len(matches):
+            text += f"（一覧には{len(matches)}件、地図には{SEARCH_MARK_LIMIT}件まで表示）"
+        elif total > SEARCH_MARK_LIMIT:
+            text += f"（地図には{SEARCH_MARK_LIMIT}件まで表示）"
+        self.search_status_label.config(text=text)
+
+    def distance_column(self, origin_id, radius):
+        # 選択ピンから全ピンへの距離（PinStore の行順）。選択・半径・ピン位置が同じ間は使い回す
+        key = (origin_id, radius, self.pins.geo_version)
+        if self.distance_cache is None or self.distance_cache[:3] != key:
+            lat, lon = self.pins.lat_lon(origin_id)
+            self.distance_cache = key + (haversine_km(lat, lon, self.pins.lat, self.pins.lon, radius),)
+        return self.distance_cache[3]
+
+    def run_pin_query(self):
+        if self.current_pin_id is None:
+            messagebox.showerror("エラー", "近傍検索の中心にするピンを選択してください")
+            return
+        try:
+            value = float(self.query_value_var.get())
+            radius = self.star_diameter.get() / 2.0
+        except (ValueError, tk.TclError):
+            messagebox.showerror("入力エラー", "件数・半径・星の直径は数値で入力してください")
+            return
+        center = self.current_pin_id
+        lat, lon = self.pins.lat_lon(center)
+        start = time.perf_counter()
+        if self.query_mode_var.get() == QUERY_MODES[0]:
+            results = self.sphere_index.nearest(lat, lon, int(value), radius, exclude=center)
+        else:
+            results = self.sphere_index.within(lat, lon, value, radius, exclude=center)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.query_center = center
+        self.query_results = results
+        self.fill_query_list()
+        self.query_status_label.config(
+            text=f"{self.pins.get(center).name} から {len(results)}件（{elapsed:.1f} ms）")
+        self.request_redraw("highlight")
+
+    def fill_query_list(self):
+        self.query_listbox.delete(0, tk.END)
+        for pin_id, distance in self.query_results:
+            self.query_listbox.insert(tk.END, format_pin_entry(self.pins.get(pin_id).name, distance))
+
+    def clear_pin_query(self):
+        self.query_center = None
+        self.query_results = []
+        self.query_listbox.delete(0, tk.END)
+        self.query_status_label.config(text="")
+        self.request_redraw("highlight")
+
+    def drop_from_pin_query(self, pin_id):
+        # 削除されたピンを検索結果から外す（中心が削除された場合は結果ごと破棄）
+        if pin_id == self.query_center:
+            self.clear_pin_query()
+        elif any(p == pin_id for p, _ in self.query_results):
+            self.query_results = [(p, d) for p, d in self.query_results if p != pin_id]
+            self.fill_query_list()
+            self.request_redraw("highlight")
+
+    def on_query_result_select(self, event):
+        if not self.query_listbox.curselection():
+            return
+        self.select_pin(self.query_results[self.query_listbox.curselection()[0]][0])
 
     def edit_current_pin(self):
-        if self.current_pin:
-            self.show_pin_input_edit(self.current_pin)
+        if self.current_pin_id is not None:
+            self.show_pin_input_edit(self.current_pin_id)
 
     def delete_current_pin(self):
-        if self.current_pin and messagebox.askyesno("確認", "このピンを削除しますか？"):
-            if "marker_id" in self.current_pin:
-                self.canvas.delete(self.current_pin["marker_id"])
-            if "text_id" in self.current_pin:
-                self.canvas.delete(self.current_pin["text_id"])
-            self.pins.remove(self.current_pin)
-            self.current_pin = None
-            self.detail_text.config(state="normal")
-            self.detail_text.delete("1.0", tk.END)
-            self.detail_text.config(state="disabled")
-            self.edit_button.pack_forget()
-            self.delete_button.pack_forget()
-            self.update_pin_list()
-            self.draw_map()
+        if self.current_pin_id is not None and messagebox.askyesno("確認", "このピンを削除しますか？"):
+            pin_id = self.current_pin_id
+            self.scene.remove_pin(pin_id)
+            self.hit_grid.remove(pin_id)
+            self.drop_from_pin_query(pin_id)
+            self.search_index.remove(pin_id)
+            self.journal.mark_delete(pin_id)
+            self.pins.remove(pin_id)
+            self.route_cache.invalidate_pin(pin_id)
+            if self.editing_pin_id == pin_id:
+                self.editing_pin_id = None
+            self.clear_selection()
+            self.request_redraw("routes", "search", "list")
 
     def show_pin_input_new(self):
-        self.editing_pin = None
+        self.editing_pin_id = None
         self.pin_action_button.config(text="作成")
         self.lat_var.set(0.0)
         self.lon_var.set(0.0)
@@ -457,26 +1719,28 @@ class MapMakerApp:
         self.color_var.set(DEFAULT_PIN_COLOR)
         self.editing_mode = True
         self.set_pin_input_state("normal")
-        self.draw_map()
+        self.request_redraw("preview")
 
-    def show_pin_input_edit(self, pin):
-        self.editing_pin = pin
+    def show_pin_input_edit(self, pin_id):
+        pin = self.pins.get(pin_id)
+        lat, lon = self.pins.lat_lon(pin_id)
+        self.editing_pin_id = pin_id
         self.pin_action_button.config(text="更新")
-        self.lat_var.set(pin["lat"])
-        self.lon_var.set(pin["lon"])
-        self.name_var.set(pin["name"])
+        self.lat_var.set(lat)
+        self.lon_var.set(lon)
+        self.name_var.set(pin.name)
         self.remark_text.config(state="normal")
         self.remark_text.delete("1.0", tk.END)
-        self.remark_text.insert("1.0", pin["remark"])
-        self.color_var.set(pin.get("color", DEFAULT_PIN_COLOR))
+        self.remark_text.insert("1.0", pin.remark)
+        self.color_var.set(pin.color)
         self.editing_mode = True
         self.set_pin_input_state("normal")
-        self.draw_map()
+        self.request_redraw("preview")
 
     def cancel_pin_input(self):
         self.editing_mode = False
         self.set_pin_input_state("disabled")
-        self.draw_map()
+        self.request_redraw("preview")
 
     def create_or_update_pin(self):
         try:
@@ -488,16 +1752,31 @@ class MapMakerApp:
         name = self.name_var.get()
         remark = self.remark_text.get("1.0", tk.END).strip()
         pin_color = self.color_var.get()
-        if self.editing_pin:
-            self.editing_pin.update({"lat": lat, "lon": lon, "name": name, "remark": remark, "color": pin_color})
+        pin_id = self.editing_pin_id
+        if pin_id is not None and pin_id in self.pins:
+            if self.pins.update(pin_id, lat, lon, name, remark, pin_color):
+                self.route_cache.invalidate_pin(pin_id)
+            # 変更したピンのアイテムだけを作り直す
+            self.scene.update_pin(pin_id)
+            self.hit_grid.update(pin_id)
+            self.search_index.update(pin_id)
+            self.journal.mark_put(pin_id)
+            if pin_id == self.current_pin_id:
+                self.show_pin_detail(pin_id)
         else:
-            new_pin = {"lat": lat, "lon": lon, "name": name, "remark": remark, "color": pin_color}
-            self.pins.append(new_pin)
+            pin_id = self.pins.add(lat, lon, name, remark, pin_color)
+            self.scene.add_pin(pin_id)
+            self.hit_grid.add(pin_id)
+            self.search_index.add(pin_id)
+            self.journal.mark_put(pin_id)
         self.editing_mode = False
         self.set_pin_input_state("disabled")
-        self.draw_map()
+        self.request_redraw("preview", "routes", "highlight", "search", "list")
 
     def save_data(self):
+        if self.load_queue is not None:
+            messagebox.showerror("エラー", "ピンの読み込み中は保存できません")
+            return
         map_name = self.map_name_entry.get().strip()
         if not map_name:
             folder = filedialog.askdirectory(title="保存先フォルダを選択")
@@ -509,27 +1788,66 @@ class MapMakerApp:
         else:
             folder = map_name
         os.makedirs(folder, exist_ok=True)
-        # ピン情報の保存
-        filepath = os.path.join(folder, "pins.csv")
-        with open(filepath, "w", newline="", encoding="utf-8") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(["lat", "lon", "name", "remark", "color"])
-            for pin in self.pins:
-                writer.writerow([pin["lat"], pin["lon"], pin["name"], pin["remark"], pin.get("color", DEFAULT_PIN_COLOR)])
+        # ピン情報の保存。同じフォルダへの保存なら変更分だけを追記ログ（SQLite なら 1 トランザクション）に書く
+        db_path = os.path.join(folder, PINS_DB_FILE)
+        if self.storage_var.get() == "SQLite":
+            if self.journal.is_bound_to(folder, "SQLite") and os.path.exists(db_path):
+                if self.journal.pending:
+                    SqlitePinBackend(db_path).apply(*self.journal.take_changes(self.pins))
+            else:
+                self.import_pins_to_sqlite(folder)
+        elif self.journal.is_bound_to(folder) and os.path.exists(os.path.join(folder, PINS_FILE)):
+            if self.journal.pending:
+                self.journal.append(self.pins)
+            if self.journal.needs_compaction():
+                self.compact_pins(folder)
+        else:
+            self.compact_pins(folder)
         # settings.json に背景透明度と星の直径を保存（マップ毎）
-        self.save_settings(folder)
+        if self.settings_dirty or not os.path.exists(os.path.join(folder, SETTINGS_FILE)):
+            self.save_settings(folder)
         self.save_state()
 
+    def compact_pins(self, folder):
+        pin_ids, digest = write_pins_folder(folder, self.pins)
+        self.journal.bind(folder, pin_ids, list(range(len(pin_ids))), digest)
+        # CSV に切り替えた場合、古い pins.sqlite が残っていると次に開いたときそちらが読まれてしまう
+        db_path = os.path.join(folder, PINS_DB_FILE)
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+    def import_pins_to_sqlite(self, folder):
+        # 今のピンを pins.sqlite に丸ごと書き、pins.csv 用の追記ログとキャッシュは消す
+        # pins.csv は以後更新しないので pins.csv.bak に改名する（古い版や pins.sqlite を消したときに古いピンを読まないように）
+        pin_ids = list(self.pins.sorted_ids())
+        rows = self.pins.rows_of(pin_ids)
+        records = [self.pins.get(pin_id) for pin_id in pin_ids]
+        keys = list(range(len(pin_ids)))
+        SqlitePinBackend(os.path.join(folder, PINS_DB_FILE)).replace_all(
+            keys, self.pins.lat[rows].tolist(), self.pins.lon[rows].tolist(),
+            [pin.name for pin in records], [pin.remark for pin in records], [pin.color for pin in records])
+        for name in (PIN_JOURNAL_FILE, PIN_CACHE_FILE):
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+        csv_path = os.path.join(folder, PINS_FILE)
+        if os.path.exists(csv_path):
+            os.replace(csv_path, csv_path + ".bak")
+        self.journal.bind(folder, pin_ids, keys, None, storage="SQLite")
+
     def save_settings(self, folder):
         settings = {
             "star_diameter": self.star_diameter.get(),
             "bg_alpha": self.bg_alpha.get()
         }
-        settings_path = os.path.join(folder, "settings.json")
-        with open(settings_path, "w", encoding="utf-8") as f:
-            json.dump(settings, f, ensure_ascii=False, indent=2)
+        settings_path = os.path.join(folder, SETTINGS_FILE)
+        replace_atomically(settings_path, lambda f: json.dump(settings, f, ensure_ascii=False, indent=2))
+        self.settings_dirty = False
 
     def load_data(self):
+        if self.load_queue is not None:
+            messagebox.showerror("エラー", "ピンを読み込み中です")
+            return
         folder = filedialog.askdirectory(title="マップデータのフォルダを選択")
         if not folder:
             return
@@ -538,62 +1856,129 @@ class MapMakerApp:
         self.map_name_entry.delete(0, tk.END)
         self.map_name_entry.insert(0, map_name)
 
-        filepath = os.path.join(folder, "pins.csv")
-        if not os.path.exists(filepath):
-            messagebox.showerror("エラー", "選択フォルダに pins.csv が見つかりません")
+        if not any(os.path.exists(os.path.join(folder, name)) for name in (PINS_FILE, PINS_DB_FILE)):
+            messagebox.showerror("エラー", "選択フォルダに pins.csv（または pins.sqlite）が見つかりません")
             return
-        with open(filepath, "r", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            self.pins.clear()
-            for row in reader:
-                try:
-                    pin = {"lat": float(row["lat"]), "lon": float(row["lon"]),
-                        "name": row["name"], "remark": row["remark"],
-                        "color": row.get("color", DEFAULT_PIN_COLOR)}
-                    self.pins.append(pin)
-                except Exception:
-                    continue
-        settings_path = os.path.join(folder, "settings.json")
-        if os.path.exists(settings_path):
+        self.start_pin_load(folder)
+
+    def start_pin_load(self, folder, with_background=True, on_loaded=None):
+        # pins.csv（またはキャッシュ）をワーカースレッドで読み、結果はキュー経由でメインスレッドが受け取る
+        results = queue.Queue()
+        self.load_queue = results
+
+        def worker():
             try:
-                with open(settings_path, "r", encoding="utf-8") as f:
-                    settings = json.load(f)
-                if "star_diameter" in settings:
-                    self.star_diameter.set(settings["star_diameter"])
-                if "bg_alpha" in settings:
-                    self.bg_alpha.set(settings["bg_alpha"])
-            except Exception:
-                pass
+                loaded = load_pins_file(folder, lambda fraction, rejected: results.put(("progress", fraction, rejected)))
+                # 名前・備考の検索索引もここで作り、メインスレッドでは受け取るだけにする
+                entries = PinSearchIndex.build_entries(loaded[0].names, loaded[0].remarks)
+                results.put(("done",) + loaded + (entries,))
+            except Exception as e:
+                results.put(("error", e))
 
+        self.load_status_label.config(text="ピンを読み込み中…")
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(50, self.poll_pin_load, folder, with_background, on_loaded)
+
+    def poll_pin_load(self, folder, with_background, on_loaded):
+        message = None
+        try:
+            while True:
+                message = self.load_queue.get_nowait()
+                if message[0] != "progress":
+                    break
+        except queue.Empty:
+            pass
+        if message is None or message[0] == "progress":
+            if message is not None:
+                self.load_status_label.config(
+                    text=f"ピンを読み込み中… {message[1] * 100:.0f}%（不正な行: {message[2]}件）")
+            self.root.after(50, self.poll_pin_load, folder, with_background, on_loaded)
+            return
+        self.load_queue = None
+        self.canvas.delete("placeholder")
+        if message[0] == "error":
+            self.load_status_label.config(text="")
+            messagebox.showerror("読み込みエラー", f"ピンの読み込みに失敗しました: {message[1]}")
+            return
+        columns, digest, cached, entries, storage, search_entries = message[1:]
+        pin_ids = self.replace_pins(columns.lat, columns.lon, columns.names, columns.remarks, columns.colors,
+                                    search_entries)
+        self.journal.bind(folder, pin_ids, columns.keys, digest, entries, storage)
+        self.storage_var.set(storage)
+        self.load_settings(folder)
+        status = f"{len(columns.names)}件を読み込みました" + ("（キャッシュ）" if cached else "")
+        if columns.rejected:
+            status += f"　不正な行: {columns.rejected}件"
+        self.load_status_label.config(text=status)
         # 背景画像も確実に読み込む
-        self.load_bg_image_from_folder()
+        if with_background:
+            self.load_bg_image_async()
         self.draw_map()
+        if on_loaded:
+            on_loaded()
+        if columns.rejected and not cached:
+            messagebox.showerror("読み込みエラー", f"pins.csv の {columns.rejected} 行を読み込めなかったため、読み飛ばしました")
 
+    def load_settings(self, folder):
+        try:
+            settings = read_map_settings(folder)
+            if "star_diameter" in settings:
+                self.star_diameter.set(settings["star_diameter"])
+            if "bg_alpha" in settings:
+                self.bg_alpha.set(settings["bg_alpha"])
+        except Exception:
+            pass
+        self.settings_dirty = False
+
+    def replace_pins(self, lats, lons, names, remarks, colors, search_entries=None):
+        # ピンを丸ごと入れ替える（読み込み時）。選択やキャッシュも合わせて破棄し、追加したピンIDを返す
+        # search_entries はワーカースレッドで作った検索索引（PinSearchIndex.build_entries()）。なければここで作る
+        self.scene.clear_pins()
+        self.pins.clear()
+        pin_ids = self.pins.extend(lats, lons, names, remarks, colors)
+        self.route_cache.clear()
+        if search_entries is None:
+            search_entries = PinSearchIndex.build_entries(names, remarks)
+        self.search_index.adopt(search_entries, pin_ids[0] if pin_ids else self.pins.next_id)
+        self.journal.unbind()
+        self.editing_pin_id = None
+        self.clear_selection()
+        return pin_ids
 
     def save_state(self):
+        # ピンはマップフォルダにあるので、状態ファイルにはフォルダの場所と表示状態だけを書く
+        map_name = self.map_name_entry.get().strip()
         state = {
-            "map_name": self.map_name_entry.get().strip(),
-            "offset_x": self.offset_x,
-            "pins": [{"lat": p["lat"], "lon": p["lon"], "name": p["name"], "remark": p["remark"], "color": p.get("color", DEFAULT_PIN_COLOR)} for p in self.pins],
+            "map_name": map_name,
+            "map_folder": self.journal.folder or os.path.abspath(map_name or "my_map"),
+            "zoom": self.viewport.zoom,
+            "offset_x": self.viewport.offset_x,
+            "offset_y": self.viewport.offset_y,
             "resolution_multiplier": self.resolution_multiplier,
             "star_diameter": self.star_diameter.get(),
             "bg_alpha": self.bg_alpha.get()
         }
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        replace_atomically(STATE_FILE, lambda f: json.dump(state, f, ensure_ascii=False, indent=2))
 
     def load_state(self):
+        # 表示状態を戻し、ピンを読み込むべきマップフォルダを返す（なければ None）
+        folder = None
         if os.path.exists(STATE_FILE):
             try:
                 with open(STATE_FILE, "r", encoding="utf-8") as f:
                     state = json.load(f)
                 self.map_name_entry.delete(0, tk.END)
                 self.map_name_entry.insert(0, state.get("map_name", "my_map"))
-                self.offset_x = state.get("offset_x", 0)
-                self.pins = state.get("pins", [])
-                for pin in self.pins:
-                    if "color" not in pin:
-                        pin["color"] = DEFAULT_PIN_COLOR
+                self.viewport.restore(state.get("zoom", 1.0), state.get("offset_x", 0), state.get("offset_y", 0))
+                self.update_zoom_label()
+                folder = state.get("map_folder") or state.get("map_name") or "my_map"
+                if not any(os.path.exists(os.path.join(folder, name)) for name in (PINS_FILE, PINS_DB_FILE)):
+                    folder = None
+                    # 旧形式（ピンを状態ファイルに持っていた）の場合
+                    pins = state.get("pins", [])
+                    self.replace_pins([p["lat"] for p in pins], [p["lon"] for p in pins],
+                                      [p["name"] for p in pins], [p["remark"] for p in pins],
+                                      [p.get("color", DEFAULT_PIN_COLOR) for p in pins])
                 self.resolution_multiplier = state.get("resolution_multiplier", 1)
                 resolution_text = [key for key, value in RESOLUTION_OPTIONS.items() if value == self.resolution_multiplier][0]
                 self.resolution_var.set(resolution_text)
@@ -603,215 +1988,253 @@ class MapMakerApp:
                     self.bg_alpha.set(state["bg_alpha"])
             except Exception as e:
                 messagebox.showerror("読み込みエラー", f"状態の読み込みに失敗しました: {e}")
+        return folder
 
     def save_and_close(self):
         self.save_data()
+        if self.export_cancel is not None:
+            # 書き出し中なら中止させ、書きかけのファイルを消し終えたら poll_export() で閉じる
+            # （ワーカーはデーモンスレッドなので、先に閉じると後始末の前に止まってしまう）
+            self.close_after_export = True
+            self.cancel_export()
+            return
         self.root.destroy()
 
 
     def reload_map(self):
         # 背景画像フォルダから再読込みし、再描画する
         self.load_bg_image_from_folder()
-        self.draw_map()
+        self.request_redraw("background")
 
 
-    def generate_map_image(self):
-        import math
+    def export_settings(self):
+        # 書き出しに使う現在の表示・ピンの写し（MapExport.from_store() の引数）。ピンは複製するので、
+        # 書き出しを別スレッドで進めている間に編集されても影響しない
         multiplier = self.resolution_multiplier
-        # 効果領域（マージン除く）サイズ
-        export_width = self.eff_width
-        export_height = self.eff_height
-        scaled_width = int(export_width * multiplier)
-        scaled_height = int(export_height * multiplier)
-
-        # 新規画像作成（背景塗りつぶし）
-        img = Image.new("RGB", (scaled_width, scaled_height), "white")
-        draw = ImageDraw.Draw(img)
-        draw.rectangle([(0, 0), (scaled_width, scaled_height)], fill="#e0e0e0")
-
-        # 背景画像描画（タイル貼り）
+        # 出力は常に地図全体。横方向の位置だけ画面の表示に合わせる（倍率1での量に換算）
+        offset_x = self.viewport.offset_x / self.viewport.zoom
+        background = None
         if self.bg_image_original:
-            try:
-                alpha = self.bg_alpha.get() / 100.0
-            except Exception:
-                alpha = 1.0
-            bg = self.bg_image_original.copy().convert("RGBA")
-            alpha_mask = Image.new("L", bg.size, int(alpha * 255))
-            bg.putalpha(alpha_mask)
-            bg_scaled = bg.resize((scaled_width, scaled_height), Image.LANCZOS)
-            # 背景はキャンバスと同様に、(offset_x*multiplier) を使い左右タイル状に配置
-            offset = int((self.offset_x * multiplier) % scaled_width)
-            for dx in (-scaled_width, 0, scaled_width):
-                pos = (-offset + dx, 0)
-                img.paste(bg_scaled, pos, bg_scaled)
-
-        # グリッド描画（キャンバスと同様）
-        for lon in range(-180, 181, 30):
-            rel = (lon - LON_MIN) / (LON_MAX - LON_MIN)
-            x_eff = (rel * self.eff_width + self.offset_x) % self.eff_width
-            x_scaled = int(x_eff * multiplier)
-            draw.line([(x_scaled, 0), (x_scaled, scaled_height)], fill="gray")
-        for lat in range(LAT_MIN, LAT_MAX + 1, 15):
-            rel = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN)
-            y_scaled = int(rel * self.eff_height * multiplier)
-            draw.line([(0, y_scaled), (scaled_width, y_scaled)], fill="gray")
-
-        # エクスポート用の座標変換（大圏航路用、ラップせず「生の」座標）
-        def exp_lat_to_y(lat):
-            rel = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN)
-            return rel * self.eff_height * multiplier
-
-        def raw_exp_lon_to_x(lon):
-            rel = (lon - LON_MIN) / (LON_MAX - LON_MIN)
-            # ラップせず、offset_x分をそのまま加算
-            return rel * self.eff_width * multiplier + (self.offset_x * multiplier)
-
-        # 大圏航路座標列を求める（ラップせず算出し、連続性を調整）
-        def get_raw_export_gc_points(lat1, lon1, lat2, lon2, n=100):
-            pts = []
-            phi1 = math.radians(lat1)
-            phi2 = math.radians(lat2)
-            lambda1 = math.radians(lon1)
-            lambda2 = math.radians(lon2)
-            delta = 2 * math.asin(math.sqrt(math.sin((phi2 - phi1) / 2)**2 +
-                                            math.cos(phi1) * math.cos(phi2) * math.sin((lambda2 - lambda1) / 2)**2))
-            if delta == 0:
-                x = raw_exp_lon_to_x(lon1)
-                y = exp_lat_to_y(lat1)
-                return [(x, y)] * (n + 1)
-            for i in range(n + 1):
-                f = i / n
-                A = math.sin((1 - f) * delta) / math.sin(delta)
-                B = math.sin(f * delta) / math.sin(delta)
-                x_val = A * math.cos(phi1) * math.cos(lambda1) + B * math.cos(phi2) * math.cos(lambda2)
-                y_val = A * math.cos(phi1) * math.sin(lambda1) + B * math.cos(phi2) * math.sin(lambda2)
-                z = A * math.sin(phi1) + B * math.sin(phi2)
-                phi = math.atan2(z, math.sqrt(x_val * x_val + y_val * y_val))
-                lambda_ = math.atan2(y_val, x_val)
-                lat_ = math.degrees(phi)
-                lon_ = math.degrees(lambda_)
-                pts.append((raw_exp_lon_to_x(lon_), exp_lat_to_y(lat_)))
-            # 調整：連続性が保たれるよう、隣接点間の差が scaled_width/2 以上なら scaled_width を加減
-            adjusted = [pts[0]]
-            for p in pts[1:]:
-                prev_x = adjusted[-1][0]
-                x, y = p
-                while x - prev_x > scaled_width / 2:
-                    x -= scaled_width
-                while x - prev_x < -scaled_width / 2:
-                    x += scaled_width
-                adjusted.append((x, y))
-            return adjusted
-
-        # 大圏航路描画
-        if self.gc_route_mode != 0 and self.current_pin:
-            for pin in self.pins:
-                if pin == self.current_pin:
-                    continue
-                pts = get_raw_export_gc_points(self.current_pin["lat"], self.current_pin["lon"],
-                                            pin["lat"], pin["lon"])
-                # 中央コピー：そのまま描画
-                draw.line(pts, fill="blue", width=1)
-                # タイリング：線が出口している側に対して、出力画像幅分だけシフトしたコピーを描画
-                xs = [x for (x, _) in pts]
-                if min(xs) < 0:
-                    pts_copy = [(x + scaled_width, y) for (x, y) in pts]
-                    draw.line(pts_copy, fill="blue", width=1)
-                if max(xs) > scaled_width:
-                    pts_copy = [(x - scaled_width, y) for (x, y) in pts]
-                    draw.line(pts_copy, fill="blue", width=1)
-
-        # ピン描画（キャンバスと同じ計算、タイル処理）
-        fixed_font = self.font.font_variant(size=14)
-        for pin in self.pins:
-            rel = (pin["lon"] - LON_MIN) / (LON_MAX - LON_MIN)
-            x_eff = (rel * self.eff_width + self.offset_x) % self.eff_width
-            y_eff = ((LAT_MAX - pin["lat"]) / (LAT_MAX - LAT_MIN)) * self.eff_height
-            x_scaled = int(x_eff * multiplier)
-            y_scaled = int(y_eff * multiplier)
-            pts = [(x_scaled - 3, y_scaled - 4), (x_scaled + 3, y_scaled - 4), (x_scaled, y_scaled)]
-            draw.polygon(pts, fill="black")
-            pin_color = pin.get("color", DEFAULT_PIN_COLOR)
-            draw.text((x_scaled, y_scaled - 8), pin["name"],
-                    fill=pin_color, font=fixed_font, anchor="mb")
-
-        return img
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+            # 出力の大きさに合う段のタイルから作る（表示用の縮小画像を拡大しない）
+            background = self.bg_pyramid if self.bg_pyramid is not None else self.bg_image_original
+
+        # 大圏航路（ラップせず「生の」座標で求め、はみ出した側のコピーは帯ごとに描く）
+        routes = None
+        if self.gc_route_mode != 0 and self.current_pin_id is not None:
+            dest_ids, u, v = self.route_cache.get_routes(self.pins, self.current_pin_id)
+            if dest_ids:
+                routes = (u.copy(), v.copy())
+        return dict(store=self.pins.copy(), eff_width=self.eff_width, eff_height=self.eff_height,
+                    multiplier=multiplier, font=self.font.font_variant(size=EXPORT_FONT_SIZE), offset_x=offset_x,
+                    background=background, bg_alpha=self.bg_alpha_level(), routes=routes,
+                    selected_id=self.current_pin_id)
 
     def export_image(self):
-        img = self.generate_map_image()
-        save_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG Files", "*.png")])
-        if save_path:
-            img.save(save_path)
+        # 保存先を先に決め、ラベル配置と描画・保存はワーカースレッドで行う（進み具合はキュー経由で受け取る）
+        if self.export_cancel is not None:
+            return
+        save_path = filedialog.asksaveasfilename(defaultextension=".png",
+                                                 filetypes=[("PNG Files", "*.png"), ("TIFF Files", "*.tif;*.tiff")])
+        if not save_path:
+            return
+        settings = self.export_settings()
+        self.start_export(lambda: MapExport.from_store(**settings),
+                          lambda export, progress, cancelled: export.save(save_path, progress, cancelled=cancelled))
+
+    def export_tiles(self):
+        # Web 地図用の z/x/y タイルを選んだフォルダに書き出す（前回と同じタイルは書き直さない）
+        if self.export_cancel is not None:
+            return
+        out_dir = filedialog.askdirectory(title="タイルの出力先フォルダ")
+        if not out_dir:
+            return
+        max_zoom = simpledialog.askinteger("タイル生成", "最大ズーム（0～10）", initialvalue=4, minvalue=0, maxvalue=10)
+        if max_zoom is None:
+            return
+        settings = self.export_settings()
+        for key in ("eff_width", "eff_height", "multiplier", "offset_x"):
+            del settings[key]  # タイルはズームごとの大きさで、横方向のずれなしで描く
+        self.start_export(lambda: TileExport.from_store(out_dir, max_zoom=max_zoom, **settings),
+                          lambda export, progress, cancelled: export.save(progress, cancelled=cancelled))
+
+    def start_export(self, make, save):
+        # make() で書き出す内容を作り、save(内容, progress, cancelled) で書く。どちらもワーカースレッドで行う
+        cancel = threading.Event()
+        results = queue.Queue()
+        self.export_cancel = cancel
+        self.export_queue = results
+
+        def worker():
+            try:
+                results.put(("stage", "ラベルを配置中…"))
+                export = make()
+                if cancel.is_set():
+                    results.put(("cancelled",))
+                    return
+                results.put(("stage", "背景・大圏航路・ピンを描画中… 0%"))
+                done = save(export, lambda done, total: results.put(("progress", done, total)), cancel.is_set)
+                results.put(("done",) if done else ("cancelled",))
+            except Exception as e:
+                results.put(("error", e))
+
+        self.export_button.config(state="disabled")
+        self.tiles_button.config(state="disabled")
+        self.export_status_label.config(text="画像の書き出しを準備中…")
+        self.export_status_label.pack(side=tk.LEFT, padx=5, after=self.tiles_button)
+        self.export_cancel_button.pack(side=tk.LEFT, padx=5, after=self.export_status_label)
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(100, self.poll_export)
+
+    def poll_export(self):
+        message = None
+        try:
+            while True:
+                message = self.export_queue.get_nowait()
+                if message[0] not in ("stage", "progress"):
+                    break
+                if self.export_cancel.is_set():
+                    continue  # 中止を受け付けた後は「中止しています」のまま
+                if message[0] == "stage":
+                    self.export_status_label.config(text=message[1])
+                else:
+                    self.export_status_label.config(
+                        text=f"背景・大圏航路・ピンを描画中… {message[1] * 100 // message[2]}%")
+        except queue.Empty:
+            pass
+        if message is None or message[0] in ("stage", "progress"):
+            self.root.after(100, self.poll_export)
+            return
+        self.export_cancel = None
+        self.export_queue = None
+        if self.close_after_export:
+            self.root.destroy()
+            return
+        self.export_button.config(state="normal")
+        self.tiles_button.config(state="normal")
+        self.export_status_label.pack_forget()
+        self.export_cancel_button.pack_forget()
+        if message[0] == "error":
+            messagebox.showerror("エラー", f"画像の書き出しに失敗しました: {message[1]}")
+
+    def cancel_export(self):
+        if self.export_cancel is not None:
+            self.export_cancel.set()
+            self.export_status_label.config(text="書き出しを中止しています…")
 
     def set_bg_image(self):
         file_path = filedialog.askopenfilename(filetypes=[("画像ファイル", "*.png;*.jpg;*.jpeg;*.bmp"), ("All Files", "*.*")])
         if not file_path:
             return
-        try:
-            img = Image.open(file_path).convert("RGB")
-            img_resized = img.resize((self.eff_width, self.eff_height), Image.LANCZOS)
-            folder = self.map_name_entry.get().strip() or "my_map"
+        folder = self.map_name_entry.get().strip() or "my_map"
+        self.bg_load_token += 1  # 読み込み中の背景画像があれば破棄
+        token = self.bg_load_token
+
+        def work():
+            # 元の解像度のままタイルピラミッドにする（大きな画像でも画面は止まらない）
             os.makedirs(folder, exist_ok=True)
-            save_bg = os.path.join(folder, "map.png")
-            img_resized.save(save_bg)
-            self.bg_image_original = img_resized
-            self.update_bg_image_with_alpha()
-            self.draw_map()
-        except Exception as e:
-            messagebox.showerror("エラー", f"背景画像の読み込みに失敗しました: {e}")
+            with Image.open(file_path) as img:
+                TilePyramid.build(folder, img.convert("RGB"))
+            # 背景の正本はタイルピラミッドなので、以前に取り込んだ map.png は古くなる。選んだ画像そのものでなければ消す
+            source = os.path.join(folder, BG_SOURCE_FILE)
+            if os.path.exists(source) and not os.path.samefile(source, file_path):
+                os.remove(source)
+            return self.read_background(folder)
+
+        def done(ok, value):
+            if token != self.bg_load_token:
+                return
+            self.load_status_label.config(text="")
+            if not ok:
+                messagebox.showerror("エラー", f"背景画像の読み込みに失敗しました: {value}")
+                return
+            self.set_background(*value)
+        self.load_status_label.config(text="背景画像を取り込み中…")
+        self.run_in_background(work, done)
+
+    def read_background(self, folder):
+        # (TilePyramid, キャンバス用の縮小画像) を返す。背景画像がなければ (None, None)
+        pyramid = TilePyramid.ensure(folder)
+        if pyramid is None:
+            return None, None
+        return pyramid, pyramid.read_scaled(self.eff_width, self.eff_height)
+
+    def set_background(self, pyramid, image):
+        self.bg_pyramid = pyramid
+        self.bg_image_original = image
+        self.bg_image = None
+        self.request_redraw("background")
 
     def load_bg_image_from_folder(self):
+        self.bg_load_token += 1  # 読み込み中の背景画像があれば破棄
         # マップ名欄に入力されている内容をフォルダ名として使用
         folder = self.map_name_entry.get().strip() or "my_map"
-        save_bg = os.path.join(folder, "map.png")
-        if os.path.exists(save_bg):
+        try:
+            self.set_background(*self.read_background(folder))
+        except Exception as e:
+            messagebox.showerror("エラー", f"背景画像の読み込みに失敗しました: {e}")
+            self.set_background(None, None)
+
+    def load_bg_image_async(self, on_loaded=None):
+        # タイルピラミッドの準備（必要なら map.png から作成）と縮小をワーカースレッドで行う
+        # （on_loaded にはかかった秒数を渡す）
+        folder = self.map_name_entry.get().strip() or "my_map"
+        self.bg_load_token += 1
+        token = self.bg_load_token
+        started = time.perf_counter()
+
+        def done(ok, value):
+            if token != self.bg_load_token:
+                return  # 読み込み中に別のマップへ切り替わった
+            if not ok:
+                messagebox.showerror("エラー", f"背景画像の読み込みに失敗しました: {value}")
+                value = (None, None)
+            self.set_background(*value)
+            if on_loaded:
+                on_loaded(time.perf_counter() - started)
+        self.run_in_background(lambda: self.read_background(folder), done)
+
+    def run_in_background(self, work, on_done):
+        # work() をワーカースレッドで実行し、(成功したか, 戻り値または例外) を Tk のスレッドで on_done に渡す
+        results = queue.Queue()
+
+        def worker():
             try:
-                img = Image.open(save_bg).convert("RGB")
-                # キャンバスサイズに合わせてリサイズ
-                self.bg_image_original = img.resize((self.eff_width, self.eff_height), Image.LANCZOS)
-                self.update_bg_image_with_alpha()
+                results.put((True, work()))
             except Exception as e:
-                messagebox.showerror("エラー", f"背景画像の読み込みに失敗しました: {e}")
-        else:
-            # 背景画像が存在しない場合は変数をクリア
-            self.bg_image_original = None
-            self.bg_image = None
+                results.put((False, e))
+
+        def poll():
+            try:
+                ok, value = results.get_nowait()
+            except queue.Empty:
+                self.root.after(50, poll)
+                return
+            on_done(ok, value)
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(50, poll)
 
     def clear_bg_image(self):
         folder = self.map_name_entry.get().strip() or "my_map"
-        save_bg = os.path.join(folder, "map.png")
+        save_bg = os.path.join(folder, BG_SOURCE_FILE)
         if os.path.exists(save_bg):
             try:
                 os.remove(save_bg)
             except Exception as e:
                 messagebox.showerror("エラー", f"背景画像の削除に失敗しました: {e}")
-        self.bg_image_original = None
-        self.bg_image = None
-        self.draw_map()
+        TilePyramid.remove(folder)
+        self.bg_load_token += 1
+        self.set_background(None, None)
 
     def create_new_map(self):
         new_map_name = simpledialog.askstring("新しいマップ", "新しいマップ名を入力してください")
         if new_map_name:
             self.map_name_entry.delete(0, tk.END)
             self.map_name_entry.insert(0, new_map_name)
-            self.pins.clear()
-            self.offset_x = 0
+            self.replace_pins([], [], [], [], [])
+            self.viewport.restore(1.0, 0, 0)
+            self.update_zoom_label()
+            self.bg_load_token += 1
+            self.bg_pyramid = None
             self.bg_image_original = None
             self.bg_image = None
             self.current_file = ""
@@ -824,7 +2247,6 @@ class MapMakerApp:
     def export_azimuthal_map(self):
         import pandas as pd
         import matplotlib.pyplot as plt
-        import matplotlib.image as mpimg
         import cartopy.crs as ccrs
         import matplotlib.font_manager as fm
         import numpy as np
@@ -832,16 +2254,15 @@ class MapMakerApp:
         jp_font = fm.FontProperties(family="Meiryo", size=8)
 
         # 選択中のピンがない場合はエラー表示
-        if not self.current_pin:
+        if self.current_pin_id is None:
             messagebox.showerror("エラー", "正距方位図法で生成するためにはピンを選択してください")
             return
 
         # 選択中のピンの座標を中心とする
-        central_lat = self.current_pin["lat"]
-        central_lon = self.current_pin["lon"]
+        central_lat, central_lon = self.pins.lat_lon(self.current_pin_id)
 
-        # self.pins リストから DataFrame を作成
-        df = pd.DataFrame(self.pins)
+        # PinStore から DataFrame を作成
+        df = pd.DataFrame(self.pins.to_dicts())
 
         # 正距方位図法の投影設定
         proj = ccrs.AzimuthalEquidistant(central_longitude=central_lon, central_latitude=central_lat)
@@ -850,12 +2271,11 @@ class MapMakerApp:
         ax.gridlines(draw_labels=True)
 
         # マップフォルダ内の背景画像ファイルを指定（例："map.png"）
-        folder = self.map_name_entry.get().strip() or "my_map"
-        img_path = os.path.join(folder, "map.png")
-        try:
-            img = mpimg.imread(img_path)
-        except FileNotFoundError:
-            print(f"背景画像 {img_path} が見つかりません")
+        # 背景はタイルピラミッドから図に見合う大きさ（2048x1024）で取り出す
+        if self.bg_pyramid is not None:
+            img = np.asarray(self.bg_pyramid.read_scaled(2048, 1024))
+        else:
+            self.load_status_label.config(text="背景画像がないため、正距方位図は白地で描きます")
             # ダミーの白い画像を生成（720x1440ピクセル、RGB）
             img = np.ones((720, 1440, 3), dtype=np.uint8) * 255
 
@@ -879,16 +2299,16 @@ class MapMakerApp:
         self.paint_color = color
     def open_bg_paint_tool(self):
         import os
-        from PIL import ImageDraw, ImageEnhance
+        from PIL import ImageDraw
 
         folder = self.map_name_entry.get().strip() or "my_map"
-        map_path = os.path.join(folder, "map.png")
+        # 元の解像度の画像は開かず、画面に合う段のタイルから作った縮小画像の上で編集する
         try:
-            if os.path.exists(map_path):
-                base_img = Image.open(map_path).convert("RGB")
-                edit_img = base_img.copy()
+            if self.bg_pyramid is not None:
+                base_img = self.bg_pyramid.read_scaled(self.eff_width, self.eff_height)
             else:
-                edit_img = Image.new("RGB", (self.eff_width, self.eff_height), "white")
+                base_img = Image.new("RGB", (self.eff_width, self.eff_height), "white")
+            edit_img = base_img.copy()
         except Exception as e:
             messagebox.showerror("エラー", f"背景画像の読み込みに失敗しました: {e}")
             return
@@ -1010,6 +2430,74 @@ class MapMakerApp:
         self.paint_last_x = None
         self.paint_last_y = None
 
+        # 基本パラメータ
+        W = self.paint_img.width
+        H = self.paint_img.height
+
+        # 中央コピーでの座標変換（元画像[0,W]を中央部分に配置）
+        def conv_lon_to_x_base(lon):
+            original_x = (lon - LON_MIN) / (LON_MAX - LON_MIN) * W
+            return int(ext + self.paint_eff_offset + original_x)
+        def conv_lat_to_y(lat):
+            original_y = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * H
+            return int(original_y)
+
+        # ラベルの配置は元画像の座標で決め、各コピー・各描画で同じものを使う。ツールは非モーダルなので、
+        # メイン画面でピンや選択が変わったときだけ置き直す
+        label_font = self.font.font_variant(size=12)
+        layout_cache = {}  # (ピンの version, 選択中のピンID) -> ([(緯度, 経度, 名前)], [ラベル])
+
+        def pin_layout():
+            key = (self.pins.version, self.current_pin_id)
+            if key not in layout_cache:
+                pin_ids = self.pins.ids.tolist()
+                points = [(lat, lon, self.pins.get(pin_id).name)
+                          for pin_id, lat, lon in zip(pin_ids, self.pins.lat.tolist(), self.pins.lon.tolist())]
+                labels = LabelLayout(lambda text: pil_text_size(label_font, text), 5, W,
+                                     self.pins, lambda: self.current_pin_id)
+                labels.set_pins(pin_ids, ((self.pins.lon - LON_MIN) / (LON_MAX - LON_MIN) * W).tolist(),
+                                [conv_lat_to_y(lat) for lat, _, _ in points], [name for _, _, name in points])
+                layout_cache.clear()
+                layout_cache[key] = (points, [labels.label(pin_id) for pin_id in pin_ids])
+            return key, layout_cache[key]
+        overlay_cache = {}  # (ピンの配置, 横のずれ, ピン透明度) -> グリッド・ピンのオーバーレイ
+
+        def pin_overlay(size, pins_alpha):
+            # グリッドとピンは、ピン・選択・横スクロール・ピン透明度のどれかが変わったときだけ描き直す
+            layout_key, (pin_points, pin_labels) = pin_layout()
+            key = (layout_key, self.paint_eff_offset, pins_alpha)
+            if key in overlay_cache:
+                return overlay_cache[key]
+            overlay_cache.clear()
+            overlay = Image.new("RGBA", size, (0, 0, 0, 0))
+            draw = ImageDraw.Draw(overlay)
+            # 横方向に−1,0,1コピー分描画
+            for copy in [-1, 0, 1]:
+                # 経度グリッド：各コピーで位置ずらして描画
+                for lon in range(-180, 181, 30):
+                    x = conv_lon_to_x_base(lon) + copy * W
+                    # 描画範囲内の場合のみ描画
+                    if 0 <= x <= size[0]:
+                        draw.line([(x, 0), (x, H)], fill=(128, 128, 128, int(255 * pins_alpha)))
+                # ピン描画
+                for (lat, lon, name), label in zip(pin_points, pin_labels):
+                    x = conv_lon_to_x_base(lon) + copy * W
+                    y = conv_lat_to_y(lat)
+                    pts = [(x - 3, y - 4), (x + 3, y - 4), (x, y)]
+                    draw.polygon(pts, fill=(0, 0, 0, int(255 * pins_alpha)))
+                    # 小さめフォント。重なって置けないラベルは描かない
+                    if label:
+                        anchor, dx, dy = label
+                        draw.text((x + dx, y + dy), name,
+                                  fill=(0, 0, 0, int(255 * pins_alpha)),
+                                  font=label_font, anchor=LabelLayout.PIL_ANCHORS[anchor])
+            # 横方向の緯度グリッド（水平線）は全体横断
+            for lat in range(LAT_MIN, LAT_MAX + 1, 15):
+                y = conv_lat_to_y(lat)
+                draw.line([(0, y), (size[0], y)], fill=(128, 128, 128, int(255 * pins_alpha)))
+            overlay_cache[key] = overlay
+            return overlay
+
         # update_paint_preview()：背景画像に透明度を適用し、タイリング＋グリッド・ピンオーバーレイを合成
         def update_paint_preview():
             offset_x = self.paint_offset_x_var.get()
@@ -1026,55 +2514,15 @@ class MapMakerApp:
 
             # タイル画像再作成（背景は create_tiled_image() で生成済み）
             tiled = create_tiled_image(offset_x, base_img)
-
-            # オーバーレイ用透明レイヤー作成
-            overlay = Image.new("RGBA", tiled.size, (0, 0, 0, 0))
-            draw = ImageDraw.Draw(overlay)
-
-            # 基本パラメータ
-            W = self.paint_img.width
-            H = self.paint_img.height
-            ext = self.paint_ext
-
-            # 中央コピーでの座標変換（元画像[0,W]を中央部分に配置）
-            def conv_lon_to_x_base(lon):
-                original_x = (lon - LON_MIN) / (LON_MAX - LON_MIN) * W
-                return int(ext + self.paint_eff_offset + original_x)
-            def conv_lat_to_y(lat):
-                original_y = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * H
-                return int(original_y)
-
-            # 横方向に−1,0,1コピー分描画
-            for copy in [-1, 0, 1]:
-                # 経度グリッド：各コピーで位置ずらして描画
-                for lon in range(-180, 181, 30):
-                    x = conv_lon_to_x_base(lon) + copy * W
-                    # 描画範囲内の場合のみ描画
-                    if 0 <= x <= tiled.width:
-                        draw.line([(x, 0), (x, H)], fill=(128, 128, 128, int(255 * pins_alpha)))
-                # ピン描画
-                for pin in self.pins:
-                    x = conv_lon_to_x_base(pin["lon"]) + copy * W
-                    y = conv_lat_to_y(pin["lat"])
-                    pts = [(x - 3, y - 4), (x + 3, y - 4), (x, y)]
-                    draw.polygon(pts, fill=(0, 0, 0, int(255 * pins_alpha)))
-                    # 小さめフォント・下端中央揃え：anchor "ms"（middle, bottom）
-                    draw.text((x, y - 5), pin["name"],
-                              fill=(0, 0, 0, int(255 * pins_alpha)),
-                              font=self.font.font_variant(size=12),
-                              anchor="ms")
-            # 横方向の緯度グリッド（水平線）は全体横断
-            for lat in range(LAT_MIN, LAT_MAX + 1, 15):
-                y = conv_lat_to_y(lat)
-                draw.line([(0, y), (tiled.width, y)], fill=(128, 128, 128, int(255 * pins_alpha)))
-            
-            composed = Image.alpha_composite(tiled, overlay)
+            composed = Image.alpha_composite(tiled, pin_overlay(tiled.size, pins_alpha))
             self.paint_canvas_img = ImageTk.PhotoImage(composed)
             paint_canvas.delete("all")
             paint_canvas.create_image(0, 0, anchor="nw", image=self.paint_canvas_img)
 
 
         update_paint_preview()
+        # メイン画面で編集してから戻ってきたときに、ピンのオーバーレイを最新にする
+        paint_win.bind("<FocusIn>", lambda e: update_paint_preview() if e.widget is paint_win else None)
 
         # 描画イベント（ペイント処理）
         def paint_start(event):
@@ -1149,10 +2597,18 @@ class MapMakerApp:
         def save_paint():
             try:
                 os.makedirs(folder, exist_ok=True)
-                save_path = os.path.join(folder, "map.png")
-                self.paint_img.convert("RGB").save(save_path)
-                self.bg_image_original = self.paint_img.copy()
-                self.draw_map()
+                painted = self.paint_img.convert("RGB")
+                if self.bg_pyramid is not None:
+                    # 描いた画素だけを元の解像度のタイルへ合成する
+                    diff = np.asarray(ImageChops.difference(base_img, painted)).max(axis=2)
+                    mask = Image.fromarray(np.where(diff > 0, 255, 0).astype(np.uint8), "L")
+                    self.bg_pyramid.apply_edit(painted, mask)
+                    pyramid = self.bg_pyramid
+                else:
+                    TilePyramid.build(folder, painted)
+                    pyramid = TilePyramid(folder)
+                self.bg_load_token += 1
+                self.set_background(pyramid, painted)
                 paint_win.destroy()
             except Exception as e:
                 messagebox.showerror("エラー", f"保存に失敗しました: {e}")
@@ -1165,57 +2621,19 @@ class MapMakerApp:
 
 # 大圏航路表示
 
+    def toggle_cluster_mode(self):
+        self.cluster_mode = not self.cluster_mode
+        self.cluster_button.config(text="クラスタ表示: " + ("有効" if self.cluster_mode else "無効"))
+        self.scene.invalidate()
+        self.request_redraw()
+
     def toggle_gc_route(self):
         # モードは0: 表示無効、1: 表示有効 の2モードに変更
         self.gc_route_mode = (self.gc_route_mode + 1) % 2
         mode_text = ["無効", "有効"]
         self.gc_route_button.config(text="大圏航路表示: " + mode_text[self.gc_route_mode])
-        self.draw_map()
-
-
+        self.request_redraw("routes")
 
-    # キャンバス上の「生の」座標を返す関数（タイリング前）
-    def lon_to_x_raw(self, lon):
-        relative = (lon - LON_MIN) / (LON_MAX - LON_MIN)
-        return self.margin_left + relative * self.eff_width + self.offset_x
-
-    def lat_to_y_raw(self, lat):
-        relative = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN)
-        return self.margin_top + relative * self.eff_height
-
-    def get_gc_points_raw(self, lat1, lon1, lat2, lon2, n=100):
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        lambda1 = math.radians(lon1)
-        lambda2 = math.radians(lon2)
-        delta = 2 * math.asin(math.sqrt(math.sin((phi2 - phi1) / 2) ** 2 +
-                                        math.cos(phi1) * math.cos(phi2) * math.sin((lambda2 - lambda1) / 2) ** 2))
-        if delta == 0:
-            return [(self.lon_to_x_raw(lon1), self.lat_to_y_raw(lat1))] * (n + 1)
-        pts = []
-        for i in range(n + 1):
-            f = i / n
-            A = math.sin((1 - f) * delta) / math.sin(delta)
-            B = math.sin(f * delta) / math.sin(delta)
-            x = A * math.cos(phi1) * math.cos(lambda1) + B * math.cos(phi2) * math.cos(lambda2)
-            y = A * math.cos(phi1) * math.sin(lambda1) + B * math.cos(phi2) * math.sin(lambda2)
-            z = A * math.sin(phi1) + B * math.sin(phi2)
-            phi = math.atan2(z, math.sqrt(x * x + y * y))
-            lambda_ = math.atan2(y, x)
-            lat = math.degrees(phi)
-            lon = math.degrees(lambda_)
-            pts.append((self.lon_to_x_raw(lon), self.lat_to_y_raw(lat)))
-        # 補正処理（連続性のため）
-        adjusted = [pts[0]]
-        for p in pts[1:]:
-            prev_x = adjusted[-1][0]
-            x, y = p
-            while x - prev_x > self.eff_width / 2:
-                x -= self.eff_width
-            while x - prev_x < -self.eff_width / 2:
-                x += self.eff_width
-            adjusted.append((x, y))
-        return adjusted
 
 
 
@@ -0,0 +1,60 @@
+# 画像書き出し（帯ごとの描画）がワーカー数に応じてどれだけ速くなるかを測るベンチマーク
+# 使い方: python bench_export.py [--multiplier 10] [--pins 20000] [--workers 1 2 4 8] [--folder マップフォルダ] [--tiff]
+# --folder を省くと、乱数の背景画像とピンを一時フォルダに作って使う。
+import argparse, os, tempfile, time
+import numpy as np
+from PIL import Image
+import locaindex_render as lm
+
+def sample_store(count, seed=0):
+    rng = np.random.default_rng(seed)
+    store = lm.PinStore()
+    store.extend(rng.uniform(-80, 80, count).tolist(), rng.uniform(-180, 180, count).tolist(),
+                 [f"pin{i}" for i in range(count)], [""] * count, rng.choice(lm.PIN_COLORS, count).tolist())
+    return store
+
+def sample_background(folder, seed=0):
+    # 滑らかな模様に細かい乱数を重ねた 4096x2048 の背景（圧縮が効きすぎないように）
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:2048, 0:4096]
+    base = np.stack([x / 16, y / 8, (x + y) / 24], axis=-1) % 256
+    noise = rng.integers(0, 24, base.shape)
+    lm.TilePyramid.build(folder, Image.fromarray((base + noise).clip(0, 255).astype(np.uint8)))
+    return lm.TilePyramid(folder)
+
+def main():
+    parser = argparse.ArgumentParser(description="画像書き出しの並列化ベンチマーク")
+    parser.add_argument("--multiplier", type=int, default=10, help="出力の倍率（既定 10）")
+    parser.add_argument("--pins", type=int, default=20000, help="乱数で作るピンの数（--folder 指定時は使わない）")
+    parser.add_argument("--workers", type=int, nargs="+", help="試すワーカー数（既定は 1 から CPU 数まで倍々）")
+    parser.add_argument("--folder", help="既存のマップフォルダ（pins.csv / pins.sqlite と背景タイル）")
+    parser.add_argument("--tiff", action="store_true", help="PNG ではなく TIFF で書き出す")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    workers = args.workers or sorted({1, cpus} | {2 ** k for k in range(1, cpus.bit_length()) if 2 ** k <= cpus})
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.folder:
+            store = lm.load_map_pins(args.folder)
+            background = lm.map_background(args.folder)["background"]
+        else:
+            store = sample_store(args.pins)
+            background = sample_background(tmp)
+        export = lm.MapExport.from_store(store, lm.MAP_WIDTH, lm.MAP_HEIGHT, args.multiplier, lm.load_font(), background=background)
+        out = os.path.join(tmp, "bench.tif" if args.tiff else "bench.png")
+        pixels = export.width * export.height
+        print(f"出力 {export.width}x{export.height}（{pixels / 1e6:.1f} Mpx）、帯 {len(export.strip_ranges())} 本、"
+              f"ピン {len(store)} 件、CPU {cpus}")
+        if max(workers) > cpus:
+            print(f"注意: CPU が {cpus} 個しかないため、{cpus} を超えるワーカー数の結果は並列化の効果を表しません")
+        print(f"{'workers':>8} {'sec':>8} {'Mpx/s':>8} {'speedup':>8}")
+        baseline = None
+        for n in workers:
+            t0 = time.perf_counter()
+            export.save(out, workers=n)
+            seconds = time.perf_counter() - t0
+            baseline = baseline or seconds
+            print(f"{n:>8} {seconds:>8.2f} {pixels / 1e6 / seconds:>8.2f} {baseline / seconds:>8.2f}")
+
+if __name__ == "__main__":
+    main()
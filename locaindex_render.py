@@ -0,0 +1,1660 @@
+# LocaIndex_Manager の地図モデル・投影・画像出力（Tk を使わない部分）
+# GUI（LocaIndex_Manager.py）から使うほか、画面なしで複数のマップフォルダを PNG にできる:
+#   python locaindex_render.py マップフォルダ [マップフォルダ ...] [-o 出力フォルダ] [-m 倍率] [-j ワーカー数]
+#   python locaindex_render.py マップフォルダ --tiles [--max-zoom 5]   （Web 地図用の z/x/y タイル）
+import csv, os, math, json, bisect, hashlib, threading, sqlite3, shutil, struct, zlib, argparse, time, sys, pathlib
+from PIL import Image, ImageDraw, ImageFont
+from io import BytesIO
+import numpy as np
+
+# 定数（緯度は -90～90、経度は -180～180）
+LAT_MIN, LAT_MAX = -90, 90
+LON_MIN, LON_MAX = -180, 180
+
+PINS_FILE = "pins.csv"
+PIN_CACHE_FILE = "pins.cache.npz"  # pins.csv の列形式キャッシュ
+PIN_JOURNAL_FILE = "pins.journal"  # pins.csv に対する変更の追記ログ
+PINS_DB_FILE = "pins.sqlite"  # SQLite で保存する場合のピンファイル
+SETTINGS_FILE = "settings.json"  # マップごとの設定（背景の透明度・星の直径）
+BG_SOURCE_FILE = "map.png"   # 背景画像（タイルピラミッドの取り込み元）
+BG_TILES_DIR = "bg_tiles"    # 背景画像のタイルピラミッド
+PIN_CACHE_VERSION = 1
+PIN_CSV_FIELDS = ["lat", "lon", "name", "remark", "color"]
+DEFAULT_FONT_PATH = "meiryo.ttc"  # デフォルトフォントパス
+DEFAULT_PIN_COLOR = "blue"         # デフォルトピンの色
+PIN_COLORS = ["black", "red", "blue", "green", "yellow", "purple", "orange"]
+LABEL_COLOR_PRIORITY = PIN_COLORS  # ラベルが重なるとき、先にある色のピンのラベルを優先して表示する
+MAP_WIDTH, MAP_HEIGHT = 1120, 670  # 倍率1の地図の大きさ（GUI のキャンバスの描画領域と同じ）
+EXPORT_FONT_SIZE = 14              # 画像出力のラベルの文字の大きさ
+
+# --- ピンの格納（列指向） ---
+# ピンは変わらない整数 ID で識別する。緯度・経度は NumPy の列として持ち、
+# 名前・備考・色は __slots__ の小さなレコードに入れる。名前順の索引は追加・変更・削除のたびに更新する。
+# キャンバス・画像出力・ペイントツール・保存読込みはすべてこのクラスを通してピンを扱う。
+class Pin:
+    __slots__ = ("id", "name", "remark", "color")
+
+    def __init__(self, pin_id, name, remark, color):
+        self.id = pin_id
+        self.name = name
+        self.remark = remark
+        self.color = color
+
+class PinStore:
+    def __init__(self):
+        self.next_id = 1
+        self.count = 0
+        self._lat = np.empty(0)
+        self._lon = np.empty(0)
+        self._ids = np.empty(0, dtype=np.int64)
+        self.rows = {}        # ID -> 列の行番号
+        self.records = {}     # ID -> Pin
+        self.name_index = []  # (名前, ID) の昇順リスト
+        self.sorted_cache = None
+        self.rank_cache = None
+        self.version = 0      # 何か変わるたびに増える
+        self.geo_version = 0  # ピンの増減・移動があったときだけ増える
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pin_id):
+        return pin_id in self.rows
+
+    # 有効な行だけの列（ビュー）
+    @property
+    def lat(self):
+        return self._lat[:self.count]
+
+    @property
+    def lon(self):
+        return self._lon[:self.count]
+
+    @property
+    def ids(self):
+        return self._ids[:self.count]
+
+    def get(self, pin_id):
+        return self.records[pin_id]
+
+    def lat_lon(self, pin_id):
+        row = self.rows[pin_id]
+        return float(self._lat[row]), float(self._lon[row])
+
+    def rows_of(self, pin_ids):
+        return np.fromiter((self.rows[pin_id] for pin_id in pin_ids), dtype=np.int64, count=len(pin_ids))
+
+    def sorted_ids(self):
+        # 名前順（同名は登録順）の ID 一覧
+        if self.sorted_cache is None:
+            self.sorted_cache = [pin_id for _, pin_id in self.name_index]
+        return self.sorted_cache
+
+    def sort_by_name(self, pin_ids, limit=None):
+        # ピンIDの集まりを名前順に並べる（ID -> 名前順の順位 の表を引いて並べ替える）
+        # limit を指定すると名前順で先頭の limit 件だけを返す（残りは並べ替えない）
+        if self.rank_cache is None:
+            order = np.fromiter(self.sorted_ids(), dtype=np.int64, count=self.count)
+            self.rank_cache = np.zeros(self.next_id, dtype=np.int64)
+            self.rank_cache[order] = np.arange(self.count)
+        if isinstance(pin_ids, np.ndarray):
+            ids = pin_ids.astype(np.int64, copy=False)
+        else:
+            ids = np.fromiter(pin_ids, dtype=np.int64, count=len(pin_ids))
+        ranks = self.rank_cache[ids]
+        if limit is not None and len(ids) > limit:
+            head = np.argpartition(ranks, limit)[:limit]
+            ids, ranks = ids[head], ranks[head]
+        return ids[np.argsort(ranks, kind="stable")].tolist()
+
+    def touch(self, geo):
+        self.version += 1
+        if geo:
+            self.geo_version += 1
+
+    def reserve(self, extra):
+        need = self.count + extra
+        if need > len(self._lat):
+            capacity = max(need, 2 * len(self._lat), 16)
+            for attr in ("_lat", "_lon", "_ids"):
+                old = getattr(self, attr)
+                new = np.empty(capacity, dtype=old.dtype)
+                new[:self.count] = old[:self.count]
+                setattr(self, attr, new)
+
+    def add(self, lat, lon, name, remark="", color=DEFAULT_PIN_COLOR):
+        return self.extend([lat], [lon], [name], [remark], [color])[0]
+
+    def extend(self, lats, lons, names, remarks, colors):
+        # まとめて追加（読み込み時用）。追加したピンの ID 一覧を返す
+        n = len(names)
+        self.reserve(n)
+        start = self.count
+        new_ids = list(range(self.next_id, self.next_id + n))
+        self.next_id += n
+        self._lat[start:start + n] = lats
+        self._lon[start:start + n] = lons
+        self._ids[start:start + n] = new_ids
+        for row, pin_id, name, remark, color in zip(range(start, start + n), new_ids, names, remarks, colors):
+            self.rows[pin_id] = row
+            self.records[pin_id] = Pin(pin_id, name, remark, color)
+        self.count += n
+        if n == 1:
+            bisect.insort(self.name_index, (names[0], new_ids[0]))
+        else:
+            self.name_index.extend(zip(names, new_ids))
+            self.name_index.sort()
+        self.sorted_cache = None
+        self.rank_cache = None
+        self.touch(geo=True)
+        return new_ids
+
+    def update(self, pin_id, lat, lon, name, remark, color):
+        # 位置が変わった場合は True を返す
+        row = self.rows[pin_id]
+        record = self.records[pin_id]
+        moved = (float(self._lat[row]), float(self._lon[row])) != (lat, lon)
+        self._lat[row] = lat
+        self._lon[row] = lon
+        if record.name != name:
+            del self.name_index[bisect.bisect_left(self.name_index, (record.name, pin_id))]
+            bisect.insort(self.name_index, (name, pin_id))
+            self.sorted_cache = None
+            self.rank_cache = None
+        record.name = name
+        record.remark = remark
+        record.color = color
+        self.touch(geo=moved)
+        return moved
+
+    def remove(self, pin_id):
+        # 最終行を空いた行へ移して詰める
+        row = self.rows.pop(pin_id)
+        record = self.records.pop(pin_id)
+        last = self.count - 1
+        if row != last:
+            moved_id = int(self._ids[last])
+            self._lat[row] = self._lat[last]
+            self._lon[row] = self._lon[last]
+            self._ids[row] = moved_id
+            self.rows[moved_id] = row
+        self.count -= 1
+        del self.name_index[bisect.bisect_left(self.name_index, (record.name, pin_id))]
+        self.sorted_cache = None
+        self.rank_cache = None
+        self.touch(geo=True)
+
+    def clear(self):
+        # ID は使い回さない（古い ID を持つキャッシュと衝突しないように）
+        self.count = 0
+        self.rows.clear()
+        self.records.clear()
+        self.name_index.clear()
+        self.sorted_cache = None
+        self.rank_cache = None
+        self.touch(geo=True)
+
+    def copy(self):
+        # 同じ ID のままの複製（書き出しなど、別のスレッドで読んでいる間に元のピンが編集されてもよいように）
+        store = PinStore()
+        store.next_id = self.next_id
+        store.count = self.count
+        store._lat = self.lat.copy()
+        store._lon = self.lon.copy()
+        store._ids = self.ids.copy()
+        store.rows = dict(self.rows)
+        store.records = {pin_id: Pin(pin_id, r.name, r.remark, r.color) for pin_id, r in self.records.items()}
+        store.name_index = list(self.name_index)
+        store.version = self.version
+        store.geo_version = self.geo_version
+        return store
+
+    def to_dicts(self):
+        # 名前順の辞書リスト（状態ファイル・pandas 用）
+        result = []
+        for pin_id in self.sorted_ids():
+            record = self.records[pin_id]
+            lat, lon = self.lat_lon(pin_id)
+            result.append({"lat": lat, "lon": lon, "name": record.name,
+                           "remark": record.remark, "color": record.color})
+        return result
+
+# --- ピンファイルの読み込み ---
+# pins.csv を少しずつ読み、列ごとの配列にまとめる（ワーカースレッドから呼ぶので Tk には触れない）。
+# 読み終えたら隣に列形式のキャッシュ（緯度経度の配列＋文字列表）を書き、次回は pins.csv の
+# 更新時刻・サイズ・ハッシュが一致すればキャッシュから読む。
+PIN_LOAD_CHUNK_ROWS = 20000  # 進捗を知らせる間隔（行）
+
+class PinColumns:
+    __slots__ = ("lat", "lon", "names", "remarks", "colors", "rejected", "keys")
+
+    def __init__(self, lat, lon, names, remarks, colors, rejected=0, keys=None):
+        self.lat = lat
+        self.lon = lon
+        self.names = names
+        self.remarks = remarks
+        self.colors = colors
+        self.rejected = rejected  # 読み飛ばした不正な行の数
+        # ファイル上のキー（pins.csv の行番号。追記ログで追加したピンはその続きの番号）
+        self.keys = list(range(len(names))) if keys is None else keys
+
+def replace_atomically(path, write, binary=False):
+    # 一時ファイルに書き終えてから置き換える（途中で落ちても元のファイルは壊れない）
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb" if binary else "w", **({} if binary else {"encoding": "utf-8", "newline": ""})) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def file_digest(path, progress=None):
+    digest = hashlib.blake2b(digest_size=16)
+    total = max(os.path.getsize(path), 1)
+    done = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+            done += len(block)
+            if progress:
+                progress(done / total)
+    return digest.hexdigest()
+
+def read_pins_csv(path, progress=None):
+    # 戻り値: (PinColumns, ファイルのハッシュ)。progress(割合, 不正な行数) を一定行ごとに呼ぶ
+    total = max(os.path.getsize(path), 1)
+    digest = hashlib.blake2b(digest_size=16)
+    consumed = [0]
+
+    def lines(f):
+        # バイト列のまま行を切り出して読んだ量を数える（引用符内の改行は csv.reader が次の行と繋ぐ）
+        first = True
+        for raw in f:
+            consumed[0] += len(raw)
+            digest.update(raw)
+            yield raw.decode("utf-8-sig" if first else "utf-8")
+            first = False
+
+    lats, lons, names, remarks, colors = [], [], [], [], []
+    rejected = 0
+    with open(path, "rb") as f:
+        reader = csv.reader(lines(f))
+        header = next(reader, None)
+        if header is None:
+            return PinColumns(np.empty(0), np.empty(0), [], [], []), digest.hexdigest()
+        column = {name: i for i, name in enumerate(header)}
+        missing = [name for name in PIN_CSV_FIELDS[:4] if name not in column]
+        if missing:
+            raise ValueError(f"{os.path.basename(path)} に列がありません: {', '.join(missing)}")
+        i_lat, i_lon, i_name, i_remark = (column[name] for name in PIN_CSV_FIELDS[:4])
+        i_color = column.get("color")
+        for count, row in enumerate(reader, 1):
+            try:
+                lat, lon = float(row[i_lat]), float(row[i_lon])
+                name, remark = row[i_name], row[i_remark]
+                if not (math.isfinite(lat) and math.isfinite(lon)):
+                    raise ValueError
+            except (ValueError, IndexError):
+                rejected += 1
+                continue
+            lats.append(lat)
+            lons.append(lon)
+            names.append(name)
+            remarks.append(remark)
+            color = row[i_color] if i_color is not None and i_color < len(row) else ""
+            colors.append(color or DEFAULT_PIN_COLOR)
+            if progress and count % PIN_LOAD_CHUNK_ROWS == 0:
+                progress(consumed[0] / total, rejected)
+    if progress:
+        progress(1.0, rejected)
+    columns = PinColumns(np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64),
+                         names, remarks, colors, rejected)
+    return columns, digest.hexdigest()
+
+def pack_strings(strings):
+    # 文字列のリストを (UTF-8 を連結したバイト列, 各文字列の開始位置) の文字列表にする
+    encoded = [text.encode("utf-8") for text in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded]) if encoded else []
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def unpack_strings(blob, offsets):
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [data[a:b].decode("utf-8") for a, b in zip(bounds[:-1], bounds[1:])]
+
+def write_pin_cache(cache_path, csv_path, columns, digest):
+    stat = os.stat(csv_path)
+    arrays = {"version": np.array(PIN_CACHE_VERSION), "csv_mtime_ns": np.array(stat.st_mtime_ns),
+              "csv_size": np.array(stat.st_size), "csv_digest": np.array(digest),
+              "lat": np.asarray(columns.lat, dtype=np.float64), "lon": np.asarray(columns.lon, dtype=np.float64),
+              "rejected": np.array(columns.rejected)}
+    for field, strings in (("name", columns.names), ("remark", columns.remarks), ("color", columns.colors)):
+        arrays[field + "_blob"], arrays[field + "_offsets"] = pack_strings(strings)
+    replace_atomically(cache_path, lambda f: np.savez(f, **arrays), binary=True)
+
+def read_pin_cache(cache_path, csv_path, progress=None):
+    # キャッシュが pins.csv と一致すれば (PinColumns, ハッシュ) を、そうでなければ None を返す
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            stat = os.stat(csv_path)
+            if (int(cache["version"]) != PIN_CACHE_VERSION or int(cache["csv_mtime_ns"]) != stat.st_mtime_ns
+                    or int(cache["csv_size"]) != stat.st_size):
+                return None
+            digest = str(cache["csv_digest"])
+            if file_digest(csv_path, progress and (lambda f: progress(f * 0.5, 0))) != digest:
+                return None
+            strings = [unpack_strings(cache[field + "_blob"], cache[field + "_offsets"])
+                       for field in ("name", "remark", "color")]
+            return PinColumns(cache["lat"], cache["lon"], *strings, rejected=int(cache["rejected"])), digest
+    except (OSError, ValueError, KeyError):
+        return None
+
+def replay_pin_journal(path, columns, base_digest, read_only=False):
+    # 追記ログを pins.csv の内容に適用する。戻り値: (PinColumns, 適用した記録数)
+    # 先頭行は元にした pins.csv のハッシュ。一致しない（圧縮後に残った古い）ログは捨てる。
+    # 書き込み途中で切れた末尾の行は適用せず、ファイルもその手前まで切り詰める（read_only ならファイルには触らない）。
+    if not os.path.exists(path):
+        return columns, 0
+    rows = {key: [lat, lon, name, remark, color] for key, lat, lon, name, remark, color in
+            zip(columns.keys, columns.lat.tolist(), columns.lon.tolist(), columns.names, columns.remarks, columns.colors)}
+    entries = 0
+    good_size = 0
+    with open(path, "rb") as f:
+        header = f.readline()
+        try:
+            stale = not header.endswith(b"\n") or json.loads(header).get("base") != base_digest
+        except (ValueError, AttributeError):
+            stale = True
+        if stale:
+            f.close()
+            if not read_only:
+                os.remove(path)
+            return columns, 0
+        good_size = len(header)
+        for raw in f:
+            try:
+                if not raw.endswith(b"\n"):
+                    raise ValueError
+                entry = json.loads(raw)
+                if entry["op"] == "put":
+                    rows[entry["key"]] = [float(entry["lat"]), float(entry["lon"]), entry["name"],
+                                          entry["remark"], entry.get("color") or DEFAULT_PIN_COLOR]
+                elif entry["op"] == "del":
+                    rows.pop(entry["key"], None)
+                else:
+                    raise ValueError
+            except (ValueError, KeyError, TypeError):
+                break
+            good_size += len(raw)
+            entries += 1
+    if good_size < os.path.getsize(path) and not read_only:
+        os.truncate(path, good_size)
+    if not entries:
+        return columns, 0
+    keys = list(rows)
+    values = list(zip(*rows.values())) or [[], [], [], [], []]
+    replayed = PinColumns(np.array(values[0], dtype=np.float64), np.array(values[1], dtype=np.float64),
+                          list(values[2]), list(values[3]), list(values[4]), columns.rejected, keys)
+    return replayed, entries
+
+def load_pins_file(folder, progress=None, read_only=False):
+    # 戻り値: (PinColumns, pins.csv のハッシュ, キャッシュから読んだか, 適用した追記ログの記録数, 保存形式)
+    # read_only ならマップフォルダに何も書かない（キャッシュを作らず、追記ログも切り詰めない）
+    db_path = os.path.join(folder, PINS_DB_FILE)
+    if os.path.exists(db_path):
+        return SqlitePinBackend(db_path).load(progress, read_only), None, False, 0, "SQLite"
+    csv_path = os.path.join(folder, PINS_FILE)
+    cache_path = os.path.join(folder, PIN_CACHE_FILE)
+    cached = read_pin_cache(cache_path, csv_path, progress)
+    if cached is not None:
+        columns, digest = cached
+    else:
+        columns, digest = read_pins_csv(csv_path, progress)
+        if not read_only:
+            try:
+                write_pin_cache(cache_path, csv_path, columns, digest)
+            except OSError:
+                pass  # キャッシュが書けなくても読み込み自体は成功
+    columns, entries = replay_pin_journal(os.path.join(folder, PIN_JOURNAL_FILE), columns, digest, read_only)
+    return columns, digest, cached is not None, entries, "CSV"
+
+def write_pins_folder(folder, store):
+    # pins.csv を丸ごと書き直してキャッシュも作り直し、追記ログを消す。
+    # 戻り値: (書いた順のピンID, pins.csv のハッシュ)
+    csv_path = os.path.join(folder, PINS_FILE)
+    pin_ids = list(store.sorted_ids())
+    rows = store.rows_of(pin_ids)
+    lats, lons = store.lat[rows], store.lon[rows]
+    records = [store.get(pin_id) for pin_id in pin_ids]
+
+    def write(f):
+        writer = csv.writer(f)
+        writer.writerow(PIN_CSV_FIELDS)
+        for lat, lon, pin in zip(lats.tolist(), lons.tolist(), records):
+            writer.writerow([lat, lon, pin.name, pin.remark, pin.color])
+    replace_atomically(csv_path, write)
+    # ここで落ちても、古い追記ログは先頭のハッシュが新しい pins.csv と合わないので適用されない
+    digest = file_digest(csv_path)
+    journal_path = os.path.join(folder, PIN_JOURNAL_FILE)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+    columns = PinColumns(lats, lons, [pin.name for pin in records], [pin.remark for pin in records],
+                         [pin.color for pin in records])
+    try:
+        # 書いた内容で列形式キャッシュも更新（次回は CSV を解析せずに開ける）
+        write_pin_cache(os.path.join(folder, PIN_CACHE_FILE), csv_path, columns, digest)
+    except OSError:
+        pass
+    return pin_ids, digest
+
+# --- 変更の追記ログ ---
+# マップフォルダに保存済みのピンとファイル上のキーの対応を持ち、前回の保存以降に変わったピンだけを
+# pins.journal に追記する。記録が溜まったら pins.csv を書き直して（圧縮して）ログを空にする。
+class PinJournal:
+    COMPACT_MIN_ENTRIES = 1000  # これ以上溜まり、かつピン数の 1/4 を超えたら圧縮する
+
+    def __init__(self):
+        self.folder = None      # 対応するマップフォルダ（絶対パス）。None なら次回は全体を書き出す
+        self.storage = None     # 対応する保存形式（STORAGE_OPTIONS のいずれか）
+        self.base_digest = None
+        self.keys = {}          # ピンID -> ファイル上のキー
+        self.next_key = 0
+        self.entries = 0        # ログに溜まっている記録数
+        self.dirty = set()      # 追加・変更されたピンID
+        self.deleted = []       # 削除されたピンのキー
+
+    def bind(self, folder, pin_ids, keys, base_digest, entries=0, storage="CSV"):
+        self.folder = os.path.abspath(folder)
+        self.storage = storage
+        self.base_digest = base_digest
+        self.keys = dict(zip(pin_ids, keys))
+        self.next_key = max(keys, default=-1) + 1
+        self.entries = entries
+        self.dirty.clear()
+        self.deleted.clear()
+
+    def unbind(self):
+        self.folder = None
+        self.keys.clear()
+        self.dirty.clear()
+        self.deleted.clear()
+
+    def is_bound_to(self, folder, storage="CSV"):
+        return self.folder is not None and self.folder == os.path.abspath(folder) and self.storage == storage
+
+    @property
+    def pending(self):
+        return bool(self.dirty or self.deleted)
+
+    def mark_put(self, pin_id):
+        self.dirty.add(pin_id)
+
+    def mark_delete(self, pin_id):
+        self.dirty.discard(pin_id)
+        key = self.keys.pop(pin_id, None)
+        if key is not None:
+            self.deleted.append(key)
+
+    def needs_compaction(self):
+        return self.entries > max(self.COMPACT_MIN_ENTRIES, len(self.keys) // 4)
+
+    def take_changes(self, store):
+        # 前回の保存以降の変更を (削除したキー, 追加・変更した記録) で返して、変更の記録を空にする
+        deleted = list(self.deleted)
+        puts = []
+        for pin_id in sorted(self.dirty):
+            if pin_id not in store:
+                continue
+            key = self.keys.get(pin_id)
+            if key is None:
+                key = self.keys[pin_id] = self.next_key
+                self.next_key += 1
+            pin = store.get(pin_id)
+            lat, lon = store.lat_lon(pin_id)
+            puts.append((key, lat, lon, pin.name, pin.remark, pin.color))
+        self.dirty.clear()
+        self.deleted.clear()
+        return deleted, puts
+
+    def append(self, store):
+        # 変更分だけを追記して fsync する
+        deleted, puts = self.take_changes(store)
+        lines = [{"op": "del", "key": key} for key in deleted]
+        lines += [{"op": "put", "key": key, "lat": lat, "lon": lon, "name": name, "remark": remark, "color": color}
+                  for key, lat, lon, name, remark, color in puts]
+        path = os.path.join(self.folder, PIN_JOURNAL_FILE)
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in lines)
+        if not os.path.exists(path):
+            data = json.dumps({"base": self.base_digest}) + "\n" + data
+        with open(path, "ab") as f:
+            f.write(data.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries += len(lines)
+
+# --- SQLite によるピンの保存 ---
+# マップフォルダの pins.sqlite にピンを 1 行ずつ持つ（保存形式としてだけ使う）。キーは PinJournal のファイル上のキーと同じ。
+# 保存は前回からの変更分を 1 トランザクションで反映するので、大きなカタログでも保存のたびに全体を書き直さない。
+# 開いたマップのピンは CSV と同じく PinStore に読み込み、表示範囲や名前での検索はメモリ上の索引
+# （PinHitGrid・PinSearchIndex）で行う。CSV に戻すには保存形式を CSV にして保存する。
+class SqlitePinBackend:
+    SCHEMA_VERSION = 2  # 1 は使わない区画番号の列と索引を持っていた
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        # 接続はスレッドごとに作る（読み込みはワーカースレッド、保存は Tk のスレッドで行うため）
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pins (
+                key INTEGER PRIMARY KEY,
+                lat REAL NOT NULL, lon REAL NOT NULL,
+                name TEXT NOT NULL, remark TEXT NOT NULL, color TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+        """)
+        if "lat_bucket" in [column[1] for column in conn.execute("PRAGMA table_info(pins)")]:
+            self.migrate_v1(conn)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (str(self.SCHEMA_VERSION),))
+        conn.commit()
+        return conn
+
+    @staticmethod
+    def migrate_v1(conn):
+        # 区画番号の列と索引を除いた表に作り直す（古い SQLite でも使えるよう DROP COLUMN は使わない）
+        with conn:
+            conn.executescript("""
+                DROP INDEX IF EXISTS pins_bucket;
+                DROP INDEX IF EXISTS pins_name;
+                CREATE TABLE pins_v2 (
+                    key INTEGER PRIMARY KEY,
+                    lat REAL NOT NULL, lon REAL NOT NULL,
+                    name TEXT NOT NULL, remark TEXT NOT NULL, color TEXT NOT NULL);
+                INSERT INTO pins_v2 SELECT key, lat, lon, name, remark, color FROM pins;
+                DROP TABLE pins;
+                ALTER TABLE pins_v2 RENAME TO pins;
+            """)
+
+    def load(self, progress=None, read_only=False):
+        # 全ピンを PinColumns で返す（キー順）。read_only なら読み取り専用で開く（表の作成・移行もしない）
+        if read_only:
+            conn = sqlite3.connect(pathlib.Path(self.path).absolute().as_uri() + "?mode=ro", uri=True)
+        else:
+            conn = self.connect()
+        try:
+            total = max(conn.execute("SELECT COUNT(*) FROM pins").fetchone()[0], 1)
+            keys, lats, lons, names, remarks, colors = [], [], [], [], [], []
+            cursor = conn.execute("SELECT key, lat, lon, name, remark, color FROM pins ORDER BY key")
+            while True:
+                rows = cursor.fetchmany(PIN_LOAD_CHUNK_ROWS)
+                if not rows:
+                    break
+                for key, lat, lon, name, remark, color in rows:
+                    keys.append(key)
+                    lats.append(lat)
+                    lons.append(lon)
+                    names.append(name)
+                    remarks.append(remark)
+                    colors.append(color)
+                if progress:
+                    progress(len(keys) / total, 0)
+        finally:
+            conn.close()
+        return PinColumns(np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64),
+                          names, remarks, colors, keys=keys)
+
+    def replace_all(self, keys, lats, lons, names, remarks, colors):
+        # 全ピンを入れ替える（CSV からの取り込み・SQLite への切り替え時）
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM pins")
+                conn.executemany("INSERT INTO pins VALUES (?, ?, ?, ?, ?, ?)",
+                                 zip(keys, lats, lons, names, remarks, colors))
+        finally:
+            conn.close()
+
+    def apply(self, deleted, puts):
+        # 削除と追加・変更を 1 トランザクションで反映する（途中で失敗したら何も変わらない）
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM pins WHERE key = ?", [(key,) for key in deleted])
+                conn.executemany("INSERT OR REPLACE INTO pins VALUES (?, ?, ?, ?, ?, ?)", puts)
+        finally:
+            conn.close()
+
+# --- 背景画像のタイルピラミッド ---
+# 背景画像を元の解像度のまま TILE px 四方のタイルに分け、1/2 ずつ縮小した段を重ねてマップフォルダに置く。
+#   bg_tiles/meta.json            各段の大きさ
+#   bg_tiles/<段>/<列>_<行>.png    段 0 が元の解像度
+# 表示や画像出力は出力の大きさに合う段から必要なタイルだけを読む。背景の正本はピラミッドで、map.png は取り込み元としてだけ使う。
+# map.png がピラミッドより新しければ map.png から作り直す（ペイントツールでの編集はタイルに直接書くので map.png は変わらない）。
+class TilePyramid:
+    TILE = 512
+    CACHE_TILES = 96  # 読み込んだタイルを保持する数
+
+    def __init__(self, folder):
+        self.root = os.path.join(folder, BG_TILES_DIR)
+        with open(os.path.join(self.root, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.sizes = [tuple(size) for size in meta["sizes"]]  # 段ごとの (幅, 高さ)
+        self.width, self.height = self.sizes[0]
+        self.cache = {}  # (段, 列, 行) -> Image（dict の挿入順を LRU として使う）
+        self.lock = threading.Lock()  # Tk のスレッドとワーカースレッドの両方から読むため
+
+    # 書き出しのワーカープロセスへはフォルダの情報だけを渡し、タイルは各プロセスがファイルから読む
+    def __getstate__(self):
+        return {"root": self.root, "sizes": self.sizes}
+
+    def __setstate__(self, state):
+        self.root = state["root"]
+        self.sizes = state["sizes"]
+        self.width, self.height = self.sizes[0]
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def is_current(cls, folder):
+        meta_path = os.path.join(folder, BG_TILES_DIR, "meta.json")
+        source = os.path.join(folder, BG_SOURCE_FILE)
+        if not os.path.exists(meta_path):
+            return False
+        return not (os.path.exists(source) and os.path.getmtime(source) > os.path.getmtime(meta_path))
+
+    @classmethod
+    def ensure(cls, folder):
+        # 必要なら map.png からピラミッドを作って開く（背景画像がなければ None）
+        if not cls.is_current(folder):
+            source = os.path.join(folder, BG_SOURCE_FILE)
+            if not os.path.exists(source):
+                return None
+            with Image.open(source) as img:
+                cls.build(folder, img.convert("RGB"))
+        return cls(folder)
+
+    @classmethod
+    def build(cls, folder, img):
+        # 別名のフォルダに全段を書いてから差し替える
+        root = os.path.join(folder, BG_TILES_DIR)
+        temp_root = root + ".tmp"
+        shutil.rmtree(temp_root, ignore_errors=True)
+        sizes = []
+        level = 0
+        while True:
+            sizes.append(img.size)
+            os.makedirs(os.path.join(temp_root, str(level)))
+            for row in range(math.ceil(img.height / cls.TILE)):
+                for col in range(math.ceil(img.width / cls.TILE)):
+                    box = (col * cls.TILE, row * cls.TILE,
+                           min((col + 1) * cls.TILE, img.width), min((row + 1) * cls.TILE, img.height))
+                    img.crop(box).save(os.path.join(temp_root, str(level), f"{col}_{row}.png"), compress_level=1)
+            if img.width <= cls.TILE and img.height <= cls.TILE:
+                break
+            img = img.reduce(2)  # 2x2 画素の平均（端数は切り上げ）
+            level += 1
+        with open(os.path.join(temp_root, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"tile": cls.TILE, "sizes": sizes}, f)
+        old_root = root + ".old"
+        if os.path.exists(root):
+            os.replace(root, old_root)
+        os.replace(temp_root, root)
+        shutil.rmtree(old_root, ignore_errors=True)
+
+    @staticmethod
+    def remove(folder):
+        shutil.rmtree(os.path.join(folder, BG_TILES_DIR), ignore_errors=True)
+
+    def tile_path(self, level, col, row):
+        return os.path.join(self.root, str(level), f"{col}_{row}.png")
+
+    def tile(self, level, col, row):
+        key = (level, col, row)
+        with self.lock:
+            img = self.cache.pop(key, None)
+            if img is None:
+                with Image.open(self.tile_path(level, col, row)) as f:
+                    img = f.convert("RGB")
+            self.cache[key] = img
+            while len(self.cache) > self.CACHE_TILES:
+                del self.cache[next(iter(self.cache))]
+            return img
+
+    def level_for(self, full_width):
+        # 全体を full_width px で表示するのに足りる、いちばん粗い段
+        for level in reversed(range(len(self.sizes))):
+            if self.sizes[level][0] >= full_width:
+                return level
+        return 0
+
+    def read_region(self, level, box):
+        # 段 level の画素座標 box = (x0, y0, x1, y1) の範囲を、重なるタイルだけ読んで返す
+        x0, y0, x1, y1 = box
+        img = Image.new("RGB", (x1 - x0, y1 - y0))
+        for row in range(y0 // self.TILE, (y1 - 1) // self.TILE + 1):
+            for col in range(x0 // self.TILE, (x1 - 1) // self.TILE + 1):
+                img.paste(self.tile(level, col, row), (col * self.TILE - x0, row * self.TILE - y0))
+        return img
+
+    def read_scaled(self, width, height, box=None):
+        # 全体（box は段 0 の座標での範囲）を width x height に縮小・拡大して返す
+        x0, y0, x1, y1 = box or (0, 0, self.width, self.height)
+        level = self.level_for(width * self.width / (x1 - x0))
+        level_width, level_height = self.sizes[level]
+        scale = level_width / self.width
+        region = (max(0, math.floor(x0 * scale)), max(0, math.floor(y0 * scale)),
+                  min(level_width, math.ceil(x1 * scale)), min(level_height, math.ceil(y1 * scale)))
+        img = self.read_region(level, region)
+        # 段の画素の端数を box で合わせて縮小
+        return img.resize((width, height), Image.LANCZOS,
+                          box=(x0 * scale - region[0], y0 * scale - region[1],
+                               x1 * scale - region[0], y1 * scale - region[1]))
+
+    def write_tile(self, level, col, row, img):
+        path = self.tile_path(level, col, row)
+        replace_atomically(path, lambda f: img.save(f, format="PNG", compress_level=1), binary=True)
+        with self.lock:
+            self.cache.pop((level, col, row), None)
+
+    def apply_edit(self, painted, mask):
+        # 縮小表示の上で描いた painted のうち mask の部分を、元の解像度のタイルへ合成する。
+        # 変わった範囲のタイルだけを書き直し、上の段もその範囲だけ作り直す
+        bbox = mask.getbbox()
+        if bbox is None:
+            return
+        sx = self.width / painted.width
+        sy = self.height / painted.height
+        changed = (max(0, math.floor(bbox[0] * sx) - 1), max(0, math.floor(bbox[1] * sy) - 1),
+                   min(self.width, math.ceil(bbox[2] * sx) + 1), min(self.height, math.ceil(bbox[3] * sy) + 1))
+        for level, (level_width, level_height) in enumerate(self.sizes):
+            f = 2 ** level
+            region = (changed[0] // f, changed[1] // f, math.ceil(changed[2] / f), math.ceil(changed[3] / f))
+            for row in range(region[1] // self.TILE, (region[3] - 1) // self.TILE + 1):
+                for col in range(region[0] // self.TILE, (region[2] - 1) // self.TILE + 1):
+                    box = (col * self.TILE, row * self.TILE,
+                           min((col + 1) * self.TILE, level_width), min((row + 1) * self.TILE, level_height))
+                    size = (box[2] - box[0], box[3] - box[1])
+                    if level == 0:
+                        extent = (box[0] / sx, box[1] / sy, box[2] / sx, box[3] / sy)
+                        tile = self.tile(0, col, row).copy()
+                        tile.paste(painted.transform(size, Image.EXTENT, extent, Image.BILINEAR), (0, 0),
+                                   mask.transform(size, Image.EXTENT, extent, Image.BILINEAR))
+                    else:
+                        # 1つ下の段の対応する範囲を 1/2 に縮小
+                        below_width, below_height = self.sizes[level - 1]
+                        tile = self.read_region(level - 1, (box[0] * 2, box[1] * 2,
+                                                            min(box[2] * 2, below_width),
+                                                            min(box[3] * 2, below_height))).reduce(2)
+                    self.write_tile(level, col, row, tile)
+        # map.png より新しいことを示すため meta.json の更新時刻を進める
+        os.utime(os.path.join(self.root, "meta.json"))
+
+# --- 大圏航路計算（NumPy による一括計算） ---
+# 1つの出発点から N 個の目的地への大圏航路を、補間点 n+1 個ずつまとめて求める。
+# 戻り値は (N, n+1) の配列 u, v（正距円筒図法上の正規化座標）。
+#   u: 経度方向。0～1 が1周分で、日付変更線を跨いでも連続になるよう展開済み
+#   v: 緯度方向。0 が北極、1 が南極
+# 画面座標へは「u * 幅 + オフセット」「v * 高さ」で変換できる。
+def gc_route_uv(lat1, lon1, lats2, lons2, n=100):
+    lats2 = np.asarray(lats2, dtype=float).reshape(-1)
+    lons2 = np.asarray(lons2, dtype=float).reshape(-1)
+    phi1, lambda1 = math.radians(lat1), math.radians(lon1)
+    phi2, lambda2 = np.radians(lats2), np.radians(lons2)
+    # 単位球上の3次元ベクトル
+    p1 = np.array([math.cos(phi1) * math.cos(lambda1),
+                   math.cos(phi1) * math.sin(lambda1),
+                   math.sin(phi1)])
+    p2 = np.stack([np.cos(phi2) * np.cos(lambda2),
+                   np.cos(phi2) * np.sin(lambda2),
+                   np.sin(phi2)], axis=-1)
+    hav = (np.sin((phi2 - phi1) / 2) ** 2 +
+           math.cos(phi1) * np.cos(phi2) * np.sin((lambda2 - lambda1) / 2) ** 2)
+    delta = 2 * np.arcsin(np.sqrt(np.clip(hav, 0.0, 1.0)))
+    # 同一地点（および対蹠点）は補間できないため出発点を並べる
+    sin_delta = np.sin(delta)
+    degenerate = sin_delta < 1e-12
+    sin_delta = np.where(degenerate, 1.0, sin_delta)
+    f = np.linspace(0.0, 1.0, n + 1)
+    A = np.sin((1 - f)[None, :] * delta[:, None]) / sin_delta[:, None]
+    B = np.sin(f[None, :] * delta[:, None]) / sin_delta[:, None]
+    A = np.where(degenerate[:, None], 1.0, A)
+    B = np.where(degenerate[:, None], 0.0, B)
+    x = A * p1[0] + B * p2[:, 0, None]
+    y = A * p1[1] + B * p2[:, 1, None]
+    z = A * p1[2] + B * p2[:, 2, None]
+    lat = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    lon = np.degrees(np.arctan2(y, x))
+    u = (lon - LON_MIN) / (LON_MAX - LON_MIN)
+    v = (LAT_MAX - lat) / (LAT_MAX - LAT_MIN)
+    # 連続性の補正：隣接点の差が半周を超えたら1周分ずらす
+    if u.shape[1] > 1:
+        u[:, 1:] -= np.cumsum(np.rint(np.diff(u, axis=1)), axis=1)
+    return u, v
+
+# --- 大圏航路キャッシュ ---
+# (出発ピン, 到着ピン, 補間数) をキーに gc_route_uv() の結果を保持する。
+# 座標はオフセットに依存しない正規化座標なので、パン時は平行移動だけで済む。
+# ピンの緯度経度が変わったとき・削除されたときだけ該当エントリを破棄する。
+class RouteCache:
+    MAX_ORIGINS = 4  # 保持する出発ピンの数（古いものから破棄）
+
+    def __init__(self):
+        self.routes = {}  # 出発ピンID -> {(到着ピンID, n): (u, v)}
+        self.last = None  # 直前に返した (キー, 到着ピンID列, U, V)
+
+    def get_routes(self, store, origin_id, n=100):
+        # 出発ピンから他の全ピンへの航路を (到着ピンID列, U, V) で返す
+        request_key = (origin_id, store.geo_version, n)
+        if self.last is not None and self.last[0] == request_key:
+            return self.last[1:]
+        # 最近使った出発ピンを末尾へ（dict の挿入順を LRU として使う）
+        table = self.routes.pop(origin_id, {})
+        self.routes[origin_id] = table
+        while len(self.routes) > self.MAX_ORIGINS:
+            del self.routes[next(iter(self.routes))]
+        dest_ids = store.ids[store.ids != origin_id].tolist()
+        missing = [pin_id for pin_id in dest_ids if (pin_id, n) not in table]
+        if missing:
+            rows = store.rows_of(missing)
+            lat1, lon1 = store.lat_lon(origin_id)
+            u, v = gc_route_uv(lat1, lon1, store.lat[rows], store.lon[rows], n)
+            for pin_id, u_row, v_row in zip(missing, u, v):
+                table[(pin_id, n)] = (u_row, v_row)
+        if dest_ids:
+            U = np.stack([table[(pin_id, n)][0] for pin_id in dest_ids])
+            V = np.stack([table[(pin_id, n)][1] for pin_id in dest_ids])
+        else:
+            U = V = np.empty((0, n + 1))
+        self.last = (request_key, dest_ids, U, V)
+        return dest_ids, U, V
+
+    def invalidate_pin(self, pin_id):
+        self.routes.pop(pin_id, None)
+        for table in self.routes.values():
+            for entry in [k for k in table if k[0] == pin_id]:
+                del table[entry]
+        self.last = None
+
+    def clear(self):
+        self.routes.clear()
+        self.last = None
+
+# --- ラベル配置（重なりの解消） ---
+# ラベルの文字の外接矩形を一定サイズのセルの占有グリッドに登録し、優先度の高いピンから順に
+# 他のピンの印・置いたラベルと重ならない候補位置（上・右・左・下）へ置く。どこにも置けないラベルは出さない。
+# 座標はキャンバス・画像出力で共通の「その縮尺での地図上の px」で、横方向は period で一周する。
+# 選択中のピンのラベルだけは、どこにも空きがなければ他のピンの印に重ねてでも出す。
+# ピンの追加・移動・削除・選択の変更では、そのピンの周囲のラベルだけを置き直す
+# （全体を置き直した場合と細部が異なることはあるが、ラベルどうしの重なりは生じない）。
+class LabelLayout:
+    CELL = 64  # 占有グリッドのセルの大きさ（px）
+    PIL_ANCHORS = {"s": "mb", "n": "mt", "w": "lm", "e": "rm"}  # Tk のアンカー -> PIL のアンカー
+
+    def __init__(self, measure, gap, period, store, selected):
+        self.measure = measure    # 文字列 -> (幅, 高さ)
+        self.gap = gap            # ピンの先端から上に置くラベルの下端までの間隔
+        self.period = period
+        self.store = store
+        self.selected = selected  # 選択中のピンIDを返す関数
+        self.sizes = {}           # 文字列 -> (幅, 高さ)
+        self.points = {}          # ピンID -> (x, y, 文字列)
+        self.labels = {}          # ピンID -> (アンカー, 横のずれ, 縦のずれ)。置けなかったときは None
+        self.markers = {}         # ピンID -> 印の矩形（一周をはみ出した分は反対側にも）
+        self.boxes = {}           # ピンID -> 置いたラベルの矩形
+        self.free = {}            # ピンID -> 他のピンの印に重ならない候補 [(アンカー, 横のずれ, 縦のずれ, 矩形)]
+        self.marker_cells = {}    # セル -> ピンIDの集合
+        self.label_cells = {}
+        self.reach_x = 0          # ラベルがピンの先端から届きうる横・縦の距離（置き直す範囲の目安）
+        self.reach_y = 0
+
+    def size(self, text):
+        size = self.sizes.get(text)
+        if size is None:
+            size = self.sizes[text] = self.measure(text)
+            self.reach_x = max(self.reach_x, size[0] + 8)
+            self.reach_y = max(self.reach_y, size[1] + self.gap + 8)
+        return size
+
+    def candidates(self):
+        # (アンカー, 横のずれ, 縦のずれ)。先にあるものほど優先
+        return (("s", 0, -self.gap), ("w", 5, -2), ("e", -5, -2), ("n", 0, 2))
+
+    def split(self, x0, y0, x1, y1):
+        pieces = [(x0, y0, x1, y1)]
+        if x0 < 0:
+            pieces.append((x0 + self.period, y0, x1 + self.period, y1))
+        if x1 > self.period:
+            pieces.append((x0 - self.period, y0, x1 - self.period, y1))
+        return pieces
+
+    def cells(self, pieces):
+        c = self.CELL
+        for x0, y0, x1, y1 in pieces:
+            for col in range(math.floor(x0 / c), math.floor(x1 / c) + 1):
+                for row in range(math.floor(y0 / c), math.floor(y1 / c) + 1):
+                    yield col, row
+
+    def label_box(self, pin_id, anchor, dx, dy):
+        x, y, text = self.points[pin_id]
+        w, h = self.size(text)
+        x += dx
+        y += dy
+        if anchor == "s":
+            return self.split(x - w / 2, y - h, x + w / 2, y)
+        if anchor == "n":
+            return self.split(x - w / 2, y, x + w / 2, y + h)
+        if anchor == "w":
+            return self.split(x, y - h / 2, x + w, y + h / 2)
+        return self.split(x - w, y - h / 2, x, y + h / 2)
+
+    def hits(self, pieces, cells, boxes, exclude):
+        for cell in self.cells(pieces):
+            for pin_id in cells.get(cell, ()):
+                if pin_id == exclude:
+                    continue
+                for a in boxes[pin_id]:
+                    for b in pieces:
+                        if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                            return True
+        return False
+
+    def register(self, pin_id, pieces, boxes, cells):
+        boxes[pin_id] = pieces
+        for cell in self.cells(pieces):
+            cells.setdefault(cell, set()).add(pin_id)
+
+    def unregister(self, pin_id, boxes, cells):
+        pieces = boxes.pop(pin_id, None)
+        if pieces is None:
+            return
+        for cell in self.cells(pieces):
+            bucket = cells.get(cell)
+            if bucket is not None:
+                bucket.discard(pin_id)
+                if not bucket:
+                    del cells[cell]
+
+    def order(self, pin_ids):
+        return label_order(self.store, pin_ids, self.selected())
+
+    def find_free(self, pin_id):
+        # 印は置き直しで動かないので、印に重ならない候補は印が変わったときだけ求め直す
+        self.free[pin_id] = []
+        if not self.points[pin_id][2]:
+            return
+        for anchor, dx, dy in self.candidates():
+            pieces = self.label_box(pin_id, anchor, dx, dy)
+            if not self.hits(pieces, self.marker_cells, self.markers, pin_id):
+                self.free[pin_id].append((anchor, dx, dy, pieces))
+
+    def place(self, pin_id):
+        # 密集した所では印に重ならない候補がなく、ここはすぐに終わる
+        self.labels[pin_id] = None
+        for anchor, dx, dy, pieces in self.free[pin_id]:
+            if not self.hits(pieces, self.label_cells, self.boxes, pin_id):
+                self.labels[pin_id] = (anchor, dx, dy)
+                self.register(pin_id, pieces, self.boxes, self.label_cells)
+                return
+        if pin_id == self.selected() and self.points[pin_id][2]:
+            # 選択中のピンは最初に置くので、ラベルどうしは重ならない（印には重なりうる）
+            anchor, dx, dy = self.candidates()[0]
+            self.labels[pin_id] = (anchor, dx, dy)
+            self.register(pin_id, self.label_box(pin_id, anchor, dx, dy), self.boxes, self.label_cells)
+
+    def add_point(self, pin_id, x, y, text):
+        self.points[pin_id] = (x % self.period, y, text)
+        x, y = self.points[pin_id][:2]
+        self.register(pin_id, self.split(x - 3, y - 4, x + 3, y), self.markers, self.marker_cells)
+
+    def set_pins(self, pin_ids, xs, ys, texts):
+        # 全体を置き直す（pin_ids, xs, ys, texts は同じ並び）
+        self.points.clear()
+        self.labels.clear()
+        self.markers.clear()
+        self.boxes.clear()
+        self.free.clear()
+        self.marker_cells.clear()
+        self.label_cells.clear()
+        for pin_id, x, y, text in zip(pin_ids, xs, ys, texts):
+            self.add_point(pin_id, x, y, text)
+        for pin_id in pin_ids:
+            self.find_free(pin_id)
+        for pin_id in self.order(list(pin_ids)):
+            self.place(pin_id)
+
+    def label(self, pin_id):
+        return self.labels.get(pin_id)
+
+    def put(self, pin_id, x, y, text):
+        # ピンを追加・移動し、ラベルの置き方が変わったピンIDの集合（自身を含む）を返す
+        old = self.points.get(pin_id)
+        if old is not None:
+            self.unregister(pin_id, self.boxes, self.label_cells)
+            self.unregister(pin_id, self.markers, self.marker_cells)
+        self.add_point(pin_id, x, y, text)
+        points = [self.points[pin_id]] + ([old] if old is not None else [])
+        self.update_free(points)
+        return self.settle(points, [pin_id]) | {pin_id}
+
+    def discard(self, pin_id):
+        old = self.points.pop(pin_id, None)
+        if old is None:
+            return set()
+        self.labels.pop(pin_id, None)
+        self.free.pop(pin_id, None)
+        self.unregister(pin_id, self.boxes, self.label_cells)
+        self.unregister(pin_id, self.markers, self.marker_cells)
+        self.update_free([old])
+        return self.settle([old], [])
+
+    def refresh(self, pin_ids):
+        # 優先度が変わったピン（選択の切り替えなど）の周囲を置き直す
+        pin_ids = [pin_id for pin_id in pin_ids if pin_id in self.points]
+        return self.settle([self.points[pin_id] for pin_id in pin_ids], pin_ids)
+
+    def nearby(self, points, rx, ry):
+        # points のいずれかから横 rx・縦 ry 以内にあるピンID
+        found = set()
+        for x, y, _ in points:
+            for cell in self.cells(self.split(x - rx, y - ry, x + rx, y + ry)):
+                for pin_id in self.marker_cells.get(cell, ()):
+                    px, py, _ = self.points[pin_id]
+                    dx = abs(px - x) % self.period
+                    if min(dx, self.period - dx) <= rx and abs(py - y) <= ry:
+                        found.add(pin_id)
+        return found
+
+    def update_free(self, points):
+        # points で印が増減・移動したとき、その印にラベルが届きうるピンの候補を求め直す
+        for pin_id in self.nearby(points, self.reach_x, self.reach_y):
+            self.find_free(pin_id)
+
+    def settle(self, points, pin_ids):
+        # points の周囲でラベルが干渉しうるピンを優先順に置き直し、置き方が変わったピンIDを返す
+        affected = set(pin_ids) | self.nearby(points, 2 * self.reach_x, 2 * self.reach_y)
+        before = {pin_id: self.labels.get(pin_id, False) for pin_id in affected}
+        for pin_id in affected:
+            self.unregister(pin_id, self.boxes, self.label_cells)
+        for pin_id in self.order(list(affected)):
+            self.place(pin_id)
+        return {pin_id for pin_id in affected if self.labels[pin_id] != before[pin_id]}
+
+def label_order(store, pin_ids, selected_id=None):
+    # ラベルを置く優先順：選択中のピン → 色（LABEL_COLOR_PRIORITY の順）→ 名前順
+    rank = {color: i for i, color in enumerate(LABEL_COLOR_PRIORITY)}
+    return sorted(store.sort_by_name(pin_ids),
+                  key=lambda pin_id: (pin_id != selected_id, rank.get(store.get(pin_id).color, len(rank))))
+
+def pil_text_size(font, text):
+    left, top, right, bottom = font.getbbox(text)
+    return right - left, bottom - top
+
+def pin_marker_pixels():
+    # キャンバスのマーカー（先端がピン位置の下向き三角形）が塗る画素の、ピン位置からのずれ (dx, dy)
+    mask = Image.new("L", (7, 5), 0)
+    ImageDraw.Draw(mask).polygon([(0, 0), (6, 0), (3, 4)], fill=255, outline=255)
+    ys, xs = np.nonzero(np.asarray(mask))
+    return [(int(x) - 3, int(y) - 4) for x, y in zip(xs, ys)]
+
+PIN_MARKER_PIXELS = pin_marker_pixels()
+
+# --- 地図画像の書き出し（帯ごと） ---
+# 書き出す内容（背景・経緯線・大圏航路・ピンとラベルの位置）を MapExport にまとめておき、
+# 出力画像を上から STRIP_HEIGHT 行ずつの帯に分けて描いてはファイルへ流す。
+# 同時に持つのは帯1本分だけなので、出力の大きさによらず使うメモリはほぼ一定になる。
+# 帯が多いときは ProcessPoolExecutor で並列に描く。各ワーカーには MapExport を起動時に1度だけ渡し
+# （背景はタイルピラミッドのフォルダだけを渡して各自ファイルから読む）、描けた帯は上から順にファイルへ流す。
+def read_map_window(source, eff_width, eff_height, zoom, x, y, width, height):
+    # 倍率 zoom の地図上の範囲（左上 (x, y)、横方向は一周ごとに繰り返す）を width x height の画像で返す
+    # source はタイルピラミッドか元の背景画像
+    img = Image.new("RGB", (width, height), "#e0e0e0")
+    period = eff_width * zoom
+    if isinstance(source, TilePyramid):
+        source_width, source_height = source.width, source.height
+    else:
+        source_width, source_height = source.size
+    sx = source_width / period
+    sy = source_height / (eff_height * zoom)
+    pos = 0
+    while pos < width:
+        # 経度 ±180 度の境目で切って、一周分ずつ元画像から切り出す
+        start = (x + pos) % period
+        run = min(width - pos, max(1, round(period - start)))
+        box = (start * sx, y * sy, min(start + run, period) * sx, (y + height) * sy)
+        if isinstance(source, TilePyramid):
+            piece = source.read_scaled(run, height, box)
+        else:
+            piece = source.resize((run, height), Image.LANCZOS, box=box)
+        img.paste(piece.convert("RGB"), (pos, 0))
+        pos += run
+    return img
+
+export_worker_job = None  # ワーカープロセスで描いている MapExport
+
+def init_export_worker(export):
+    global export_worker_job
+    export_worker_job = export
+
+def render_export_strip(y0, y1):
+    return export_worker_job.render_strip(y0, y1).tobytes()
+
+class MapExport:
+    STRIP_HEIGHT = 256         # 1回に描く行数
+    LABEL_REACH = 64           # ピンの位置からラベル・マーカーが縦にはみ出しうる幅（px）
+    PARALLEL_MIN_STRIPS = 8    # 帯がこれより少なければワーカーを起こさず順に描く
+
+    def __init__(self, eff_width, eff_height, multiplier, offset_x, background, bg_alpha, routes, pins, labels, font,
+                 reach_x=None):
+        self.eff_width = eff_width
+        self.eff_height = eff_height
+        self.multiplier = multiplier
+        self.width = int(eff_width * multiplier)
+        self.height = int(eff_height * multiplier)
+        self.offset_x = offset_x      # 横方向のずれ（倍率1での量）
+        self.background = background  # タイルピラミッド、元の背景画像、または None
+        self.bg_alpha = bg_alpha      # 背景の不透明度（0～255）
+        self.routes = routes          # [(xs, ys)]（出力画像の座標）
+        self.font = font
+        # ピンの位置からラベル・マーカーが横にはみ出しうる幅（px、None なら横では絞らない）
+        self.reach_x = reach_x
+        # ピンは y の順に並べ、帯に掛かるものを二分探索で取り出す
+        pin_ids, xs, ys, names, colors = pins
+        self.order = np.argsort(ys, kind="stable")
+        self.sorted_ys = np.asarray(ys)[self.order]
+        self.sorted_xs = np.asarray(xs)[self.order]
+        self.pins = list(zip(xs, ys, names, colors, [labels.get(pin_id) for pin_id in pin_ids]))
+        self.route_spans = [(float(ys_.min()), float(ys_.max())) for _, ys_ in routes]
+
+    @classmethod
+    def from_store(cls, store, eff_width, eff_height, multiplier, font, offset_x=0.0, background=None, bg_alpha=255,
+                   routes=None, selected_id=None):
+        # PinStore のピンから作る。routes は RouteCache.get_routes() の (u, v)（地図全体を 1 とした座標）
+        width = int(eff_width * multiplier)
+        height = int(eff_height * multiplier)
+        lines = [] if routes is None else list(zip(routes[0] * width + offset_x * multiplier, routes[1] * height))
+        # ピン（キャンバスと同じ計算、タイル処理）
+        rel = (store.lon - LON_MIN) / (LON_MAX - LON_MIN)
+        x_eff = (rel * eff_width + offset_x) % eff_width
+        y_eff = ((LAT_MAX - store.lat) / (LAT_MAX - LAT_MIN)) * eff_height
+        xs = (x_eff * multiplier).astype(int).tolist()
+        ys = (y_eff * multiplier).astype(int).tolist()
+        # ラベルはキャンバスと同じ規則で、重ならない位置に置けるものだけを描く
+        pin_ids = store.ids.tolist()
+        names = [store.get(pin_id).name for pin_id in pin_ids]
+        colors = [store.get(pin_id).color for pin_id in pin_ids]
+        labels = LabelLayout(lambda text: pil_text_size(font, text), 8, width, store, lambda: selected_id)
+        labels.set_pins(pin_ids, xs, ys, names)
+        return cls(eff_width, eff_height, multiplier, offset_x, background, bg_alpha, lines,
+                   (pin_ids, xs, ys, names, colors), {pin_id: labels.label(pin_id) for pin_id in pin_ids}, font,
+                   max(labels.reach_x, 8))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        path = getattr(self.font, "path", None)
+        if hasattr(path, "getvalue"):
+            # メモリから読んだフォント（既定のフォント）はファイル名で開き直せないので、中身ごと渡す
+            state["font"] = (path.getvalue(), self.font.size)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["font"], tuple):
+            data, size = state["font"]
+            state["font"] = ImageFont.truetype(BytesIO(data), size)
+        self.__dict__.update(state)
+
+    def strip_ranges(self):
+        return [(y0, min(self.height, y0 + self.STRIP_HEIGHT)) for y0 in range(0, self.height, self.STRIP_HEIGHT)]
+
+    def strips(self, workers=None):
+        # 帯を上から順に (y0, 画像) で返す。workers が 2 以上なら別プロセスで並列に描く（先読みは workers の2倍まで）
+        ranges = self.strip_ranges()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 2 or len(ranges) < self.PARALLEL_MIN_STRIPS:
+            for y0, y1 in ranges:
+                yield y0, self.render_strip(y0, y1)
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers, initializer=init_export_worker, initargs=(self,)) as pool:
+            pending = []
+            try:
+                for y0, y1 in ranges:
+                    pending.append((y0, y1, pool.submit(render_export_strip, y0, y1)))
+                    if len(pending) >= workers * 2:
+                        yield self.strip_result(*pending.pop(0))
+                while pending:
+                    yield self.strip_result(*pending.pop(0))
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
+    def render_strip(self, y0, y1):
+        # 出力画像の y0 行目から y1 行目の手前までを描いた画像
+        return self.render_box(0, y0, self.width, y1)
+
+    def render_box(self, x0, y0, x1, y1):
+        # 出力画像の (x0, y0) から (x1, y1) の手前までの範囲を描いた画像（タイル出力ではタイル1枚分）
+        width, multiplier = self.width, self.multiplier
+        img = Image.new("RGB", (x1 - x0, y1 - y0), "#e0e0e0")
+        if self.background is not None:
+            bg = read_map_window(self.background, self.eff_width, self.eff_height, multiplier,
+                                 x0 - self.offset_x * multiplier, y0, x1 - x0, y1 - y0)
+            img = Image.blend(img, bg, self.bg_alpha / 255)
+        draw = ImageDraw.Draw(img)
+
+        # 経緯線
+        for lon in range(-180, 181, 30):
+            rel = (lon - LON_MIN) / (LON_MAX - LON_MIN)
+            x = int((rel * self.eff_width + self.offset_x) % self.eff_width * multiplier) - x0
+            if 0 <= x < x1 - x0:
+                draw.line([(x, 0), (x, y1 - y0)], fill="gray")
+        for lat in range(LAT_MIN, LAT_MAX + 1, 15):
+            y = int((LAT_MAX - lat) / (LAT_MAX - LAT_MIN) * self.eff_height * multiplier) - y0
+            if 0 <= y < y1 - y0:
+                draw.line([(0, y), (x1 - x0, y)], fill="gray")
+
+        # 大圏航路（はみ出した側に出力画像の幅だけずらしたコピーを描く）
+        for (row_x, row_y), (top, bottom) in zip(self.routes, self.route_spans):
+            if bottom < y0 - 1 or top > y1 + 1:
+                continue
+            # 座標を整数にしておくと、帯の境目をまたぐ線も1枚で描いたときと同じ画素になる
+            pts = list(zip((np.round(row_x).astype(int) - x0).tolist(), (np.round(row_y).astype(int) - y0).tolist()))
+            draw.line(pts, fill="blue", width=1)
+            if row_x.min() < 0:
+                draw.line([(x + width, y) for (x, y) in pts], fill="blue", width=1)
+            if row_x.max() > width:
+                draw.line([(x - width, y) for (x, y) in pts], fill="blue", width=1)
+
+        # ピン（範囲に掛かりうるものだけを、元の順番で）
+        lo = np.searchsorted(self.sorted_ys, y0 - self.LABEL_REACH, side="left")
+        hi = np.searchsorted(self.sorted_ys, y1 + self.LABEL_REACH, side="right")
+        rows = self.order[lo:hi]
+        if self.reach_x is not None and (x0 > 0 or x1 < width):
+            xs = self.sorted_xs[lo:hi]
+            rows = rows[(xs >= x0 - self.reach_x) & (xs <= x1 + self.reach_x)]
+        for i in np.sort(rows).tolist():
+            x, y, name, color, label = self.pins[i]
+            x -= x0
+            y -= y0
+            draw.polygon([(x - 3, y - 4), (x + 3, y - 4), (x, y)], fill="black")
+            if label:
+                anchor, dx, dy = label
+                draw.text((x + dx, y + dy), name, fill=color, font=self.font, anchor=LabelLayout.PIL_ANCHORS[anchor])
+        return img
+
+    def strip_result(self, y0, y1, future):
+        return y0, Image.frombytes("RGB", (self.width, y1 - y0), future.result())
+
+    def save(self, path, progress=None, workers=None, cancelled=None):
+        # 拡張子が .tif / .tiff なら TIFF、それ以外は PNG で保存。progress(書いた行数, 全行数) で進み具合を知らせる
+        # cancelled() が真になったら書きかけのファイルを消してやめる。最後まで書けたら True
+        writer_class = TiffStripWriter if os.path.splitext(path)[1].lower() in (".tif", ".tiff") else PngStripWriter
+        writer = writer_class(path, self.width, self.height)
+        strips = self.strips(workers)
+        try:
+            for y0, strip in strips:
+                if cancelled and cancelled():
+                    writer.abort()
+                    return False
+                writer.write(strip)
+                if progress:
+                    progress(y0 + strip.height, self.height)
+            writer.close()
+            return True
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            strips.close()  # 並列で描いている帯があれば取り消す
+
+class PngStripWriter:
+    # 8bit RGB の PNG を上から帯ごとに書く。行データは zlib で逐次圧縮し、ある程度たまるごとに IDAT チャンクにする
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(6)
+        self.buffer = []
+        self.buffered = 0
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, strip):
+        rows = np.asarray(strip.convert("RGB")).reshape(strip.height, -1)
+        # 各行の先頭にフィルタ種別 1（左隣の画素との差）を付ける
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rows[:, :3]
+        np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        self.push(self.compressor.compress(filtered.tobytes()))
+
+    def push(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.CHUNK_SIZE:
+            self.chunk(b"IDAT", b"".join(self.buffer))
+            self.buffer, self.buffered = [], 0
+
+    def close(self):
+        self.buffer.append(self.compressor.flush())
+        self.chunk(b"IDAT", b"".join(self.buffer))
+        self.chunk(b"IEND", b"")
+        self.file.close()
+
+    def abort(self):
+        # 途中で失敗・中止したときは書きかけのファイルを残さない
+        self.file.close()
+        os.remove(self.path)
+
+class TiffStripWriter:
+    # 無圧縮 RGB のベースライン TIFF を帯ごとに書く。画素を書き終えてから、帯の位置の一覧を含む IFD を末尾に書く
+    def __init__(self, path, width, height):
+        if width * height * 3 >= 2 ** 32 - 2 ** 20:
+            raise ValueError("TIFF で保存できる大きさ（4GB）を超えています。PNG で保存してください。")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.file = open(path, "wb")
+        self.file.write(b"II*\x00" + struct.pack("<I", 0))  # IFD の位置は close() で書き込む
+        self.offsets = []
+        self.counts = []
+        self.rows_per_strip = None
+
+    def write(self, strip):
+        if self.rows_per_strip is None:
+            self.rows_per_strip = strip.height
+        data = strip.convert("RGB").tobytes()
+        self.offsets.append(self.file.tell())
+        self.counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        f = self.file
+        entries = []
+
+        def entry(tag, kind, values):
+            fmt = {3: "<H", 4: "<I", 5: "<II"}[kind]
+            data = b"".join(struct.pack(fmt, *(v if kind == 5 else (v,))) for v in values)
+            if len(data) <= 4:
+                entries.append(struct.pack("<HHI", tag, kind, len(values)) + data.ljust(4, b"\x00"))
+            else:
+                if f.tell() % 2:
+                    f.write(b"\x00")
+                entries.append(struct.pack("<HHII", tag, kind, len(values), f.tell()))
+                f.write(data)
+
+        entry(256, 4, [self.width])            # ImageWidth
+        entry(257, 4, [self.height])           # ImageLength
+        entry(258, 3, [8, 8, 8])               # BitsPerSample
+        entry(259, 3, [1])                     # Compression（なし）
+        entry(262, 3, [2])                     # PhotometricInterpretation（RGB）
+        entry(273, 4, self.offsets)            # StripOffsets
+        entry(277, 3, [3])                     # SamplesPerPixel
+        entry(278, 4, [self.rows_per_strip or self.height])  # RowsPerStrip
+        entry(279, 4, self.counts)             # StripByteCounts
+        entry(282, 5, [(72, 1)])               # XResolution
+        entry(283, 5, [(72, 1)])               # YResolution
+        entry(284, 3, [1])                     # PlanarConfiguration
+        entry(296, 3, [2])                     # ResolutionUnit（インチ）
+        if f.tell() % 2:
+            f.write(b"\x00")
+        ifd = f.tell()
+        f.write(struct.pack("<H", len(entries)) + b"".join(entries) + struct.pack("<I", 0))
+        f.seek(4)
+        f.write(struct.pack("<I", ifd))
+        f.close()
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+# --- Web 地図用のタイル出力（z/x/y） ---
+# 地図全体を正距円筒図法のまま TILE_SIZE px 四方の PNG に分け、<出力フォルダ>/<z>/<x>/<y>.png に書く。
+# ズーム z の地図は幅 2×TILE_SIZE×2^z・高さ TILE_SIZE×2^z で、タイルは横 2^(z+1) 枚・縦 2^z 枚
+# （Leaflet の L.CRS.EPSG4326 などの経緯度タイルと同じ並び。x は経度 -180 度、y は北極から数える）。
+# ズームごとにラベルを置き直した MapExport を作り、各タイルはその範囲だけを1度ずつ描く。
+# 背景色のほかに何も描かれないタイルは書かない。描いた画素のハッシュを tiles.json に残しておき、
+# 前回と同じ画素のタイルは PNG に圧縮せずファイルもそのままにする（前回あって今回なくなったタイルは消す）。
+# タイルはワーカープロセスで並列に描き、各プロセスがそのままファイルに書く。
+tile_worker_job = None  # ワーカープロセスで書いている TileExport
+
+def init_tile_worker(job):
+    global tile_worker_job
+    tile_worker_job = job
+
+def render_export_tile(z, x, y, digest):
+    return tile_worker_job.write_tile(z, x, y, digest)
+
+class TileExport:
+    TILE_SIZE = 256
+    MANIFEST_FILE = "tiles.json"
+    BLANK_RGB = (224, 224, 224)  # 背景画像のない所の色（#e0e0e0）
+    PARALLEL_MIN_TILES = 16      # タイルがこれより少なければワーカーを起こさず順に描く
+
+    def __init__(self, root, exports):
+        self.root = root        # 出力フォルダ
+        self.exports = exports  # ズーム -> MapExport
+
+    @classmethod
+    def from_store(cls, root, store, font, min_zoom=0, max_zoom=4, background=None, bg_alpha=255, routes=None,
+                   selected_id=None):
+        # 引数は MapExport.from_store() と同じ（倍率の代わりにズームの範囲を受け取る。横方向のずれはなし）
+        size = cls.TILE_SIZE
+        exports = {z: MapExport.from_store(store, 2 * size, size, 2 ** z, font, background=background,
+                                           bg_alpha=bg_alpha, routes=routes, selected_id=selected_id)
+                   for z in range(min_zoom, max_zoom + 1)}
+        return cls(root, exports)
+
+    @staticmethod
+    def key(z, x, y):
+        return f"{z}/{x}/{y}"
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.root, str(z), str(x), f"{y}.png")
+
+    def tiles(self):
+        return [(z, x, y) for z in sorted(self.exports) for x in range(2 ** (z + 1)) for y in range(2 ** z)]
+
+    def write_tile(self, z, x, y, digest):
+        # タイル1枚を描き、画素のハッシュを返す（何も描かれなければ None）。digest は前回のハッシュ
+        size = self.TILE_SIZE
+        img = self.exports[z].render_box(x * size, y * size, (x + 1) * size, (y + 1) * size)
+        if img.getextrema() == tuple((c, c) for c in self.BLANK_RGB):
+            return None
+        new_digest = hashlib.blake2b(img.tobytes(), digest_size=16).hexdigest()
+        path = self.tile_path(z, x, y)
+        if new_digest != digest or not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            img.save(path + ".tmp", "PNG")
+            os.replace(path + ".tmp", path)
+        return new_digest
+
+    def read_manifest(self):
+        # 前回の出力のハッシュ（キー "z/x/y" -> ハッシュ）。タイルの大きさが違えばすべて描き直す
+        path = os.path.join(self.root, self.MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("tile_size") != self.TILE_SIZE:
+            return {}
+        return manifest.get("tiles", {})
+
+    def write_manifest(self, digests):
+        manifest = {"tile_size": self.TILE_SIZE, "min_zoom": min(self.exports), "max_zoom": max(self.exports),
+                    "bounds": [LON_MIN, LAT_MIN, LON_MAX, LAT_MAX], "tiles": digests}
+        replace_atomically(os.path.join(self.root, self.MANIFEST_FILE),
+                           lambda f: json.dump(manifest, f, ensure_ascii=False, separators=(",", ":")))
+
+    def results(self, tiles, old, workers):
+        # 描けたタイルを (z, x, y, ハッシュ) で返す（並列のときは描けた順）
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 2 or len(tiles) < self.PARALLEL_MIN_TILES:
+            for z, x, y in tiles:
+                yield z, x, y, self.write_tile(z, x, y, old.get(self.key(z, x, y)))
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers, initializer=init_tile_worker, initargs=(self,)) as pool:
+            pending = {}  # Future -> (z, x, y)。先に投げておくのは workers の4倍まで
+            try:
+                for tile in tiles:
+                    pending[pool.submit(render_export_tile, *tile, old.get(self.key(*tile)))] = tile
+                    if len(pending) >= workers * 4:
+                        yield from self.collect(pending)
+                while pending:
+                    yield from self.collect(pending)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def collect(pending):
+        from concurrent.futures import wait, FIRST_COMPLETED
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            yield (*pending.pop(future), future.result())
+
+    def save(self, progress=None, workers=None, cancelled=None):
+        # すべてのタイルを書き出す。progress(描いたタイル数, 全タイル数) で進み具合を知らせる
+        # cancelled() が真になったらやめる（書けたタイルは残し、tiles.json もそこまでの内容にする）。最後まで書けたら True
+        os.makedirs(self.root, exist_ok=True)
+        old = self.read_manifest()
+        digests = dict(old)
+        tiles = self.tiles()
+        results = self.results(tiles, old, workers)
+        try:
+            for done, (z, x, y, digest) in enumerate(results, 1):
+                key = self.key(z, x, y)
+                if digest is not None:
+                    digests[key] = digest
+                elif digests.pop(key, None) is not None:
+                    self.remove_tile(key)
+                if progress:
+                    progress(done, len(tiles))
+                if cancelled and cancelled():
+                    return False
+            # 今回のズームの範囲から外れたタイルも消す
+            wanted = {self.key(*tile) for tile in tiles}
+            for key in [key for key in digests if key not in wanted]:
+                del digests[key]
+                self.remove_tile(key)
+            return True
+        finally:
+            results.close()  # 並列で描いているタイルがあれば取り消す
+            self.write_manifest(digests)
+
+    def remove_tile(self, key):
+        try:
+            os.remove(self.tile_path(*key.split("/")))
+        except FileNotFoundError:
+            pass
+
+# --- 画面なしでの書き出し（コマンドライン） ---
+# GUI を起動せずに、マップフォルダ（pins.csv または pins.sqlite、settings.json、map.png）を地図全体の画像にする。
+# 出力は GUI の「画像生成」と同じ（横方向のずれなし・大圏航路なし）。--tiles では Web 地図用のタイルにする。
+# マップフォルダは読むだけで、キャッシュ・追記ログ・背景のタイルピラミッドには手を付けない。
+def load_font(size=EXPORT_FONT_SIZE):
+    # 既定のフォントファイルがなければ Pillow の既定フォントを使う
+    try:
+        return ImageFont.truetype(DEFAULT_FONT_PATH, size)
+    except IOError:
+        return ImageFont.load_default().font_variant(size=size)
+
+def read_map_settings(folder):
+    # settings.json の内容（なければ空）
+    path = os.path.join(folder, SETTINGS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def load_map_pins(folder):
+    # マップフォルダには何も書かない（読み取り専用の場所や GUI で開いているフォルダからも書き出せるように）
+    columns = load_pins_file(folder, read_only=True)[0]
+    store = PinStore()
+    store.extend(columns.lat, columns.lon, columns.names, columns.remarks, columns.colors)
+    return store
+
+def map_background(folder):
+    # 背景と不透明度（0～255）。背景は最新のタイルピラミッドがあればそれを、なければ map.png を直接読む（なければ None）
+    # ピラミッドは作らない（マップフォルダには書かない）
+    alpha = float(read_map_settings(folder).get("bg_alpha", 100.0)) / 100.0
+    source = os.path.join(folder, BG_SOURCE_FILE)
+    if TilePyramid.is_current(folder):
+        background = TilePyramid(folder)
+    elif os.path.exists(source):
+        with Image.open(source) as img:
+            background = img.convert("RGB")
+    else:
+        background = None
+    return dict(background=background, bg_alpha=min(max(int(alpha * 255), 0), 255))
+
+def render_map_folder(folder, out_path, multiplier=1, font=None, workers=None, progress=None):
+    # 拡張子が .tif / .tiff なら TIFF、それ以外は PNG で保存し、書き出した MapExport を返す
+    export = MapExport.from_store(load_map_pins(folder), MAP_WIDTH, MAP_HEIGHT, multiplier, font or load_font(),
+                                  **map_background(folder))
+    export.save(out_path, progress, workers)
+    return export
+
+def render_map_tiles(folder, out_dir, min_zoom=0, max_zoom=4, font=None, workers=None, progress=None):
+    # out_dir に z/x/y のタイルを書き、書き出した TileExport を返す
+    export = TileExport.from_store(out_dir, load_map_pins(folder), font or load_font(), min_zoom, max_zoom,
+                                   **map_background(folder))
+    export.save(progress, workers)
+    return export
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="マップフォルダを画面なしで画像に書き出す")
+    parser.add_argument("folders", nargs="+", help="マップフォルダ（pins.csv または pins.sqlite を含む）")
+    parser.add_argument("-o", "--output", help="出力フォルダ（省略時は各マップフォルダと同じ場所に <フォルダ名>.png）")
+    parser.add_argument("-m", "--multiplier", type=int, default=1, help="出力の倍率（既定 1）")
+    parser.add_argument("-j", "--workers", type=int, help="帯を描くプロセス数（既定は CPU 数）")
+    parser.add_argument("--tiff", action="store_true", help="PNG ではなく TIFF で書き出す")
+    parser.add_argument("--tiles", action="store_true",
+                        help="1枚の画像ではなく Web 地図用の z/x/y タイル（<フォルダ名>_tiles）で書き出す")
+    parser.add_argument("--min-zoom", type=int, default=0, help="タイルの最小ズーム（既定 0）")
+    parser.add_argument("--max-zoom", type=int, default=4, help="タイルの最大ズーム（既定 4）")
+    args = parser.parse_args(argv)
+    if not 0 <= args.min_zoom <= args.max_zoom:
+        parser.error("ズームは 0 <= --min-zoom <= --max-zoom にしてください")
+
+    font = load_font()
+    failed = 0
+    for folder in args.folders:
+        folder = os.path.normpath(folder)
+        out_dir = args.output or os.path.dirname(os.path.abspath(folder))
+        suffix = "_tiles" if args.tiles else ".tif" if args.tiff else ".png"
+        out_path = os.path.join(out_dir, os.path.basename(folder) + suffix)
+        started = time.perf_counter()
+        try:
+            if not any(os.path.exists(os.path.join(folder, name)) for name in (PINS_FILE, PINS_DB_FILE)):
+                raise ValueError(f"{PINS_FILE}（または {PINS_DB_FILE}）が見つかりません")
+            os.makedirs(out_dir, exist_ok=True)
+            if args.tiles:
+                export = render_map_tiles(folder, out_path, args.min_zoom, args.max_zoom, font, args.workers)
+                size = f"ズーム {args.min_zoom}～{args.max_zoom}、タイル {len(export.read_manifest())} 枚"
+            else:
+                export = render_map_folder(folder, out_path, args.multiplier, font, args.workers)
+                size = f"{export.width}x{export.height}"
+        except Exception as e:
+            failed += 1
+            print(f"{folder}: 書き出しに失敗しました: {e}", file=sys.stderr)
+            continue
+        print(f"{folder} -> {out_path}（{size}、{time.perf_counter() - started:.1f}秒）")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,7 +13,7 @@ REM 仮想環境を有効化
 call %VENV_DIR%\Scripts\activate
 
 REM 必要なライブラリのリスト
-set LIBS=pillow pandas matplotlib cartopy scipy
+set LIBS=pillow numpy pandas matplotlib cartopy scipy
 
 REM ライブラリの欠如をチェック
 set "MISSING=0"
@@ -0,0 +1,4 @@
+# テストからリポジトリ直下のモジュール（locaindex_render・LocaIndex_Manager）を読めるようにする
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
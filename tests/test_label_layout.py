@@ -0,0 +1,47 @@
+from locaindex_render import LabelLayout, PinStore
+
+PERIOD = 1000
+
+def make_layout(names):
+    store = PinStore()
+    ids = store.extend([0.0] * len(names), [0.0] * len(names), names, [""] * len(names), ["blue"] * len(names))
+    layout = LabelLayout(lambda text: (40, 10), 8, PERIOD, store, lambda: None)
+    return layout, ids
+
+def overlaps(layout, a, b):
+    return any(p[0] < q[2] and q[0] < p[2] and p[1] < q[3] and q[1] < p[3]
+               for p in layout.boxes[a] for q in layout.boxes[b])
+
+def test_labels_far_apart_both_go_above():
+    layout, (a, b) = make_layout(["A", "B"])
+    layout.set_pins([a, b], [300, 600], [100, 100], ["A", "B"])
+    assert layout.label(a)[0] == "s"
+    assert layout.label(b)[0] == "s"
+
+def test_labels_collide_across_the_wrap():
+    layout, (a, b) = make_layout(["A", "B"])
+    # A は右端、B は左端。上に置いた A のラベルは一周の継ぎ目をまたいで B の上にかかる
+    layout.set_pins([a, b], [PERIOD - 5, 5], [100, 100], ["A", "B"])
+    assert layout.label(a)[0] == "s"
+    assert layout.label(b) is not None and layout.label(b)[0] != "s"
+    assert not overlaps(layout, a, b)
+
+def test_wrapped_coordinates_are_reduced_to_one_period():
+    layout, (a, b) = make_layout(["A", "B"])
+    layout.set_pins([a, b], [-5, PERIOD + 5], [100, 100], ["A", "B"])
+    assert layout.label(a)[0] == "s"
+    assert layout.label(b)[0] != "s"
+    assert not overlaps(layout, a, b)
+
+def test_moving_a_pin_across_the_wrap_resettles_its_neighbour():
+    layout, (a, b) = make_layout(["A", "B"])
+    layout.set_pins([a, b], [500, 5], [100, 100], ["A", "B"])
+    assert layout.label(b)[0] == "s"
+    changed = layout.put(a, PERIOD - 5, 100, "A")
+    assert b in changed
+    assert layout.label(a)[0] == "s"
+    assert layout.label(b)[0] != "s"
+    assert not overlaps(layout, a, b)
+    # 離れると B は上に戻る
+    assert b in layout.put(a, 500, 100, "A")
+    assert layout.label(b)[0] == "s"
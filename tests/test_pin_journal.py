@@ -0,0 +1,67 @@
+import os
+
+from locaindex_render import (PIN_CACHE_FILE, PIN_JOURNAL_FILE, PinJournal, PinStore, load_map_pins, load_pins_file,
+                              write_pins_folder)
+
+def saved_folder(tmp_path):
+    # 3 件を pins.csv に書き、1 件削除・1 件変更・1 件追加を追記ログに残したマップフォルダ
+    store = PinStore()
+    a, b, c = store.extend([1.0, 2.0, 3.0], [10.0, 20.0, 30.0], ["a", "b", "c"], ["", "", ""], ["red", "red", "red"])
+    pin_ids, digest = write_pins_folder(str(tmp_path), store)
+    journal = PinJournal()
+    journal.bind(str(tmp_path), pin_ids, list(range(len(pin_ids))), digest)
+    store.remove(a)
+    journal.mark_delete(a)
+    store.update(b, 2.5, 25.0, "b2", "changed", "blue")
+    journal.mark_put(b)
+    d = store.add(4.0, 40.0, "d")
+    journal.mark_put(d)
+    journal.append(store)
+    return os.path.join(str(tmp_path), PIN_JOURNAL_FILE)
+
+def pins_of(columns):
+    return {key: (lat, lon, name, remark, color) for key, lat, lon, name, remark, color in
+            zip(columns.keys, columns.lat.tolist(), columns.lon.tolist(), columns.names, columns.remarks, columns.colors)}
+
+EXPECTED = {1: (2.5, 25.0, "b2", "changed", "blue"), 2: (3.0, 30.0, "c", "", "red"), 3: (4.0, 40.0, "d", "", "blue")}
+
+def test_journal_is_replayed_onto_pins_csv(tmp_path):
+    saved_folder(tmp_path)
+    columns, digest, cached, entries, storage = load_pins_file(str(tmp_path))
+    assert (cached, entries, storage) == (True, 3, "CSV")
+    assert pins_of(columns) == EXPECTED
+
+def test_truncated_last_record_is_dropped_and_cut_off(tmp_path):
+    path = saved_folder(tmp_path)
+    good_size = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b'{"op": "put", "key": 7, "lat": 5.0, "lon"')  # 書き込み途中で落ちた記録
+    columns, digest, cached, entries, storage = load_pins_file(str(tmp_path))
+    assert entries == 3
+    assert pins_of(columns) == EXPECTED
+    assert os.path.getsize(path) == good_size
+    # 切り詰めた後にもう一度開いても同じ内容になる
+    columns, digest, cached, entries, storage = load_pins_file(str(tmp_path))
+    assert entries == 3
+
+def test_journal_for_an_older_pins_csv_is_discarded(tmp_path):
+    path = saved_folder(tmp_path)
+    with open(path, "rb") as f:
+        lines = f.readlines()
+    with open(path, "wb") as f:
+        f.write(b'{"base": "0000"}\n' + b"".join(lines[1:]))
+    columns, digest, cached, entries, storage = load_pins_file(str(tmp_path))
+    assert entries == 0
+    assert columns.names == ["a", "b", "c"]
+    assert not os.path.exists(path)
+
+def test_read_only_load_leaves_the_folder_untouched(tmp_path):
+    path = saved_folder(tmp_path)
+    os.remove(os.path.join(str(tmp_path), PIN_CACHE_FILE))
+    with open(path, "ab") as f:
+        f.write(b'{"op": "del"')
+    size = os.path.getsize(path)
+    store = load_map_pins(str(tmp_path))
+    assert sorted(store.get(pin_id).name for pin_id in store.ids.tolist()) == ["b2", "c", "d"]
+    assert os.path.getsize(path) == size
+    assert not os.path.exists(os.path.join(str(tmp_path), PIN_CACHE_FILE))
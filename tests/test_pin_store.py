@@ -0,0 +1,26 @@
+from locaindex_render import PinStore
+
+def make_store():
+    store = PinStore()
+    ids = store.extend([10.0, 20.0, 30.0], [1.0, 2.0, 3.0], ["c", "a", "b"], ["", "", ""], ["red", "blue", "green"])
+    return store, ids
+
+def test_ids_stay_attached_to_pins_across_delete_and_insert():
+    store, (c, a, b) = make_store()
+    store.remove(c)  # 最終行でない行を消すと、最終行が空いた行へ移る
+    d = store.add(40.0, 4.0, "d")
+    assert c not in store
+    assert d not in (a, b, c)
+    assert store.lat_lon(a) == (20.0, 2.0)
+    assert store.lat_lon(b) == (30.0, 3.0)
+    assert store.lat_lon(d) == (40.0, 4.0)
+    assert [store.get(pin_id).name for pin_id in (a, b, d)] == ["a", "b", "d"]
+    assert sorted(store.ids.tolist()) == sorted([a, b, d])
+    assert store.sorted_ids() == [a, b, d]
+
+def test_ids_are_not_reused_after_clear():
+    store, ids = make_store()
+    store.clear()
+    new_ids = store.extend([0.0], [0.0], ["x"], [""], ["black"])
+    assert len(store) == 1
+    assert not set(new_ids) & set(ids)
@@ -0,0 +1,63 @@
+from LocaIndex_Manager import PinSearchIndex
+from locaindex_render import PinStore
+
+def make_index(names, remarks):
+    store = PinStore()
+    ids = store.extend([0.0] * len(names), [0.0] * len(names), names, remarks, ["blue"] * len(names))
+    index = PinSearchIndex(store)
+    for pin_id in ids:
+        index.add(pin_id)
+    return store, index, ids
+
+def found(index, query):
+    return sorted(index.search(query).tolist())
+
+def test_one_and_two_gram_queries():
+    store, index, (tokyo, kyoto, osaka) = make_index(["東京", "京都", "大阪"], ["", "", "港あり"])
+    assert index.search("  ") is None
+    assert found(index, "京") == [tokyo, kyoto]
+    assert found(index, "東京") == [tokyo]
+    assert found(index, "京東") == []
+    assert found(index, "港") == [osaka]  # 備考も検索する
+
+def test_longer_queries_are_checked_against_the_text():
+    store, index, (a, b) = make_index(["abcab", "abxbc"], ["", ""])
+    # 2-gram（ab, bc）はどちらにもあるが、"abc" を含むのは a だけ
+    assert found(index, "abc") == [a]
+    assert found(index, "ab") == [a, b]
+
+def test_queries_are_normalized():
+    store, index, (a,) = make_index(["Ｔｏｋｙｏ Tower"], [""])
+    assert found(index, "tokyo") == [a]
+    assert found(index, "TOWER") == [a]
+
+def test_as_you_type_narrowing_follows_edits():
+    store, index, (a, b) = make_index(["alpha", "alps"], ["", ""])
+    assert found(index, "al") == [a, b]
+    assert found(index, "alp") == [a, b]
+    store.update(b, 0.0, 0.0, "beta", "", "blue")
+    index.update(b)
+    # 直前の結果は version が変わったので使わない
+    assert found(index, "alph") == [a]
+    assert found(index, "be") == [b]
+    index.remove(a)
+    assert found(index, "al") == []
+
+def test_adopted_entries_use_the_id_base():
+    store = PinStore()
+    store.extend([0.0], [0.0], ["old"], [""], ["blue"])
+    store.clear()
+    names, remarks = ["north", "south"], ["", ""]
+    ids = store.extend([0.0, 0.0], [0.0, 0.0], names, remarks, ["blue", "blue"])
+    index = PinSearchIndex(store)
+    index.adopt(PinSearchIndex.build_entries(names, remarks), ids[0])
+    assert found(index, "th") == sorted(ids)
+    assert found(index, "no") == [ids[0]]
+
+def test_results_rank_by_name_with_a_limit():
+    names = [f"pin{i:03d}" for i in range(100)][::-1]
+    store, index, ids = make_index(names, [""] * 100)
+    hits = index.search("pin")
+    by_name = sorted(ids, key=lambda pin_id: store.get(pin_id).name)
+    assert store.sort_by_name(hits) == by_name
+    assert store.sort_by_name(hits, 10) == by_name[:10]
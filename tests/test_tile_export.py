@@ -0,0 +1,60 @@
+import json, os
+
+from locaindex_render import PinStore, TileExport, load_font
+
+SENTINEL = b"not rewritten"
+
+def save_tiles(root, lat, lon, min_zoom=0, max_zoom=1):
+    store = PinStore()
+    store.extend([lat], [lon], ["Tokyo"], [""], ["red"])
+    export = TileExport.from_store(str(root), store, load_font(), min_zoom, max_zoom)
+    assert export.save(workers=1)
+    return export
+
+def manifest(root):
+    with open(os.path.join(str(root), TileExport.MANIFEST_FILE), encoding="utf-8") as f:
+        return json.load(f)["tiles"]
+
+def mark(export, keys):
+    # 書き直されたかどうかが分かるように、タイルの中身を置き換えておく（tiles.json はそのまま）
+    for key in keys:
+        with open(export.tile_path(*key.split("/")), "wb") as f:
+            f.write(SENTINEL)
+
+def is_marked(export, key):
+    with open(export.tile_path(*key.split("/")), "rb") as f:
+        return f.read() == SENTINEL
+
+def test_unchanged_tiles_are_not_rewritten(tmp_path):
+    export = save_tiles(tmp_path, 35.0, 139.0)
+    before = manifest(tmp_path)
+    assert sorted(before) == sorted(export.key(*tile) for tile in export.tiles())
+    mark(export, before)
+    export = save_tiles(tmp_path, 35.0, 139.0)
+    assert manifest(tmp_path) == before
+    assert all(is_marked(export, key) for key in before)
+
+def test_changed_and_missing_tiles_are_rewritten(tmp_path):
+    export = save_tiles(tmp_path, 35.0, 139.0)
+    before = manifest(tmp_path)
+    mark(export, before)
+    os.remove(export.tile_path(1, 1, 0))
+    # ピンを 1/3/0 から 1/0/1 へ動かす
+    export = save_tiles(tmp_path, -45.0, -100.0)
+    after = manifest(tmp_path)
+    changed = {key for key in before if after[key] != before[key]}
+    assert {"1/3/0", "1/0/1"} <= changed
+    assert all(not is_marked(export, key) for key in changed)
+    assert all(is_marked(export, key) for key in set(before) - changed - {"1/1/0"})
+    assert not is_marked(export, "1/1/0")  # ハッシュは同じでもファイルがなければ書く
+
+def test_blank_tiles_are_skipped_and_stale_tiles_removed(tmp_path):
+    export = save_tiles(tmp_path, 35.0, 139.0, 0, 4)
+    digests = manifest(tmp_path)
+    assert len(digests) < len(export.tiles())
+    for tile in export.tiles():
+        assert os.path.exists(export.tile_path(*tile)) == (export.key(*tile) in digests)
+    export = save_tiles(tmp_path, 35.0, 139.0, 0, 1)
+    assert set(manifest(tmp_path)) == {export.key(*tile) for tile in export.tiles()}
+    stale = [key for key in digests if key.startswith("4/")]
+    assert stale and not any(os.path.exists(export.tile_path(*key.split("/"))) for key in stale)